@@ -19,6 +19,21 @@
 
 __version__ = '0.4'
 
+import sys
+
 from .config import conf
 from .produtos import get_produto
+from .produtos import get_produtos
 from .servicos import get_servico
+from .servicos import get_servicos
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(nome):
+        # as consultas assíncronas são importadas apenas quando utilizadas,
+        # de modo que ``import ibptws`` não dependa de aiohttp nem de redis
+        if nome in ('get_produto_async', 'get_servico_async'):
+            from . import assincrono
+            return getattr(assincrono, nome)
+        raise AttributeError(
+                "module 'ibptws' has no attribute '{}'".format(nome))
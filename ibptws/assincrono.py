@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/assincrono.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Consultas assíncronas (:mod:`asyncio`) aos web services do IBPT. Este módulo
+requer Python 3.7+ e, para o transporte padrão, o pacote `aiohttp`_
+(instale com ``pip install ibptws[async]``).
+
+.. sourcecode:: python
+
+    >>> from ibptws.assincrono import get_produto_async  # doctest: +SKIP
+    >>> produto = await get_produto_async('02091021')   # doctest: +SKIP
+
+.. versionadded:: 0.5
+
+.. _`aiohttp`: https://docs.aiohttp.org/
+"""
+
+import asyncio
+import json
+import threading
+import time
+import uuid
+import weakref
+
+from collections import OrderedDict
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from .config import conf
+from .excecoes import ErroNaoEncontrado
+from .instrumentacao import relogio
+from .lotes import chaves_de_produtos
+from .lotes import unicos
+from .produtos import Produto
+from .produtos import _parametros as _parametros_produto
+from .produtos import _produto_da_resposta
+from .servicos import _parametros as _parametros_servico
+from .servicos import Servico
+from .servicos import _servico_da_resposta
+from .transportes import STATUS_REPETIVEIS
+from .transportes import PoliticaRepeticao
+from .provisoes import EXPIRA_EM_1H
+from .provisoes import EXPIRA_EM_24H
+from .provisoes import CodecHash
+from .provisoes import ProvisaoViaRedis
+from .provisoes import VERSAO_TABELA
+from .provisoes import _identificar_versao
+from .provisoes import _interpretar_versao
+from .provisoes import _str
+
+
+class RespostaAssincrona(object):
+    """
+    Resposta já lida de uma requisição assíncrona. Imita a interface de
+    ``requests.Response`` necessária para interpretar as respostas do web
+    services, de modo que as consultas síncronas e assíncronas compartilhem
+    o mesmo tratamento (e as mesmas exceções).
+    """
+
+    def __init__(self, url, status_code, conteudo):
+        self.url = url
+        self.status_code = status_code
+        self.conteudo = conteudo
+
+
+    def json(self):
+        return json.loads(self.conteudo.decode('utf-8'))
+
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.HTTPError('{} for url: {}'.format(
+                    self.status_code, self.url), response=self)
+
+
+class TransporteAssincronoBase(object):
+    """
+    Classe base para os transportes HTTP assíncronos. Um transporte mínimo
+    deverá sobrescrever a *coroutine* :meth:`get`.
+    """
+
+    async def get(self, url, params=None):
+        """
+        Realiza uma requisição HTTP GET.
+
+        :return: Uma instância de :class:`RespostaAssincrona` (ou qualquer
+            objeto que se comporte da mesma maneira).
+        """
+        raise NotImplementedError()
+
+
+    async def fechar(self):
+        """Libera os recursos mantidos pelo transporte."""
+        pass
+
+
+class TransporteAIOHTTP(PoliticaRepeticao, TransporteAssincronoBase):
+    """
+    Implementa um transporte assíncrono baseado em uma ``aiohttp.ClientSession``
+    com um *pool* de conexões persistentes e um limite para o número de
+    requisições simultâneas, de modo que milhares de consultas possam ser
+    disparadas no mesmo *event loop* sem sobrecarregar o web services.
+
+    Cada *event loop* que utilizar o transporte terá sua própria sessão (e
+    seu próprio limite de requisições simultâneas), criada sob demanda, de
+    modo que diferentes *threads*, cada uma com o seu *event loop*, possam
+    compartilhar o mesmo transporte. As sessões de *event loops* já
+    encerrados são descartadas quando uma nova sessão é criada. Prefira
+    invocar :meth:`fechar` antes de encerrar o *event loop*.
+
+    Assim como em :class:`~ibptws.transportes.TransporteHTTP`, toda
+    requisição tem um tempo limite para conexão e para leitura e,
+    opcionalmente, um prazo total; falhas de conexão, tempo esgotado e erros
+    HTTP 5xx são repetidos com espera exponencial e aleatória entre as
+    tentativas e cada endereço do web services tem seu próprio
+    :class:`~ibptws.transportes.Disjuntor`.
+    """
+
+    def __init__(self, max_conexoes=100, conexoes_por_host=0,
+            max_simultaneas=100, keep_alive=True, timeout=(3.05, 10),
+            prazo=None, max_tentativas=3, espera_inicial=0.1, espera_maxima=2,
+            limite_falhas=5, tempo_recuperacao=30):
+        """
+        Inicia uma instância de :class:`TransporteAIOHTTP`.
+
+        :param int max_conexoes: Número máximo de conexões abertas no *pool*.
+            Informe ``0`` para não limitar.
+
+        :param int conexoes_por_host: Número máximo de conexões abertas para
+            um mesmo host. Informe ``0`` para não limitar.
+
+        :param int max_simultaneas: Número máximo de requisições em andamento
+            ao mesmo tempo. As demais aguardam sua vez.
+
+        :param bool keep_alive: Se ``False``, as conexões serão encerradas ao
+            final de cada requisição.
+
+        Os argumentos ``timeout``, ``prazo``, ``max_tentativas``,
+        ``espera_inicial``, ``espera_maxima``, ``limite_falhas`` e
+        ``tempo_recuperacao`` são os mesmos de
+        :class:`~ibptws.transportes.TransporteHTTP`.
+        """
+        if aiohttp is None:
+            raise ImportError('TransporteAIOHTTP requer o pacote aiohttp')
+        super(TransporteAIOHTTP, self).__init__(timeout=timeout, prazo=prazo,
+                max_tentativas=max_tentativas, espera_inicial=espera_inicial,
+                espera_maxima=espera_maxima, limite_falhas=limite_falhas,
+                tempo_recuperacao=tempo_recuperacao)
+        self.max_conexoes = max_conexoes
+        self.conexoes_por_host = conexoes_por_host
+        self.max_simultaneas = max_simultaneas
+        self.keep_alive = keep_alive
+        self._sessoes = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+
+    def _preparar(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            sessao = self._sessoes.get(loop)
+            if sessao is None:
+                self._descartar_encerradas()
+                conector = aiohttp.TCPConnector(
+                        limit=self.max_conexoes,
+                        limit_per_host=self.conexoes_por_host,
+                        force_close=not self.keep_alive)
+                sessao = self._sessoes[loop] = (
+                        aiohttp.ClientSession(connector=conector),
+                        asyncio.Semaphore(self.max_simultaneas))
+        return sessao
+
+
+    def _descartar_encerradas(self):
+        # um event loop encerrado (como ao final de asyncio.run()) não pode
+        # mais encerrar as conexões da sua sessão; a sessão é marcada como
+        # encerrada e as conexões do conector são liberadas quando ele for
+        # descartado
+        for loop, (sessao, _) in list(self._sessoes.items()):
+            if loop.is_closed():
+                del self._sessoes[loop]
+                sessao.detach()
+
+
+    async def get(self, url, params=None):
+        disjuntor = self._permitir(url)
+        limite = self._limite()
+        tentativa = 0
+
+        while True:
+            tentativa += 1
+            erro, response = None, None
+            try:
+                response = await self._get(url, params, limite)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError,
+                    requests.Timeout) as ex:
+                erro = ex
+            except Exception:
+                disjuntor.falha()
+                raise
+            else:
+                if response.status_code not in STATUS_REPETIVEIS:
+                    disjuntor.sucesso()
+                    return response
+
+            espera = self._espera(tentativa, limite)
+            if espera is None:
+                disjuntor.falha()
+                if erro is not None:
+                    raise erro
+                return response
+
+            await asyncio.sleep(espera)
+
+
+    async def _get(self, url, params, limite):
+        # os mesmos tempos limite de TransporteHTTP; o prazo restante limita
+        # a requisição inteira (aiohttp não limita um total menor que zero)
+        conexao, leitura = self._timeout(limite)
+        total = None if limite is None else max(limite - time.time(), 0.001)
+        timeout = aiohttp.ClientTimeout(total=total,
+                sock_connect=conexao, sock_read=leitura)
+        sessao, semaforo = self._preparar()
+        async with semaforo:
+            async with sessao.get(url, params=_query(params),
+                    timeout=timeout) as response:
+                conteudo = await response.read()
+                return RespostaAssincrona(str(response.url),
+                        response.status, conteudo)
+
+
+    async def fechar(self):
+        """
+        Encerra as sessões de todos os *event loops*. A sessão do *event
+        loop* atual é encerrada imediatamente; as dos demais *event loops*
+        em execução são encerradas nos respectivos *event loops*.
+        """
+        atual = asyncio.get_running_loop()
+        with self._lock:
+            sessoes = list(self._sessoes.items())
+            self._sessoes.clear()
+        for loop, (sessao, _) in sessoes:
+            if loop is atual:
+                await sessao.close()
+            elif loop.is_running() and not loop.is_closed():
+                # a sessão pertence a outro event loop e só pode ser
+                # encerrada nele
+                asyncio.run_coroutine_threadsafe(sessao.close(), loop)
+            else:
+                sessao.detach()
+
+
+def _query(params):
+    # aiohttp (yarl) aceita apenas str, int e float na query string
+    return {k: v if isinstance(v, (int, float)) else str(v)
+            for k, v in (params or {}).items()}
+
+
+def _transporte():
+    if conf.transporte_assincrono is None:
+        conf.transporte_assincrono = TransporteAIOHTTP()
+    return conf.transporte_assincrono
+
+
+async def get_produto_async(codigo_ncm, excecao=0):
+    """
+    Versão assíncrona de :func:`~ibptws.produtos.get_produto`, com os mesmos
+    argumentos, o mesmo retorno e as mesmas exceções.
+    """
+    return await _consultar('produtos', conf.endpoint.produtos,
+            _parametros_produto(codigo_ncm, excecao),
+            _produto_da_resposta, codigo_ncm, excecao)
+
+
+async def get_servico_async(codigo_nbs):
+    """
+    Versão assíncrona de :func:`~ibptws.servicos.get_servico`, com os mesmos
+    argumentos, o mesmo retorno e as mesmas exceções.
+    """
+    return await _consultar('servicos', conf.endpoint.servicos,
+            _parametros_servico(codigo_nbs), _servico_da_resposta, codigo_nbs)
+
+
+async def _consultar(recurso, url, params, interpretar, *args):
+    instrumentacao = conf.instrumentacao
+    if instrumentacao is None:
+        response = await _transporte().get(url, params=params)
+        return interpretar(response, *args)
+
+    inicio = relogio()
+    erro = None
+    try:
+        response = await _transporte().get(url, params=params)
+        return interpretar(response, *args)
+    except Exception as ex:
+        erro = ex
+        raise
+    finally:
+        instrumentacao.registrar_consulta(recurso, relogio() - inicio, erro)
+
+
+async def _consultar_em_lote(funcao, chaves):
+    # versão assíncrona de lotes.consultar_em_lote; as consultas simultâneas
+    # são limitadas pelo próprio transporte assíncrono
+    chaves = unicos(chaves)
+    consultas = [funcao(*(chave if isinstance(chave, tuple) else (chave,)))
+            for chave in chaves]
+    resultados = await asyncio.gather(*consultas, return_exceptions=True)
+    return OrderedDict(zip(chaves, resultados))
+
+
+async def _ler(redis, codec, chaves):
+    # versão assíncrona de CodecBase.ler
+    if not chaves:
+        return []
+    async with redis.pipeline(transaction=False) as pipe:
+        codec.consultar(pipe, chaves)
+        valores, _ = codec.interpretar(await pipe.execute())
+    if codec.legado is not None:
+        legadas = [i for i, valor in enumerate(valores) if valor is None]
+        if legadas:
+            lidos = await _ler(redis, codec.legado,
+                    [chaves[i] for i in legadas])
+            for i, dados in zip(legadas, lidos):
+                valores[i] = dados
+    return valores
+
+
+class ProvisaoViaRedisAssincrona(object):
+    """
+    Versão assíncrona de :class:`~ibptws.provisoes.ProvisaoViaRedis`,
+    baseada no cliente ``redis.asyncio`` (requer `redis-py`_ 4.2+). Utiliza
+    as mesmas chaves, as mesmas travas e os mesmos *codecs* que
+    :class:`~ibptws.provisoes.ProvisaoViaRedis`, de modo que processos
+    síncronos e assíncronos podem compartilhar o mesmo provisionamento.
+    Produtos e serviços não provisionados são obtidos com
+    :func:`get_produto_async` e :func:`get_servico_async`.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaRedisAssincrona(host='localhost')  # doctest: +SKIP
+        >>> produto = await provisao.get_produto('02091021', 0)  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+
+    .. _`redis-py`: https://github.com/redis/redis-py
+    """
+
+    def __init__(self, redis=None, expires=EXPIRA_EM_24H,
+            expires_nao_encontrado=EXPIRA_EM_1H, trava_expira=10,
+            codec=None, variacao_expiracao=0, indexar_expiracoes=False,
+            versao=None, **kwargs):
+        """
+        Inicia uma instância de :class:`ProvisaoViaRedisAssincrona`. Os
+        argumentos são os mesmos de
+        :class:`~ibptws.provisoes.ProvisaoViaRedis`, exceto que ``redis``,
+        se informado, deverá ser uma instância de ``redis.asyncio.Redis`` e
+        que ``kwargs`` são os argumentos para criar essa instância.
+
+        As chaves são versionadas como em
+        :class:`~ibptws.provisoes.ProvisaoViaRedis` (veja o argumento
+        ``versao`` e :meth:`mudar_versao`), inclusive durante a transição
+        entre versões. A versão publicada por
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.publicar_versao` é obtida
+        com :meth:`sincronizar_versao`.
+        """
+        self._redis = redis
+        self._codec = codec or CodecHash()
+        self._expires = expires
+        self._expires_nao_encontrado = expires_nao_encontrado
+        self._trava_expira = trava_expira
+        self._trava_intervalo = 0.05
+        self._variacao_expiracao = variacao_expiracao
+        self._indexar_expiracoes = indexar_expiracoes
+        self._em_andamento = {}
+        self._lock = threading.Lock()
+        self._versao = _identificar_versao(versao)
+        self._transicao = None
+        self._ao_mudar_versao = []
+        self._kwargs = kwargs
+
+
+    # a gravação não faz E/S (apenas inclui os comandos no pipeline), por
+    # isso é a mesma de ProvisaoViaRedis
+    _gravar = ProvisaoViaRedis._gravar
+    _expiracao = ProvisaoViaRedis._expiracao
+    _incluir_leituras = ProvisaoViaRedis._incluir_leituras
+
+    # assim como o versionamento das chaves
+    versao = ProvisaoViaRedis.versao
+    _chave = ProvisaoViaRedis._chave
+    _chave_anterior = ProvisaoViaRedis._chave_anterior
+    ao_mudar_versao = ProvisaoViaRedis.ao_mudar_versao
+    mudar_versao = ProvisaoViaRedis.mudar_versao
+
+
+    async def sincronizar_versao(self):
+        """
+        Versão assíncrona de
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.sincronizar_versao`.
+        """
+        mensagem = await self._cliente().get(VERSAO_TABELA)
+        if mensagem is None:
+            return False
+        return self.mudar_versao(*_interpretar_versao(mensagem))
+
+
+    def _cliente(self):
+        if self._redis is None:
+            if aioredis is None:
+                raise RuntimeError('ProvisaoViaRedisAssincrona requer '
+                        'redis-py 4.2 ou superior (redis.asyncio)')
+            self._redis = aioredis.Redis(**self._kwargs)
+        return self._redis
+
+
+    async def _get(self, metodo, classe_entidade, chave, *args):
+        instrumentacao = conf.instrumentacao
+        if instrumentacao is not None:
+            inicio = relogio()
+        dados = (await self._ler_chaves([chave]))[0]
+        if instrumentacao is not None:
+            instrumentacao.registrar_provisao(self, relogio() - inicio,
+                    acertos=int(dados is not None),
+                    falhas=int(dados is None))
+        if dados is not None:
+            return self._codec.decodificar(classe_entidade, dados)
+
+        # apenas uma das tarefas que solicitarem a mesma chave ao mesmo tempo
+        # irá provisioná-la; as demais aguardam pelo mesmo resultado
+        em_andamento = (id(asyncio.get_running_loop()), chave)
+        tarefa = self._em_andamento.get(em_andamento)
+        if tarefa is None:
+            tarefa = asyncio.ensure_future(self._provisionar(
+                    metodo, classe_entidade, chave, args))
+            self._em_andamento[em_andamento] = tarefa
+            tarefa.add_done_callback(
+                    lambda t: self._em_andamento.pop(em_andamento, None))
+        return await asyncio.shield(tarefa)
+
+
+    async def _provisionar(self, metodo, classe_entidade, chave, args):
+        redis = self._cliente()
+        trava = 'trava:{}'.format(chave)
+        token = uuid.uuid4().hex
+        adquirida = False
+
+        if self._trava_expira:
+            adquirida = await redis.set(trava, token, nx=True,
+                    px=int(self._trava_expira * 1000))
+            if not adquirida:
+                # outro processo está consultando o web services por essa
+                # mesma chave; aguarda que ela seja provisionada
+                entidade = await self._aguardar(classe_entidade, chave)
+                if entidade is not None:
+                    return entidade
+
+        try:
+            try:
+                entidade = await metodo(*args)
+            except ErroNaoEncontrado as ex:
+                await self._gravar_lote({chave: ex})
+                raise
+            await self._gravar_lote({chave: entidade})
+        finally:
+            if adquirida:
+                if _str(await redis.get(trava) or '') == token:
+                    await redis.delete(trava)
+
+        return entidade
+
+
+    async def _aguardar(self, classe_entidade, chave):
+        redis = self._cliente()
+        trava = 'trava:{}'.format(chave)
+        limite = time.time() + self._trava_expira
+        while time.time() < limite:
+            await asyncio.sleep(self._trava_intervalo)
+            dados = (await _ler(redis, self._codec, [chave]))[0]
+            if dados is not None:
+                return self._codec.decodificar(classe_entidade, dados)
+            if not await redis.exists(trava):
+                break
+        return None
+
+
+    async def _ler_chaves(self, chaves):
+        # lê as chaves e, durante a transição entre versões, lê da versão
+        # anterior as que ainda não foram provisionadas na versão atual
+        # (veja ProvisaoViaRedis._ler)
+        todos_dados = await _ler(self._cliente(), self._codec, chaves)
+        await self._registrar_leituras(chaves, todos_dados)
+        if self._transicao is None:
+            return todos_dados
+        anteriores = OrderedDict()
+        for i, (chave, dados) in enumerate(zip(chaves, todos_dados)):
+            if dados is None:
+                anterior = self._chave_anterior(chave)
+                if anterior is not None:
+                    anteriores[i] = anterior
+        if anteriores:
+            for i, dados in zip(anteriores, await _ler(self._cliente(),
+                    self._codec, list(anteriores.values()))):
+                todos_dados[i] = dados
+        return todos_dados
+
+
+    async def _registrar_leituras(self, chaves, todos_dados):
+        # veja ProvisaoViaRedis._registrar_leituras
+        lidas = [chave for chave, dados in zip(chaves, todos_dados)
+                if dados is not None]
+        if not self._indexar_expiracoes or not lidas:
+            return
+        async with self._cliente().pipeline(transaction=False) as pipe:
+            self._incluir_leituras(pipe, lidas)
+            await pipe.execute()
+
+
+    async def _gravar_lote(self, itens):
+        async with self._cliente().pipeline(transaction=False) as pipe:
+            for chave, valor in itens.items():
+                self._gravar(pipe, chave, valor)
+            await pipe.execute()
+
+
+    async def get_produto(self, ncm, ncm_ex):
+        """
+        Versão assíncrona de
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.get_produto`.
+        """
+        chave = self._chave('ncm:{}:{}'.format(ncm, ncm_ex))
+        return await self._get(get_produto_async, Produto, chave,
+                ncm, ncm_ex)
+
+
+    async def get_servico(self, nbs):
+        """
+        Versão assíncrona de
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.get_servico`.
+        """
+        chave = self._chave('nbs:{}'.format(nbs))
+        return await self._get(get_servico_async, Servico, chave, nbs)
+
+
+    async def _get_lote(self, metodo, classe_entidade, chaves_redis):
+        # lê todas as chaves em uma única ida e volta, obtém as faltantes do
+        # web services e as provisiona em uma segunda ida e volta
+        instrumentacao = conf.instrumentacao
+        if instrumentacao is not None:
+            inicio = relogio()
+        todos_dados = await self._ler_chaves(list(chaves_redis.values()))
+        if instrumentacao is not None:
+            faltantes = todos_dados.count(None)
+            instrumentacao.registrar_provisao(self, relogio() - inicio,
+                    acertos=len(todos_dados) - faltantes, falhas=faltantes)
+
+        resultados = OrderedDict()
+        faltantes = []
+        for chave, dados in zip(chaves_redis, todos_dados):
+            if dados is not None:
+                try:
+                    resultados[chave] = self._codec.decodificar(
+                            classe_entidade, dados)
+                except ErroNaoEncontrado as ex:
+                    resultados[chave] = ex
+            else:
+                resultados[chave] = None
+                faltantes.append(chave)
+
+        if not faltantes:
+            return resultados
+
+        itens = OrderedDict()
+        for chave, valor in (await _consultar_em_lote(
+                metodo, faltantes)).items():
+            resultados[chave] = valor
+            if isinstance(valor, ErroNaoEncontrado) or \
+                    not isinstance(valor, Exception):
+                itens[chaves_redis[chave]] = valor
+        await self._gravar_lote(itens)
+
+        return resultados
+
+
+    async def get_produtos(self, chaves):
+        """
+        Versão assíncrona de
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.get_produtos`.
+        """
+        chaves_redis = OrderedDict(
+                ((ncm, ncm_ex), self._chave('ncm:{}:{}'.format(ncm, ncm_ex)))
+                for ncm, ncm_ex in chaves_de_produtos(chaves))
+        return await self._get_lote(get_produto_async, Produto, chaves_redis)
+
+
+    async def get_servicos(self, codigos):
+        """
+        Versão assíncrona de
+        :meth:`~ibptws.provisoes.ProvisaoViaRedis.get_servicos`.
+        """
+        chaves_redis = OrderedDict(
+                (nbs, self._chave('nbs:{}'.format(nbs)))
+                for nbs in unicos(codigos))
+        return await self._get_lote(get_servico_async, Servico, chaves_redis)
+
+
+    async def fechar(self):
+        """Encerra as conexões com o servidor Redis."""
+        if self._redis is not None:
+            # redis-py 5.0.1+ prefere aclose()
+            fechar = getattr(self._redis, 'aclose', None) or self._redis.close
+            await fechar()
@@ -17,8 +17,13 @@
 # limitations under the License.
 #
 
+import multiprocessing
+
+from collections import deque
+from collections import namedtuple
 from decimal import Decimal
 
+from .lotes import _chave_de_produto
 from .provisoes import SemProvisao
 
 
@@ -26,6 +31,88 @@ ZERO = Decimal('0')
 CEM = Decimal('100')
 
 
+ItemCalculado = namedtuple('ItemCalculado', 'codigo valor federal_nacional '
+        'federal_importado estadual municipal')
+"""
+Detalhamento dos valores aproximados dos tributos de um produto ou serviço
+acumulado por :class:`DeOlhoNoImposto`, quando criada com
+``detalhar=True``. O atributo ``codigo`` é a tupla ``(ncm, ncm_ex)`` para
+produtos ou o código NBS para serviços; ``municipal`` é ``None`` para
+produtos.
+
+.. versionadded:: 0.5
+"""
+
+_Resultado = namedtuple('_Resultado', 'federal_nacional federal_importado '
+        'estadual municipal total')
+
+
+class Resultado(_Resultado):
+    """
+    Valores aproximados dos tributos em cada esfera e soma dos subtotais
+    acumulados por uma :class:`DeOlhoNoImposto` (veja
+    :meth:`DeOlhoNoImposto.resultado`) ou calculados por
+    :func:`calcular_cupons`.
+
+    Ao contrário da calculadora, um resultado não mantém o provisionamento,
+    é imutável e pode ser serializado com ``pickle`` a baixo custo. Os
+    resultados parciais (por loja e por hora, por exemplo) podem ser
+    combinados com :meth:`mesclar` em qualquer ordem e agrupamento, como em
+    uma etapa de redução:
+
+    .. sourcecode:: python
+
+        >>> from functools import reduce
+        >>> a = Resultado(Decimal('0.21'), Decimal('0.24'), Decimal('0.9'),
+        ...         ZERO, Decimal('5.00'))
+        >>> b = Resultado(Decimal('13.45'), Decimal('14.05'), ZERO,
+        ...         Decimal('4.33'), Decimal('100'))
+        >>> reduce(Resultado.mesclar, [a, b], Resultado.vazio()).total
+        Decimal('105.00')
+
+    A soma de ``Decimal`` é exata (e, portanto, associativa) enquanto os
+    totais não excederem a precisão do contexto decimal (28 dígitos).
+
+    .. versionadded:: 0.5
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def vazio(cls):
+        """Retorna um resultado sem produtos nem serviços, o elemento
+        neutro de :meth:`mesclar`."""
+        return cls(ZERO, ZERO, ZERO, ZERO, ZERO)
+
+
+    def mesclar(self, outro):
+        """
+        Retorna um novo resultado que combina este resultado e ``outro``,
+        como se os produtos e serviços de ambos tivessem sido acumulados
+        por uma mesma calculadora.
+
+        :rtype: Resultado
+        """
+        return Resultado(*[a + b for a, b in zip(self, outro)])
+
+
+    def carga_federal(self):
+        """Veja :meth:`DeOlhoNoImposto.carga_federal`."""
+        return self.federal_nacional + self.federal_importado
+
+
+    def total_tributos(self):
+        """Veja :meth:`DeOlhoNoImposto.total_tributos`."""
+        return sum([self.carga_federal(), self.estadual, self.municipal])
+
+
+    def percentual_sobre_total(self):
+        """Veja :meth:`DeOlhoNoImposto.percentual_sobre_total`."""
+        if self.total.is_zero():
+            return ZERO
+        return self.total_tributos() / self.total
+
+
 class DeOlhoNoImposto(object):
     """
     Implementa uma calculadora para a Lei 12.741/2012. O propósito é acumular
@@ -48,28 +135,85 @@ class DeOlhoNoImposto(object):
         >>> calculadora.total_tributos()        # doctest: +SKIP
         Decimal('15.20')
         
+    Os valores de cada esfera são acumulados à medida que os produtos e
+    serviços são informados, de modo que a memória utilizada e o custo de
+    obter os totais não dependem do número de itens. Os totais são
+    exatamente os mesmos que seriam obtidos somando os valores de todos os
+    itens, na ordem em que foram informados. Para manter também os valores
+    de cada item, crie a calculadora com ``detalhar=True`` (veja
+    :meth:`itens`).
+
     .. versionadded:: 0.3
         
     """
     
-    def __init__(self, provisao=None):
-        self._fed_nacionais = []
-        self._fed_importados = []
-        self._estaduais = []
-        self._municipais = []
-        self._total = ZERO
+    def __init__(self, provisao=None, detalhar=False):
+        """
+        Inicia uma instância de :class:`DeOlhoNoImposto`.
+
+        :param provisao: **Opcional** O provisionamento das consultas.
+            Padrão é :class:`~ibptws.provisoes.SemProvisao`.
+
+        :param bool detalhar: Se ``True``, mantém os valores aproximados dos
+            tributos de cada item acumulado (veja :meth:`itens`).
+
+        .. versionchanged:: 0.5
+            Argumento ``detalhar``.
+        """
         self._provisao = provisao or SemProvisao()
+        self._detalhar = detalhar
+        self.reiniciar()
         
     
     def reiniciar(self):
         """
         Reinicia a calculadora, zerando os produtos e serviços acumulados.
         """
-        self._fed_nacionais[:] = []
-        self._fed_importados[:] = []
-        self._estaduais[:] = []
-        self._municipais[:] = []
+        # os acumuladores iniciam em ZERO, assim como sum() inicia em 0,
+        # portanto a sequência de adições é exatamente a mesma de somar os
+        # valores de todos os itens
+        self._fed_nacional = ZERO
+        self._fed_importado = ZERO
+        self._estadual = ZERO
+        self._municipal = ZERO
         self._total = ZERO
+        self._itens = [] if self._detalhar else None
+
+
+    def itens(self):
+        """
+        Retorna o detalhamento dos produtos e serviços acumulados, na ordem
+        em que foram informados. Disponível apenas se a calculadora tiver
+        sido criada com ``detalhar=True``.
+
+        :rtype: list[ItemCalculado]
+
+        :raises RuntimeError: se a calculadora não mantém o detalhamento.
+
+        .. versionadded:: 0.5
+        """
+        if self._itens is None:
+            raise RuntimeError('Calculadora criada sem detalhamento dos '
+                    'itens (informe detalhar=True)')
+        return list(self._itens)
+
+
+    def resultado(self):
+        """
+        Retorna os valores acumulados até o momento como um
+        :class:`Resultado`, que pode ser serializado e combinado com outros
+        resultados.
+
+        :rtype: Resultado
+
+        .. versionadded:: 0.5
+        """
+        return Resultado(
+                federal_nacional=self._fed_nacional,
+                federal_importado=self._fed_importado,
+                estadual=self._estadual,
+                municipal=self._municipal,
+                total=self._total)
         
         
     def produto(self, ncm, ncm_ex, valor):
@@ -84,10 +228,48 @@ class DeOlhoNoImposto(object):
         
         """
         p = self._provisao.get_produto(ncm, ncm_ex)
-        self._fed_nacionais.append(valor * (p.aliquota_nacional / CEM))
-        self._fed_importados.append(valor * (p.aliquota_importado / CEM))
-        self._estaduais.append(valor * (p.aliquota_estadual / CEM))
+        self._acumular_produto((ncm, ncm_ex), p, valor)
+        
+    
+    def produtos(self, itens):
+        """
+        Acumula os valores aproximados dos tributos de vários produtos de uma
+        só vez, obtendo as alíquotas de todos eles do provisionamento em uma
+        única operação (veja :meth:`ProvisaoBase.get_produtos
+        <ibptws.provisoes.ProvisaoBase.get_produtos>`).
+        
+        Se as alíquotas de algum dos produtos não puderem ser obtidas, a
+        exceção correspondente ao primeiro deles será lançada e nenhum dos
+        produtos será acumulado.
+        
+        :param itens: Iterável de tuplas ``(ncm, ncm_ex, valor)``, com os
+            mesmos argumentos de :meth:`produto`.
+        
+        .. versionadded:: 0.5
+        """
+        itens = list(itens)
+        produtos = self._provisao.get_produtos(
+                (ncm, ncm_ex) for ncm, ncm_ex, valor in itens)
+        for ncm, ncm_ex, valor in itens:
+            produto = produtos[_chave_de_produto((ncm, ncm_ex))]
+            if isinstance(produto, Exception):
+                raise produto
+        for ncm, ncm_ex, valor in itens:
+            self._acumular_produto((ncm, ncm_ex),
+                    produtos[_chave_de_produto((ncm, ncm_ex))], valor)
+        
+    
+    def _acumular_produto(self, codigo, p, valor):
+        fed_nacional = valor * (p.aliquota_nacional / CEM)
+        fed_importado = valor * (p.aliquota_importado / CEM)
+        estadual = valor * (p.aliquota_estadual / CEM)
+        self._fed_nacional += fed_nacional
+        self._fed_importado += fed_importado
+        self._estadual += estadual
         self._total += valor
+        if self._itens is not None:
+            self._itens.append(ItemCalculado(codigo, valor,
+                    fed_nacional, fed_importado, estadual, None))
         
     
     def servico(self, nbs, valor):
@@ -100,11 +282,41 @@ class DeOlhoNoImposto(object):
         
         """
         s = self._provisao.get_servico(nbs)
-        self._fed_nacionais.append(valor * (s.aliquota_nacional / CEM))
-        self._fed_importados.append(valor * (s.aliquota_importado / CEM))
-        self._estaduais.append(valor * (s.aliquota_estadual / CEM))
-        self._municipais.append(valor * (s.aliquota_municipal / CEM))
+        self._acumular_servico(nbs, s, valor)
+        
+    
+    def servicos(self, itens):
+        """
+        Acumula os valores aproximados dos tributos de vários serviços de uma
+        só vez. Veja :meth:`produtos`.
+        
+        :param itens: Iterável de tuplas ``(nbs, valor)``, com os mesmos
+            argumentos de :meth:`servico`.
+        
+        .. versionadded:: 0.5
+        """
+        itens = list(itens)
+        servicos = self._provisao.get_servicos(nbs for nbs, valor in itens)
+        for nbs, valor in itens:
+            if isinstance(servicos[nbs], Exception):
+                raise servicos[nbs]
+        for nbs, valor in itens:
+            self._acumular_servico(nbs, servicos[nbs], valor)
+        
+    
+    def _acumular_servico(self, codigo, s, valor):
+        fed_nacional = valor * (s.aliquota_nacional / CEM)
+        fed_importado = valor * (s.aliquota_importado / CEM)
+        estadual = valor * (s.aliquota_estadual / CEM)
+        municipal = valor * (s.aliquota_municipal / CEM)
+        self._fed_nacional += fed_nacional
+        self._fed_importado += fed_importado
+        self._estadual += estadual
+        self._municipal += municipal
         self._total += valor
+        if self._itens is not None:
+            self._itens.append(ItemCalculado(codigo, valor,
+                    fed_nacional, fed_importado, estadual, municipal))
         
         
     def carga_federal(self):
@@ -124,7 +336,7 @@ class DeOlhoNoImposto(object):
         
         :rtype: decimal.Decimal
         """
-        return sum(self._fed_nacionais or [ZERO,])
+        return self._fed_nacional
         
     
     def carga_federal_importado(self):
@@ -134,7 +346,7 @@ class DeOlhoNoImposto(object):
         
         :rtype: decimal.Decimal
         """
-        return sum(self._fed_importados or [ZERO,])
+        return self._fed_importado
         
     
     def carga_estadual(self):
@@ -142,7 +354,7 @@ class DeOlhoNoImposto(object):
         Retorna o valor aproximado dos tributos na esfera estadual.
         :rtype: decimal.Decimal
         """
-        return sum(self._estaduais or [ZERO,])
+        return self._estadual
         
     
     def carga_municipal(self):
@@ -150,7 +362,7 @@ class DeOlhoNoImposto(object):
         Retorna o valor aproximado dos tributos na esfera municipal.
         :rtype: decimal.Decimal
         """
-        return sum(self._municipais or [ZERO,])
+        return self._municipal
         
     
     def total_tributos(self):
@@ -183,3 +395,103 @@ class DeOlhoNoImposto(object):
         if self.total().is_zero():
             return ZERO
         return self.total_tributos() / self.total()
+
+
+def calcular_cupons(cupons, fabrica_provisao=None, max_workers=None,
+        chunksize=100):
+    """
+    Calcula os valores aproximados dos tributos de muitos cupons,
+    distribuindo-os entre um *pool* de processos, de modo que o cálculo
+    escala com o número de núcleos. Os cupons são enviados aos processos em
+    blocos de ``chunksize`` cupons e os resultados são devolvidos à medida
+    que ficam prontos, na mesma ordem dos cupons. Apenas alguns blocos por
+    processo são mantidos em andamento, de modo que ``cupons`` pode ser um
+    gerador arbitrariamente longo.
+
+    Cada processo cria, uma única vez, o seu próprio provisionamento,
+    invocando ``fabrica_provisao``, que é então reaproveitado (e, portanto,
+    mantido "aquecido") em todos os cupons calculados por aquele processo:
+
+    .. sourcecode:: python
+
+        >>> from functools import partial
+        >>> from ibptws.provisoes import ProvisaoViaRedis
+        >>> for resultado in calcular_cupons(cupons,
+        ...         fabrica_provisao=partial(ProvisaoViaRedis, host='redis'),
+        ...         max_workers=8):  # doctest: +SKIP
+        ...     print(resultado.total)
+
+    :param cupons: Iterável de cupons. Cada cupom é uma sequência de itens,
+        que são tuplas ``(ncm, ncm_ex, valor)``, para produtos, ou
+        ``(nbs, valor)``, para serviços, acumulados na ordem em que
+        aparecem (veja :meth:`DeOlhoNoImposto.produto` e
+        :meth:`DeOlhoNoImposto.servico`).
+
+    :param fabrica_provisao: **Opcional** Função, sem argumentos, que cria o
+        provisionamento de cada processo. Deve poder ser serializada com
+        ``pickle`` (uma função ou classe definida no nível de um módulo, ou
+        um ``functools.partial`` delas). Se não for informada, será
+        utilizada :class:`~ibptws.provisoes.SemProvisao`.
+
+    :param int max_workers: Número de processos. Padrão é o número de
+        núcleos da máquina.
+
+    :param int chunksize: Número de cupons enviados a um processo de cada
+        vez. Blocos maiores reduzem o custo de comunicação entre processos;
+        blocos menores equilibram melhor a carga.
+
+    :return: Um gerador que produz, para cada cupom, um :class:`Resultado`
+        ou, se o cálculo daquele cupom falhar, a exceção lançada (por
+        exemplo, :class:`~ibptws.excecoes.ErroProdutoNaoEncontrado`). Uma
+        falha em um cupom não interrompe os demais.
+    """
+    max_workers = max_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(max_workers, _iniciar_processo,
+            (fabrica_provisao,))
+    try:
+        em_andamento = deque()
+        cupons = iter(cupons)
+        while True:
+            while len(em_andamento) < 2 * max_workers:
+                bloco = [cupom for _, cupom in zip(range(chunksize), cupons)]
+                if not bloco:
+                    break
+                em_andamento.append(pool.apply_async(_calcular_bloco,
+                        (bloco,)))
+            if not em_andamento:
+                break
+            for resultado in em_andamento.popleft().get():
+                yield resultado
+        pool.close()
+    finally:
+        # se o gerador for descartado antes do fim, os processos são
+        # encerrados sem aguardar os blocos ainda em andamento
+        pool.terminate()
+        pool.join()
+
+
+# provisionamento do processo do pool, criado por _iniciar_processo
+_provisao_do_processo = None
+
+
+def _iniciar_processo(fabrica_provisao):
+    global _provisao_do_processo
+    _provisao_do_processo = (fabrica_provisao or SemProvisao)()
+
+
+def _calcular_bloco(cupons):
+    calculadora = DeOlhoNoImposto(provisao=_provisao_do_processo)
+    resultados = []
+    for cupom in cupons:
+        calculadora.reiniciar()
+        try:
+            for item in cupom:
+                if len(item) == 3:
+                    calculadora.produto(*item)
+                else:
+                    calculadora.servico(*item)
+        except Exception as ex:
+            resultados.append(ex)
+            continue
+        resultados.append(calculadora.resultado())
+    return resultados
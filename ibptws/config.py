@@ -17,6 +17,9 @@
 # limitations under the License.
 #
 
+from .transportes import TransporteHTTP
+
+
 class Endpoint(object):
 
     def __init__(self):
@@ -44,5 +47,25 @@ class Configuracoes(object):
         self.estado = ''
         """Sigla do Estado (unidade federativa) do domicílio do :attr:`cnpj`."""
 
+        self.transporte = TransporteHTTP()
+        """Transporte HTTP utilizado nas consultas aos web services. Por padrão
+        é um :class:`~ibptws.transportes.TransporteHTTP`, que mantém um *pool*
+        de conexões persistentes. Atribua qualquer implementação de
+        :class:`~ibptws.transportes.TransporteBase` para substituí-lo."""
+
+        self.transporte_assincrono = None
+        """Transporte HTTP utilizado nas consultas assíncronas (veja
+        :mod:`ibptws.assincrono`). Se não for atribuído, será criado um
+        :class:`~ibptws.assincrono.TransporteAIOHTTP` na primeira consulta."""
+
+        self.consultas_simultaneas = 8
+        """Número máximo de consultas simultâneas realizadas pelas consultas
+        em lote, como :func:`~ibptws.produtos.get_produtos`."""
+
+        self.instrumentacao = None
+        """Instrumentação das consultas ao web services e dos
+        provisionamentos (veja :mod:`ibptws.instrumentacao`). Se ``None``,
+        não há instrumentação."""
+
 
 conf = Configuracoes()
@@ -38,3 +38,11 @@ class ErroServicoNaoEncontrado(ErroNaoEncontrado):
     """Lançado quando a consulta de Serviços não for capaz de localizar o
     serviço solicitado, resultando em um erro HTTP 404 na consulta.
     """
+
+
+class ErroServicoIndisponivel(Exception):
+    """Lançado quando o web services do IBPT for considerado indisponível,
+    após sucessivas falhas nas consultas, de modo que novas consultas falhem
+    imediatamente ao invés de aguardar pelo esgotamento do tempo limite.
+    Veja :class:`~ibptws.transportes.Disjuntor`.
+    """
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/instrumentacao.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Instrumentação das consultas ao web services do IBPT e dos provisionamentos.
+Por padrão não há instrumentação (:attr:`Configuracoes.instrumentacao` é
+``None``) e o custo é apenas o de verificar essa configuração. Para
+instrumentar, atribua uma implementação de :class:`Instrumentacao`:
+
+.. sourcecode:: python
+
+    >>> from ibptws import conf
+    >>> from ibptws.instrumentacao import InstrumentacaoEmMemoria
+    >>> conf.instrumentacao = InstrumentacaoEmMemoria()  # doctest: +SKIP
+
+São registrados os seguintes contadores e histogramas:
+
+* ``provisao_acertos`` e ``provisao_falhas``: consultas atendidas e não
+  atendidas pelo provisionamento (rótulo ``provisao``);
+* ``provisao_latencia``: tempo de leitura do provisionamento, em segundos
+  (rótulo ``provisao``);
+* ``webservice_consultas``: consultas ao web services (rótulo ``recurso``,
+  ``produtos`` ou ``servicos``);
+* ``webservice_erros``: consultas ao web services que falharam (rótulos
+  ``recurso`` e ``erro``, o nome da classe da exceção, como
+  ``ErroProdutoNaoEncontrado`` ou ``ErroIdentificacao``);
+* ``webservice_latencia``: tempo das consultas ao web services, em segundos
+  (rótulo ``recurso``).
+
+.. versionadded:: 0.5
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+
+relogio = getattr(time, 'perf_counter', time.time)
+"""Relógio utilizado para medir as latências."""
+
+LIMITES_PADRAO = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1, 2.5, 5, 10,)
+"""Limites superiores, em segundos, das faixas dos histogramas."""
+
+
+class Instrumentacao(object):
+    """
+    Classe base para as instrumentações. Uma implementação mínima deverá
+    sobrescrever os métodos :meth:`contar` e :meth:`medir`.
+    """
+
+    def contar(self, nome, valor=1, **rotulos):
+        """Incrementa um contador."""
+        raise NotImplementedError()
+
+
+    def medir(self, nome, segundos, **rotulos):
+        """Registra uma observação em um histograma de latências."""
+        raise NotImplementedError()
+
+
+    def registrar_provisao(self, provisao, segundos, acertos=0, falhas=0):
+        """
+        Registra uma leitura do provisionamento, que atendeu ``acertos``
+        consultas e não atendeu ``falhas`` consultas.
+
+        :param provisao: A instância do provisionamento.
+        """
+        nome = type(provisao).__name__
+        if acertos:
+            self.contar('provisao_acertos', acertos, provisao=nome)
+        if falhas:
+            self.contar('provisao_falhas', falhas, provisao=nome)
+        self.medir('provisao_latencia', segundos, provisao=nome)
+
+
+    def registrar_consulta(self, recurso, segundos, erro=None):
+        """
+        Registra uma consulta ao web services.
+
+        :param str recurso: ``produtos`` ou ``servicos``.
+        :param erro: A exceção lançada pela consulta, se houver.
+        """
+        self.contar('webservice_consultas', recurso=recurso)
+        if erro is not None:
+            self.contar('webservice_erros', recurso=recurso,
+                    erro=type(erro).__name__)
+        self.medir('webservice_latencia', segundos, recurso=recurso)
+
+
+    def consulta(self, recurso, funcao, *args):
+        """Executa e registra uma consulta ao web services."""
+        inicio = relogio()
+        erro = None
+        try:
+            return funcao(*args)
+        except Exception as ex:
+            erro = ex
+            raise
+        finally:
+            self.registrar_consulta(recurso, relogio() - inicio, erro)
+
+
+class InstrumentacaoCallback(Instrumentacao):
+    """
+    Repassa cada registro para uma função, que recebe o tipo (``contador``
+    ou ``histograma``), o nome, o valor e um dicionário com os rótulos.
+
+    .. sourcecode:: python
+
+        >>> registros = []
+        >>> instrumentacao = InstrumentacaoCallback(
+        ...         lambda *args: registros.append(args))
+        >>> instrumentacao.contar('webservice_consultas', recurso='produtos')
+        >>> registros
+        [('contador', 'webservice_consultas', 1, {'recurso': 'produtos'})]
+
+    """
+
+    def __init__(self, funcao):
+        self.funcao = funcao
+
+
+    def contar(self, nome, valor=1, **rotulos):
+        self.funcao('contador', nome, valor, rotulos)
+
+
+    def medir(self, nome, segundos, **rotulos):
+        self.funcao('histograma', nome, segundos, rotulos)
+
+
+class InstrumentacaoLogging(Instrumentacao):
+    """
+    Registra cada contador e cada latência em um *logger*.
+    """
+
+    def __init__(self, logger=None, nivel=logging.DEBUG):
+        self.logger = logger or logging.getLogger('ibptws')
+        self.nivel = nivel
+
+
+    def contar(self, nome, valor=1, **rotulos):
+        if self.logger.isEnabledFor(self.nivel):
+            self.logger.log(self.nivel, '%s +%s %s', nome, valor,
+                    _formatar_rotulos(rotulos))
+
+
+    def medir(self, nome, segundos, **rotulos):
+        if self.logger.isEnabledFor(self.nivel):
+            self.logger.log(self.nivel, '%s %.6fs %s', nome, segundos,
+                    _formatar_rotulos(rotulos))
+
+
+class InstrumentacaoEmMemoria(Instrumentacao):
+    """
+    Mantém os contadores e os histogramas em memória, ao estilo de um
+    registro Prometheus, para serem consultados ou exportados no formato de
+    texto do Prometheus por :meth:`exportar`.
+
+    .. sourcecode:: python
+
+        >>> instrumentacao = InstrumentacaoEmMemoria()
+        >>> instrumentacao.contar('provisao_acertos', 3, provisao='Redis')
+        >>> instrumentacao.contador('provisao_acertos', provisao='Redis')
+        3
+
+    """
+
+    def __init__(self, limites=LIMITES_PADRAO, prefixo='ibptws_'):
+        self.limites = tuple(limites)
+        self.prefixo = prefixo
+        self._lock = threading.Lock()
+        self._contadores = OrderedDict()
+        self._histogramas = OrderedDict()
+
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+
+    def medir(self, nome, segundos, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        faixa = bisect.bisect_left(self.limites, segundos)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = \
+                        [[0] * (len(self.limites) + 1), 0.0]
+            histograma[0][faixa] += 1
+            histograma[1] += segundos
+
+
+    def contador(self, nome, **rotulos):
+        """Retorna o valor de um contador."""
+        with self._lock:
+            return self._contadores.get(
+                    (nome, tuple(sorted(rotulos.items()))), 0)
+
+
+    def histograma(self, nome, **rotulos):
+        """
+        Retorna um histograma de latências.
+
+        :return: Uma tupla com a lista do número de observações em cada
+            faixa (a última faixa não tem limite superior), a soma e o número
+            total de observações.
+        """
+        with self._lock:
+            histograma = self._histogramas.get(
+                    (nome, tuple(sorted(rotulos.items()))))
+            if histograma is None:
+                return [0] * (len(self.limites) + 1), 0.0, 0
+            return list(histograma[0]), histograma[1], sum(histograma[0])
+
+
+    def limpar(self):
+        """Descarta todos os contadores e histogramas."""
+        with self._lock:
+            self._contadores.clear()
+            self._histogramas.clear()
+
+
+    def exportar(self):
+        """
+        Exporta os contadores e histogramas no formato de texto do
+        Prometheus (*exposition format*).
+
+        :rtype: str
+        """
+        with self._lock:
+            contadores = list(self._contadores.items())
+            histogramas = [(chave, list(faixas), soma)
+                    for chave, (faixas, soma) in self._histogramas.items()]
+
+        familias = OrderedDict()
+        for (nome, rotulos), valor in contadores:
+            ajuda = 'Contador {}.'.format(nome)
+            nome = '{}{}_total'.format(self.prefixo, nome)
+            familias.setdefault((nome, 'counter', ajuda), []).append(
+                    '{}{} {}'.format(nome, _rotulos(rotulos), valor))
+
+        for (nome, rotulos), faixas, soma in histogramas:
+            ajuda = 'Histograma {} (segundos).'.format(nome)
+            nome = '{}{}_seconds'.format(self.prefixo, nome)
+            amostras = familias.setdefault((nome, 'histogram', ajuda), [])
+            acumulado = 0
+            for limite, contagem in zip(self.limites + ('+Inf',), faixas):
+                acumulado += contagem
+                amostras.append('{}_bucket{} {}'.format(nome,
+                        _rotulos(rotulos + (('le', str(limite)),)),
+                        acumulado))
+            amostras.append('{}_sum{} {!r}'.format(
+                    nome, _rotulos(rotulos), soma))
+            amostras.append('{}_count{} {}'.format(
+                    nome, _rotulos(rotulos), acumulado))
+
+        # cada família (nome da métrica) é escrita num único bloco, com as
+        # linhas HELP e TYPE seguidas de todas as suas amostras rotuladas
+        linhas = []
+        for (nome, tipo, ajuda), amostras in familias.items():
+            linhas.append('# HELP {} {}'.format(nome, ajuda))
+            linhas.append('# TYPE {} {}'.format(nome, tipo))
+            linhas.extend(amostras)
+
+        return '\n'.join(linhas) + '\n'
+
+
+def _escapar(valor):
+    return '{}'.format(valor).replace('\\', '\\\\') \
+            .replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos(rotulos):
+    if not rotulos:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, _escapar(v))
+            for k, v in rotulos))
+
+
+def _formatar_rotulos(rotulos):
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(rotulos.items()))
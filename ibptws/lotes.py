@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/lotes.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import conf
+
+
+def unicos(chaves):
+    """
+    Retorna uma lista das chaves informadas, sem repetições, preservando a
+    ordem em que cada chave apareceu pela primeira vez.
+
+    .. sourcecode:: python
+
+        >>> unicos([('1234', 0), ('5678', 0), ('1234', 0)])
+        [('1234', 0), ('5678', 0)]
+
+    """
+    return list(OrderedDict.fromkeys(chaves))
+
+
+def chaves_de_produtos(chaves):
+    """
+    Retorna uma lista das chaves de produtos informadas, sem repetições (veja
+    :func:`unicos`), com a exceção da NCM convertida para número inteiro, de
+    modo que ``('02091021', '1')`` e ``('02091021', 1)`` sejam a mesma chave.
+
+    .. sourcecode:: python
+
+        >>> chaves_de_produtos([('02091021', '0'), ('02091021', 0)])
+        [('02091021', 0)]
+
+    :raises TypeError: se alguma chave não for uma tupla ``(ncm, ncm_ex)``,
+        como um código NCM isolado.
+
+    .. versionadded:: 0.5
+    """
+    return unicos(_chave_de_produto(chave) for chave in chaves)
+
+
+def _chave_de_produto(chave):
+    if not isinstance(chave, (tuple, list)) or len(chave) != 2:
+        raise TypeError('Chave de produto deve ser uma tupla (ncm, ncm_ex): '
+                '{!r}'.format(chave))
+    ncm, ncm_ex = chave
+    return (ncm, int(ncm_ex))
+
+
+def consultar_em_lote(funcao, chaves, max_workers=None):
+    """
+    Executa ``funcao`` para cada uma das chaves únicas, em paralelo, em um
+    *pool* de *threads* limitado. Se a chave for uma tupla, seus elementos
+    serão passados como argumentos para ``funcao``.
+
+    Uma falha na consulta de uma chave não interrompe o lote; a exceção
+    lançada é devolvida como o valor correspondente à chave.
+
+    :param funcao: Função de consulta, como
+        :func:`~ibptws.produtos.get_produto`.
+
+    :param chaves: Iterável com as chaves a serem consultadas.
+
+    :param int max_workers: Número máximo de consultas simultâneas. Se não
+        informado, será utilizado :attr:`Configuracoes.consultas_simultaneas`.
+
+    :return: Um dicionário ordenado, cujas chaves são as chaves únicas
+        consultadas e cujos valores são os resultados ou as exceções.
+
+    :rtype: collections.OrderedDict
+    """
+    chaves = unicos(chaves)
+    resultados = OrderedDict()
+    if not chaves:
+        return resultados
+
+    def consultar(chave):
+        argumentos = chave if isinstance(chave, tuple) else (chave,)
+        try:
+            return funcao(*argumentos)
+        except Exception as ex:
+            return ex
+
+    max_workers = max_workers or conf.consultas_simultaneas
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chaves))) as pool:
+        for chave, resultado in zip(chaves, pool.map(consultar, chaves)):
+            resultados[chave] = resultado
+
+    return resultados
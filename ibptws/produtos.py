@@ -25,6 +25,8 @@ import requests
 from .config import conf
 from .excecoes import ErroIdentificacao
 from .excecoes import ErroProdutoNaoEncontrado
+from .lotes import chaves_de_produtos
+from .lotes import consultar_em_lote
 
 
 _Produto = namedtuple('_Produto',
@@ -81,10 +83,57 @@ def get_produto(codigo_ncm, excecao=0):
         expirado ou não estiverem corretos.
     """
 
-    response = requests.get(conf.endpoint.produtos, params=dict(
-            token=conf.token, cnpj=conf.cnpj, uf=conf.estado,
-            codigo=codigo_ncm, ex=excecao))
+    instrumentacao = conf.instrumentacao
+    if instrumentacao is not None:
+        return instrumentacao.consulta('produtos', _consultar,
+                codigo_ncm, excecao)
+    return _consultar(codigo_ncm, excecao)
 
+
+def get_produtos(chaves, max_workers=None):
+    """Consulta vários produtos de uma só vez. As chaves repetidas são
+    consultadas apenas uma vez e as consultas são feitas em paralelo.
+
+    .. sourcecode:: python
+
+        >>> produtos = get_produtos([('02091021', 0), ('22030000', 0)])  # doctest: +SKIP
+        >>> produtos[('02091021', 0)].nacional  # doctest: +SKIP
+        4.2
+
+    :param chaves: Iterável de tuplas ``(codigo_ncm, excecao)``. A exceção é
+        convertida para número inteiro (veja
+        :func:`~ibptws.lotes.chaves_de_produtos`).
+
+    :param int max_workers: **Opcional** Número máximo de consultas
+        simultâneas (veja :attr:`Configuracoes.consultas_simultaneas`).
+
+    :return: Dicionário ordenado cujas chaves são as tuplas ``(codigo_ncm,
+        excecao)`` e cujos valores são instâncias de :class:`Produto` ou, se
+        a consulta daquela chave falhar, a exceção lançada (por exemplo,
+        :class:`~ibptws.excecoes.ErroProdutoNaoEncontrado`).
+
+    :rtype: collections.OrderedDict
+
+    .. versionadded:: 0.5
+    """
+    return consultar_em_lote(get_produto, chaves_de_produtos(chaves),
+            max_workers=max_workers)
+
+
+def _consultar(codigo_ncm, excecao):
+    response = conf.transporte.get(conf.endpoint.produtos,
+            params=_parametros(codigo_ncm, excecao))
+    return _produto_da_resposta(response, codigo_ncm, excecao)
+
+
+def _parametros(codigo_ncm, excecao):
+    return dict(token=conf.token, cnpj=conf.cnpj, uf=conf.estado,
+            codigo=codigo_ncm, ex=excecao)
+
+
+def _produto_da_resposta(response, codigo_ncm, excecao):
+    # interpreta a resposta do web services; compartilhado entre as
+    # consultas síncronas e assíncronas (veja ibptws.assincrono)
     if response.status_code == requests.codes.ok:
         data = response.json()
         return Produto(**{k.lower():v for k,v in data.items()})
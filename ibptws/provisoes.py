@@ -17,14 +17,73 @@
 # limitations under the License.
 #
 
+import bisect
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import redis
 
-from .produtos import get_produto, Produto
-from .servicos import get_servico, Servico
+from .excecoes import ErroNaoEncontrado
+from .excecoes import ErroProdutoNaoEncontrado
+from .excecoes import ErroServicoNaoEncontrado
+from .config import conf
+from .instrumentacao import relogio
+from .lotes import _chave_de_produto
+from .lotes import chaves_de_produtos
+from .lotes import unicos
+from .produtos import get_produto, get_produtos, Produto
+from .servicos import get_servico, get_servicos, Servico
 
 
 EXPIRA_EM_24H = 24 * 60 * 60
 
+EXPIRA_EM_1H = 60 * 60
+
+EXPIRA_EM_5MIN = 5 * 60
+
+INDICE_EXPIRACOES = 'expiracoes'
+"""Chave do *sorted set* que indexa as expirações das chaves provisionadas
+por :class:`ProvisaoViaRedis`, quando ``indexar_expiracoes`` for ``True``."""
+
+INDICE_LEITURAS = 'leituras'
+"""Chave do *sorted set* que mantém o momento da última leitura de cada chave
+provisionada por :class:`ProvisaoViaRedis`, quando ``indexar_expiracoes``
+for ``True``. Apenas as chaves lidas desde que foram provisionadas são
+renovadas (veja :meth:`ProvisaoViaRedis.renovar`)."""
+
+NAO_ENCONTRADO = '_nao_encontrado'
+"""Campo que identifica, no provisionamento, um produto ou serviço que o web
+services não encontrou (HTTP 404)."""
+
+VERSAO_TABELA = 'versao_tabela'
+"""Chave que mantém a versão da tabela do IBPT em uso pelos provisionamentos
+:class:`ProvisaoViaRedis`, publicada por
+:meth:`ProvisaoViaRedis.publicar_versao`."""
+
+CANAL_INVALIDACAO = 'ibptws:invalidacao'
+"""Canal *pub/sub* do Redis no qual as mudanças de versão da tabela do IBPT
+são anunciadas (veja :class:`InvalidacaoViaRedis`)."""
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
 
 class ProvisaoBase(object):
     """
@@ -72,6 +131,132 @@ class ProvisaoBase(object):
         """
         raise NotImplementedError()
         
+
+    def get_produtos(self, chaves):
+        """
+        Obtém as alíquotas para vários produtos de uma só vez. Esta
+        implementação simplesmente invoca :meth:`get_produto` para cada uma
+        das chaves únicas. As implementações de provisionamento poderão
+        sobrescrever este método para obter os produtos de maneira mais
+        eficiente, como em uma única ida e volta ao provisionamento.
+
+        :param chaves: Iterável de tuplas ``(ncm, ncm_ex)``. A exceção é
+            convertida para número inteiro (veja
+            :func:`~ibptws.lotes.chaves_de_produtos`).
+
+        :return: Dicionário ordenado cujas chaves são as tuplas
+            ``(ncm, ncm_ex)`` e cujos valores são instâncias de
+            :class:`~ibptws.produtos.Produto` ou a exceção lançada na
+            obtenção daquele produto (veja
+            :func:`~ibptws.produtos.get_produtos`).
+
+        :rtype: collections.OrderedDict
+
+        :raises TypeError: se alguma chave não for uma tupla
+            ``(ncm, ncm_ex)``.
+
+        .. versionadded:: 0.5
+        """
+        return _em_lote(self.get_produto, chaves_de_produtos(chaves))
+
+
+    def get_servicos(self, codigos):
+        """
+        Obtém as alíquotas para vários serviços de uma só vez. Veja
+        :meth:`get_produtos`.
+
+        :param codigos: Iterável de códigos NBS.
+
+        :return: Dicionário ordenado cujas chaves são os códigos NBS e cujos
+            valores são instâncias de :class:`~ibptws.servicos.Servico` ou a
+            exceção lançada na obtenção daquele serviço.
+
+        :rtype: collections.OrderedDict
+
+        .. versionadded:: 0.5
+        """
+        return _em_lote(self.get_servico, unicos(codigos))
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        """
+        Obtém um produto apenas deste provisionamento, sem recorrer ao web
+        services ou a outro provisionamento (veja :class:`ProvisaoEmCamadas`).
+        Esta implementação simplesmente invoca :meth:`get_produto`, o que é
+        adequado aos provisionamentos que sempre têm a resposta, como as
+        tabelas do IBPT ou o próprio web services. Os provisionamentos que
+        funcionam como *cache* deverão sobrescrever este método.
+
+        :return: O produto ou ``None``, se não estiver provisionado.
+
+        :raises ErroProdutoNaoEncontrado: se estiver provisionado como não
+            encontrado.
+
+        .. versionadded:: 0.5
+        """
+        return self.get_produto(ncm, ncm_ex)
+
+
+    def consultar_servico(self, nbs):
+        """
+        Obtém um serviço apenas deste provisionamento. Veja
+        :meth:`consultar_produto`.
+
+        .. versionadded:: 0.5
+        """
+        return self.get_servico(nbs)
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        """
+        Provisiona um produto obtido de outra fonte (veja
+        :class:`ProvisaoEmCamadas`). Esta implementação não faz nada.
+
+        :param produto: O produto ou uma exceção
+            :class:`~ibptws.excecoes.ErroProdutoNaoEncontrado`, para
+            provisioná-lo como não encontrado.
+
+        .. versionadded:: 0.5
+        """
+        pass
+
+
+    def provisionar_servico(self, nbs, servico):
+        """
+        Provisiona um serviço obtido de outra fonte. Veja
+        :meth:`provisionar_produto`.
+
+        .. versionadded:: 0.5
+        """
+        pass
+
+
+    def _ler_instrumentado(self, ler, *args):
+        # invoca ler(*args), que lê apenas deste provisionamento o item
+        # solicitado (ou None, se não estiver provisionado) ou uma lista de
+        # itens (None para os não provisionados), registrando os acertos, as
+        # falhas e a latência da leitura em conf.instrumentacao; um item
+        # provisionado como não encontrado (ErroNaoEncontrado) é um acerto
+        instrumentacao = conf.instrumentacao
+        if instrumentacao is None:
+            return ler(*args)
+        inicio = relogio()
+        try:
+            valor = ler(*args)
+        except ErroNaoEncontrado:
+            instrumentacao.registrar_provisao(self, relogio() - inicio,
+                    acertos=1)
+            raise
+        if isinstance(valor, list):
+            falhas = valor.count(None)
+            acertos = len(valor) - falhas
+        else:
+            falhas = int(valor is None)
+            acertos = 1 - falhas
+        instrumentacao.registrar_provisao(self, relogio() - inicio,
+                acertos=acertos, falhas=falhas)
+        return valor
+        
         
 class SemProvisao(ProvisaoBase):
     """
@@ -92,109 +277,2778 @@ class SemProvisao(ProvisaoBase):
         return get_servico(nbs)
 
 
-class ProvisaoViaRedis(ProvisaoBase):
+    def get_produtos(self, chaves):
+        return get_produtos(chaves)
+
+
+    def get_servicos(self, codigos):
+        return get_servicos(codigos)
+
+
+class ConsultaUnica(object):
     """
-    Implementa um provisionamento baseado em um servidor `Redis`_.
-    Produtos e serviços solicitados serão obtidos do web services do IBPT e
-    então provisionados, com uma expiração padrão de 24h de modo que, dentro
-    desse prazo, toda solicitação feita para um produto ou serviço provisionados
-    serão obtidos de um servidor Redis, ao invés de acessar o web services.
-    
-    .. versionadded:: 0.3
+    Coalesce consultas simultâneas pela mesma chave (*single-flight*): se
+    várias *threads* solicitarem a mesma chave ao mesmo tempo, apenas a
+    primeira delas executa a consulta, enquanto as demais aguardam e recebem
+    o mesmo resultado (ou a mesma exceção).
+
+    .. sourcecode:: python
+
+        >>> consultas = ConsultaUnica()
+        >>> consultas.executar('ncm:02091021:0', lambda: 'resultado')
+        'resultado'
+
+    .. versionadded:: 0.5
     """
-    
-    def __init__(self, redis=None, expires=EXPIRA_EM_24H, **kwargs):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_andamento = {}
+
+
+    def executar(self, chave, funcao, *args, **kwargs):
         """
-        Inicia uma instância de :class:`ProvisaoViaRedis`.
-        
-        :param redis: Uma instância do servidor Redis. Normalmente, deverá ser
-            uma instância ``redis.StrictRedis``(veja `redis-py`_). Mas poderá
-            ser qualquer implementação que se comporte da mesma maneira. Se
-            este argumento não for informado, será criada uma instância de
-            ``redis.StrictRedis``, cujos argumentos deverão ser os mesmos
-            argumentos esperados pela classe ``StrictRedis``.
-            
-        :param int expires: Especifica o tempo que uma consulta à produto ou
-            serviço deverá durar até que expire, exigindo que seja feita uma
-            nova consulta ao web services. Em segundos. Padrão é 24 horas.
+        Executa ``funcao(*args, **kwargs)``, a menos que já exista uma
+        execução em andamento para ``chave``, caso em que aguarda o término
+        daquela execução e retorna o seu resultado.
+        """
+        with self._lock:
+            consulta = self._em_andamento.get(chave)
+            lider = consulta is None
+            if lider:
+                consulta = self._em_andamento[chave] = _Consulta()
+
+        if not lider:
+            return consulta.aguardar()
+
+        try:
+            consulta.resultado = funcao(*args, **kwargs)
+        except Exception as ex:
+            consulta.erro = ex
+            raise
+        finally:
+            with self._lock:
+                del self._em_andamento[chave]
+            consulta.concluida.set()
+
+        return consulta.resultado
+
+
+class _Consulta(object):
+
+    def __init__(self):
+        self.concluida = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+    def aguardar(self):
+        self.concluida.wait()
+        if self.erro is not None:
+            raise self.erro
+        return self.resultado
+
+
+class RevalidacaoEmSegundoPlano(object):
+    """
+    Executa, em segundo plano, a revalidação de chaves provisionadas que já
+    passaram do prazo de validade, mas que ainda podem ser servidas enquanto
+    são atualizadas (*stale-while-revalidate*). Uma chave já agendada não é
+    agendada novamente até que sua revalidação termine.
+
+    As revalidações são executadas em um *pool* de *threads* criado sob
+    demanda e recriado automaticamente se o processo for bifurcado (*fork*).
+
+    .. versionadded:: 0.5
+    """
 
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pendentes = set()
+        self._executor = None
+        self._pid = None
+
+
+    def agendar(self, chave, funcao, *args, **kwargs):
         """
-        self._redis = redis
+        Agenda a execução de ``funcao(*args, **kwargs)`` para revalidar a
+        ``chave``, a menos que ela já esteja agendada. Exceções lançadas por
+        ``funcao`` são ignoradas.
+
+        :return: ``True`` se a revalidação foi agendada.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # após um fork, as threads do processo pai não existem
+                self._executor = None
+                self._pendentes = set()
+                self._pid = os.getpid()
+            if chave in self._pendentes:
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+            self._pendentes.add(chave)
+            self._executor.submit(self._executar, chave, funcao, args, kwargs)
+        return True
+
+
+    def _executar(self, chave, funcao, args, kwargs):
+        try:
+            funcao(*args, **kwargs)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._pendentes.discard(chave)
+
+
+    def encerrar(self, wait=True):
+        """
+        Encerra o *pool* de *threads*, aguardando o término das revalidações
+        agendadas se ``wait`` for ``True``. Um novo *pool* será criado se
+        outra revalidação for agendada.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait)
+
+
+Estatisticas = namedtuple('Estatisticas', 'acertos falhas despejos tamanho')
+"""Contadores de um provisionamento em memória (veja
+:meth:`ProvisaoEmMemoria.estatisticas`)."""
+
+
+class ProvisaoEmMemoria(ProvisaoBase):
+    """
+    Implementa um provisionamento na memória do próprio processo, que envolve
+    outro provisionamento qualquer. Os produtos e serviços mais recentemente
+    consultados são mantidos em memória até ``tamanho`` itens (os itens menos
+    recentemente consultados são descartados primeiro) e por no máximo
+    ``expires`` segundos. Os demais são obtidos do provisionamento envolvido.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoEmMemoria(ProvisaoViaRedis(), tamanho=512)
+        >>> provisao.estatisticas()
+        Estatisticas(acertos=0, falhas=0, despejos=0, tamanho=0)
+
+    Produtos e serviços não encontrados também são mantidos em memória, de
+    modo que a exceção é lançada novamente até que expirem. É mantida apenas
+    a classe e a mensagem da exceção; cada consulta lança uma nova
+    instância, de modo que os *tracebacks* não se acumulam.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, provisao=None, tamanho=1024, expires=EXPIRA_EM_5MIN):
+        """
+        Inicia uma instância de :class:`ProvisaoEmMemoria`.
+
+        :param provisao: O provisionamento envolvido, do qual serão obtidos
+            os produtos e serviços que não estiverem em memória. Padrão é
+            :class:`SemProvisao`.
+
+        :param int tamanho: Número máximo de produtos e serviços mantidos em
+            memória.
+
+        :param int expires: Tempo, em segundos, que um produto ou serviço
+            permanece em memória. Padrão é 5 minutos.
+        """
+        self._provisao = provisao or SemProvisao()
+        self._tamanho = tamanho
         self._expires = expires
-        self._kwargs = kwargs
-        
-    
-    def _connect(self):
-        self._redis = redis.StrictRedis(**self._kwargs)
-        
-        
-    def _sanear(self, classe_entidade, dados):
-        entidade = classe_entidade(**{k.lower():v for k,v in dados.items()})
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self._acertos = 0
+        self._falhas = 0
+        self._despejos = 0
+
+
+    def estatisticas(self):
+        """
+        Retorna os contadores de acertos (consultas atendidas da memória),
+        falhas (consultas repassadas ao provisionamento envolvido) e despejos
+        (itens descartados para dar lugar a outros), além do número de itens
+        em memória.
+
+        :rtype: Estatisticas
+        """
+        with self._lock:
+            return Estatisticas(acertos=self._acertos, falhas=self._falhas,
+                    despejos=self._despejos, tamanho=len(self._itens))
+
+
+    def limpar(self):
+        """Descarta todos os itens mantidos em memória."""
+        with self._lock:
+            self._itens.clear()
+
+
+    def _inserir(self, chave, valor, agora):
+        # deve ser chamado com self._lock
+        self._itens.pop(chave, None)
+        self._itens[chave] = (agora + self._expires, _guardar(valor))
+        while len(self._itens) > self._tamanho:
+            self._itens.popitem(last=False)
+            self._despejos += 1
+
+
+    def _ler(self, chaves, agora):
+        # retorna os itens mantidos (None para os que não estão em memória
+        # ou expiraram), na forma em que foram guardados (veja _guardar)
+        valores = []
+        with self._lock:
+            for chave in chaves:
+                item = self._itens.pop(chave, None)
+                if item is not None and item[0] > agora:
+                    # reinsere no final, como o item mais recentemente
+                    # consultado
+                    self._itens[chave] = item
+                    self._acertos += 1
+                    valores.append(item[1])
+                else:
+                    self._falhas += 1
+                    valores.append(None)
+        return valores
+
+
+    def _get(self, chave, metodo, *args):
+        agora = time.time()
+        valor = _restaurar(self._ler_instrumentado(
+                self._ler, [chave], agora)[0])
+
+        if valor is None:
+            try:
+                valor = metodo(*args)
+            except ErroNaoEncontrado as ex:
+                valor = ex
+            with self._lock:
+                self._inserir(chave, valor, agora)
+
+        if isinstance(valor, ErroNaoEncontrado):
+            raise valor
+        return valor
+
+
+    def get_produto(self, ncm, ncm_ex):
+        chave = _chave_produto_em_memoria((ncm, ncm_ex))
+        return self._get(chave, self._provisao.get_produto, *chave[1:])
+
+
+    def get_servico(self, nbs):
+        return self._get(('nbs', nbs), self._provisao.get_servico, nbs)
+
+
+    def _consultar(self, chave):
+        valor = _restaurar(self._ler_instrumentado(
+                self._ler, [chave], time.time())[0])
+        if isinstance(valor, ErroNaoEncontrado):
+            raise valor
+        return valor
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        return self._consultar(_chave_produto_em_memoria((ncm, ncm_ex)))
+
+
+    def consultar_servico(self, nbs):
+        return self._consultar(('nbs', nbs))
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        with self._lock:
+            self._inserir(_chave_produto_em_memoria((ncm, ncm_ex)), produto,
+                    time.time())
+
+
+    def provisionar_servico(self, nbs, servico):
+        with self._lock:
+            self._inserir(('nbs', nbs), servico, time.time())
+
+
+    def _get_lote(self, chaves, chave_memoria, metodo_lote):
+        agora = time.time()
+        resultados = OrderedDict()
+        faltantes = []
+        lidos = self._ler_instrumentado(self._ler,
+                [chave_memoria(chave) for chave in chaves], agora)
+        for chave, valor in zip(chaves, lidos):
+            resultados[chave] = _restaurar(valor)
+            if valor is None:
+                faltantes.append(chave)
+
+        if faltantes:
+            obtidos = metodo_lote(faltantes)
+            with self._lock:
+                for chave, valor in obtidos.items():
+                    resultados[chave] = valor
+                    if isinstance(valor, Exception) and \
+                            not isinstance(valor, ErroNaoEncontrado):
+                        continue
+                    self._inserir(chave_memoria(chave), valor, agora)
+
+        return resultados
+
+
+    def get_produtos(self, chaves):
+        return self._get_lote(chaves_de_produtos(chaves),
+                _chave_produto_em_memoria, self._provisao.get_produtos)
+
+
+    def get_servicos(self, codigos):
+        return self._get_lote(unicos(codigos),
+                lambda nbs: ('nbs', nbs), self._provisao.get_servicos)
+
+
+def _chave_produto_em_memoria(chave):
+    # a mesma chave para consultas individuais e em lote, com a exceção da
+    # NCM convertida para número inteiro (veja lotes.chaves_de_produtos)
+    return ('ncm',) + _chave_de_produto(chave)
+
+
+class CodecBase(object):
+    """
+    Classe base para os *codecs* que determinam como produtos e serviços
+    são armazenados no Redis por :class:`ProvisaoViaRedis`. A leitura é
+    dividida entre :meth:`consultar`, que inclui os comandos em um
+    *pipeline*, e :meth:`interpretar`, que interpreta os resultados, de modo
+    que o mesmo *codec* possa ser utilizado com clientes Redis síncronos e
+    assíncronos.
+
+    .. versionadded:: 0.5
+    """
+
+    legado = None
+    """Um *codec* com o qual devem ser lidas as chaves que não puderam ser
+    lidas por este *codec* (veja :class:`CodecBinario`)."""
+
+    def ler(self, redis, chaves, ttl=False):
+        """
+        Lê as chaves informadas em uma única ida e volta ao servidor (ou
+        duas, se houver chaves a serem lidas pelo *codec* :attr:`legado`).
+
+        :param bool ttl: Se ``True``, obtém também o tempo restante, em
+            milissegundos, até que cada chave expire (``PTTL``).
+
+        :return: Uma lista com os dados lidos para cada chave, na mesma
+            ordem das chaves, ou ``None`` para as chaves inexistentes. Se
+            ``ttl`` for ``True``, uma tupla com essa lista e a lista dos
+            tempos restantes.
+        """
+        if not chaves:
+            return ([], []) if ttl else []
+        with redis.pipeline(transaction=False) as pipe:
+            self.consultar(pipe, chaves, ttl=ttl)
+            valores, restantes = self.interpretar(pipe.execute(), ttl=ttl)
+        if self.legado is not None:
+            legadas = [i for i, valor in enumerate(valores) if valor is None]
+            if legadas:
+                lidos = self.legado.ler(redis, [chaves[i] for i in legadas])
+                for i, dados in zip(legadas, lidos):
+                    valores[i] = dados
+        return (valores, restantes) if ttl else valores
+
+
+    def consultar(self, pipe, chaves, ttl=False):
+        """Inclui no *pipeline* os comandos para ler as chaves informadas."""
+        raise NotImplementedError()
+
+
+    def interpretar(self, resultados, ttl=False):
+        """
+        Interpreta os resultados do *pipeline* preparado por
+        :meth:`consultar`.
+
+        :return: Uma tupla com a lista dos dados lidos (ou ``None``) e a
+            lista dos tempos restantes (ou ``None``, se ``ttl`` for
+            ``False``).
+        """
+        raise NotImplementedError()
+
+
+    def gravar(self, pipe, chave, valor, expires):
+        """
+        Inclui no *pipeline* os comandos para gravar um produto, um serviço
+        ou uma exceção :class:`~ibptws.excecoes.ErroNaoEncontrado`.
+        """
+        raise NotImplementedError()
+
+
+    def nao_encontrado(self, dados):
+        """
+        Indica se os dados lidos marcam um produto ou serviço não encontrado.
+        """
+        raise NotImplementedError()
+
+
+    def decodificar(self, classe_entidade, dados):
+        """
+        Compõe a entidade a partir dos dados lidos. Se os dados indicarem um
+        produto ou serviço não encontrado, a exceção correspondente será
+        lançada.
+        """
+        raise NotImplementedError()
+
+
+class CodecHash(CodecBase):
+    """
+    Armazena cada produto ou serviço no Redis como um *hash*, com um campo
+    para cada atributo (``HGETALL``/``HMSET``). Este é o formato utilizado
+    originalmente por :class:`ProvisaoViaRedis`.
+
+    .. versionadded:: 0.5
+    """
+
+    def consultar(self, pipe, chaves, ttl=False):
+        for chave in chaves:
+            pipe.hgetall(chave)
+            if ttl:
+                pipe.pttl(chave)
+
+
+    def interpretar(self, resultados, ttl=False):
+        if ttl:
+            return ([dados or None for dados in resultados[0::2]],
+                    resultados[1::2])
+        return [dados or None for dados in resultados], None
+
+
+    def gravar(self, pipe, chave, valor, expires):
+        if isinstance(valor, ErroNaoEncontrado):
+            dados = {NAO_ENCONTRADO: str(valor)}
+        else:
+            dados = valor._asdict()
+        pipe.delete(chave)
+        pipe.hmset(chave, unicode_to_str(dados))
+        pipe.expire(chave, expires)
+
+
+    def nao_encontrado(self, dados):
+        return any(_str(k).lower() == NAO_ENCONTRADO for k in dados)
+
+
+    def decodificar(self, classe_entidade, dados):
+        # dados provisionados no Redis são convertidos para strings, por isso
+        # é necessário sanear os atributos da entidade resultante convertendo
+        # para os tipos Python corretos...
+        dados = {_str(k).lower():v for k,v in dados.items()}
+        if NAO_ENCONTRADO in dados:
+            erro = _ERROS_NAO_ENCONTRADO[classe_entidade]
+            raise erro(_str(dados[NAO_ENCONTRADO]))
+        entidade = classe_entidade(**dados)
         return getattr(self, '_sanear_{}'.format(
                 classe_entidade.__name__.lower()))(entidade)
-                
-                
+
+
     def _sanear_produto(self, produto):
         return produto._replace(
-                codigo=produto.codigo.decode('utf-8'),
-                uf=produto.uf.decode('utf-8'),
-                descricao=produto.descricao.decode('utf-8'),
+                codigo=_str(produto.codigo),
+                uf=_str(produto.uf),
+                descricao=_str(produto.descricao),
                 ex=int(produto.ex),
                 nacional=float(produto.nacional),
                 importado=float(produto.importado),
                 estadual=float(produto.estadual))
-                
-    
+
+
     def _sanear_servico(self, servico):
         return servico._replace(
-                codigo=servico.codigo.decode('utf-8'),
-                uf=servico.uf.decode('utf-8'),
-                descricao=servico.descricao.decode('utf-8'),
-                tipo=servico.tipo.decode('utf-8'),
+                codigo=_str(servico.codigo),
+                uf=_str(servico.uf),
+                descricao=_str(servico.descricao),
+                tipo=_str(servico.tipo),
                 nacional=float(servico.nacional),
                 importado=float(servico.importado),
                 estadual=float(servico.estadual),
                 municipal=float(servico.municipal))
-                
 
-    def _get(self, metodo, classe_entidade, chave, *args, **kwargs):
-        if self._redis is None:
-            self._connect()
-        
-        dados = self._redis.hgetall(chave)
-        
-        if dados:
-            # compõe a entidade dos dados obtidos do provisionamento, porém,
-            # dados provisionados no Redis são convertidos para strings, por
-            # isso é necessário sanear os atributos da entidade resultante
-            # convertendo para os tipos Python corretos...
-            entidade = self._sanear(classe_entidade, dados)
-        else:
-            # não foi possível obter do provisionamento,
-            # obtém do web services do IBPT...
-            entidade = metodo(*args, **kwargs)
-            # ...e provisiona os dados obtidos
-            with self._redis.pipeline() as pipe:
-                pipe.hmset(chave, unicode_to_str(entidade._asdict()))
-                pipe.expire(chave, self._expires)
-                pipe.execute()
 
-        return entidade
-        
-        
-    def get_produto(self, ncm, ncm_ex):
-        chave = 'ncm:{}:{}'.format(ncm, ncm_ex)
-        return self._get(get_produto, Produto, chave, ncm, ncm_ex)
-        
-    
-    def get_servico(self, nbs):
-        chave = 'nbs:{}'.format(nbs)
-        return self._get(get_servico, Servico, chave, nbs)
+class CodecBinario(CodecBase):
+    """
+    Armazena cada produto ou serviço no Redis como um único valor binário
+    compacto (``MGET``/``SET``): alíquotas em ponto fixo, UF e tipo do
+    serviço como índices em tabelas conhecidas e código e descrição
+    prefixados por seus tamanhos. Ocupa uma fração da memória de um *hash*
+    e é decodificado sem conversões de texto para número.
 
+    Enquanto ``ler_legado`` for ``True``, as chaves ainda gravadas como
+    *hash* (por :class:`CodecHash`) continuam sendo lidas, de modo que é
+    possível migrar um provisionamento existente sem descartá-lo: as chaves
+    antigas são substituídas à medida que expiram.
 
-def unicode_to_str(self, d):
-    """
-    Runs through dictionary keys, converting every unicode value to str.
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaRedis(codec=CodecBinario())  # doctest: +SKIP
+
+    .. versionadded:: 0.5
     """
-    convert = lambda v: v.encode('utf-8') if isinstance(v, unicode) else v
-    return {k: convert(v) for k, v in d.items()}
+
+    UFS = ('', 'AC', 'AL', 'AM', 'AP', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA',
+            'MG', 'MS', 'MT', 'PA', 'PB', 'PE', 'PI', 'PR', 'RJ', 'RN', 'RO',
+            'RR', 'RS', 'SC', 'SE', 'SP', 'TO',)
+
+    TIPOS = ('NBS', 'LC116',)
+
+    ESCALA = 10000
+
+    _NAO_ENCONTRADO = 0
+    _PRODUTO = 1
+    _SERVICO = 2
+    _PONTO_FLUTUANTE = 0x80
+    _OUTRO = 0xff
+
+    # marca, UF, exceção
+    _CABECALHO_PRODUTO = struct.Struct('<BBH')
+    # marca, UF, tipo
+    _CABECALHO_SERVICO = struct.Struct('<BBB')
+
+    def __init__(self, ler_legado=True):
+        self.ler_legado = ler_legado
+        self._legado = CodecHash()
+
+
+    @property
+    def legado(self):
+        # MGET retorna nulo para as chaves que não são strings, como as
+        # chaves ainda gravadas como hash, que serão lidas por CodecHash
+        return self._legado if self.ler_legado else None
+
+
+    def consultar(self, pipe, chaves, ttl=False):
+        pipe.mget(chaves)
+        if ttl:
+            for chave in chaves:
+                pipe.pttl(chave)
+
+
+    def interpretar(self, resultados, ttl=False):
+        return list(resultados[0]), (resultados[1:] if ttl else None)
+
+
+    def gravar(self, pipe, chave, valor, expires):
+        pipe.set(chave, self.codificar(valor), ex=expires)
+
+
+    def nao_encontrado(self, dados):
+        if isinstance(dados, dict):
+            return self._legado.nao_encontrado(dados)
+        return bytearray(dados[:1])[0] == self._NAO_ENCONTRADO
+
+
+    def decodificar(self, classe_entidade, dados):
+        if isinstance(dados, dict):
+            return self._legado.decodificar(classe_entidade, dados)
+
+        marca = bytearray(dados[:1])[0]
+        if marca == self._NAO_ENCONTRADO:
+            mensagem, _ = _ler_texto(dados, 1, 'H')
+            raise _ERROS_NAO_ENCONTRADO[classe_entidade](mensagem)
+
+        formato_aliquotas = '<dddd' if marca & self._PONTO_FLUTUANTE \
+                else '<IIII'
+
+        if marca & ~self._PONTO_FLUTUANTE == self._PRODUTO:
+            _, indice_uf, ex = self._CABECALHO_PRODUTO.unpack_from(dados)
+            posicao = self._CABECALHO_PRODUTO.size
+            formato_aliquotas = formato_aliquotas[:-1]
+        else:
+            _, indice_uf, indice_tipo = self._CABECALHO_SERVICO.unpack_from(
+                    dados)
+            posicao = self._CABECALHO_SERVICO.size
+
+        aliquotas = struct.unpack_from(formato_aliquotas, dados, posicao)
+        posicao += struct.calcsize(formato_aliquotas)
+        if not marca & self._PONTO_FLUTUANTE:
+            escala = float(self.ESCALA)
+            aliquotas = [aliquota / escala for aliquota in aliquotas]
+
+        if indice_uf == self._OUTRO:
+            uf, posicao = _ler_texto(dados, posicao, 'B')
+        else:
+            uf = self.UFS[indice_uf]
+
+        if marca & ~self._PONTO_FLUTUANTE == self._PRODUTO:
+            codigo, posicao = _ler_texto(dados, posicao, 'B')
+            descricao, posicao = _ler_texto(dados, posicao, 'H')
+            nacional, importado, estadual = aliquotas
+            return Produto(codigo=codigo, uf=uf, ex=ex, descricao=descricao,
+                    nacional=nacional, importado=importado, estadual=estadual)
+
+        if indice_tipo == self._OUTRO:
+            tipo, posicao = _ler_texto(dados, posicao, 'B')
+        else:
+            tipo = self.TIPOS[indice_tipo]
+        codigo, posicao = _ler_texto(dados, posicao, 'B')
+        descricao, posicao = _ler_texto(dados, posicao, 'H')
+        nacional, importado, estadual, municipal = aliquotas
+        return Servico(codigo=codigo, uf=uf, descricao=descricao, tipo=tipo,
+                nacional=nacional, importado=importado, estadual=estadual,
+                municipal=municipal)
+
+
+    def codificar(self, valor):
+        """
+        Codifica um produto, um serviço ou uma exceção
+        :class:`~ibptws.excecoes.ErroNaoEncontrado`.
+
+        :rtype: bytes
+        """
+        if isinstance(valor, ErroNaoEncontrado):
+            return struct.pack('<B', self._NAO_ENCONTRADO) + \
+                    _texto(str(valor), 'H')
+
+        if isinstance(valor, Produto):
+            marca = self._PRODUTO
+            aliquotas = (valor.nacional, valor.importado, valor.estadual)
+        else:
+            marca = self._SERVICO
+            aliquotas = (valor.nacional, valor.importado, valor.estadual,
+                    valor.municipal)
+
+        fixos = [int(round(float(a) * self.ESCALA)) for a in aliquotas]
+        if all(0 <= f < 2 ** 32 and abs(float(a) * self.ESCALA - f) < 1e-6
+                for a, f in zip(aliquotas, fixos)):
+            formato = '<' + 'I' * len(fixos)
+        else:
+            # a alíquota não pode ser representada em ponto fixo sem perda
+            marca |= self._PONTO_FLUTUANTE
+            formato = '<' + 'd' * len(fixos)
+            fixos = [float(a) for a in aliquotas]
+
+        uf = _str(valor.uf or '')
+        indice_uf = self.UFS.index(uf) if uf in self.UFS else self._OUTRO
+
+        if isinstance(valor, Produto):
+            partes = [self._CABECALHO_PRODUTO.pack(marca, indice_uf,
+                    int(valor.ex))]
+        else:
+            tipo = _str(valor.tipo or '')
+            indice_tipo = self.TIPOS.index(tipo) if tipo in self.TIPOS \
+                    else self._OUTRO
+            partes = [self._CABECALHO_SERVICO.pack(marca, indice_uf,
+                    indice_tipo)]
+
+        partes.append(struct.pack(formato, *fixos))
+        if indice_uf == self._OUTRO:
+            partes.append(_texto(uf, 'B'))
+        if isinstance(valor, Servico) and indice_tipo == self._OUTRO:
+            partes.append(_texto(tipo, 'B'))
+        partes.append(_texto(_str(valor.codigo), 'B'))
+        partes.append(_texto(_str(valor.descricao), 'H'))
+        return b''.join(partes)
+
+
+EstatisticasConexoes = namedtuple('EstatisticasConexoes',
+        'criadas em_uso disponiveis maximo')
+"""Contadores de um *pool* de conexões com o servidor Redis (veja
+:meth:`ProvisaoViaRedis.estatisticas_conexoes`). Os contadores que não
+puderem ser obtidos da versão instalada do redis-py são ``None``
+(desconhecidos)."""
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = None
+
+
+def pool_de_conexoes(max_conexoes=None, bloquear=False, **kwargs):
+    """
+    Retorna o *pool* de conexões com o servidor Redis compartilhado por
+    todas as instâncias de :class:`ProvisaoViaRedis` criadas com os mesmos
+    argumentos neste processo, criando-o na primeira chamada. Os argumentos
+    de conexão são os mesmos esperados pela classe ``StrictRedis``.
+
+    .. sourcecode:: python
+
+        >>> pool_de_conexoes(host='localhost') is pool_de_conexoes(
+        ...         host='localhost')
+        True
+
+    .. versionadded:: 0.5
+    """
+    global _pools_pid
+    try:
+        chave = (max_conexoes, bloquear, tuple(sorted(kwargs.items())))
+        hash(chave)
+    except TypeError:
+        # argumentos que não podem ser comparados não são compartilhados
+        return _criar_pool(max_conexoes, bloquear, kwargs)
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # após um fork, os pools herdados do processo pai são descartados
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(chave)
+        if pool is None:
+            pool = _pools[chave] = _criar_pool(max_conexoes, bloquear, kwargs)
+        return pool
+
+
+def _criar_pool(max_conexoes, bloquear, kwargs):
+    kwargs = dict(kwargs)
+    # converte os argumentos de StrictRedis que não são aceitos pelo pool
+    if kwargs.pop('ssl', False):
+        kwargs['connection_class'] = redis.SSLConnection
+    caminho = kwargs.pop('unix_socket_path', None)
+    if caminho:
+        kwargs['connection_class'] = redis.UnixDomainSocketConnection
+        kwargs['path'] = caminho
+        kwargs.pop('host', None)
+        kwargs.pop('port', None)
+    if bloquear:
+        return redis.BlockingConnectionPool(
+                max_connections=max_conexoes or 50, **kwargs)
+    return redis.ConnectionPool(max_connections=max_conexoes, **kwargs)
+
+
+def _estatisticas_pool(pool):
+    # o redis-py não expõe esses contadores; são lidos de atributos internos
+    # dos pools, que podem mudar entre versões, e os que não existirem são
+    # informados como desconhecidos (None)
+    criadas = disponiveis = None
+    if isinstance(pool, redis.BlockingConnectionPool):
+        conexoes = getattr(pool, '_connections', None)
+        fila = getattr(getattr(pool, 'pool', None), 'queue', None)
+        if conexoes is not None:
+            criadas = len(conexoes)
+        if fila is not None:
+            disponiveis = len([c for c in list(fila) if c is not None])
+    else:
+        criadas = getattr(pool, '_created_connections', None)
+        conexoes = getattr(pool, '_available_connections', None)
+        if conexoes is not None:
+            disponiveis = len(conexoes)
+    em_uso = None
+    if criadas is not None and disponiveis is not None:
+        em_uso = criadas - disponiveis
+    return EstatisticasConexoes(criadas=criadas,
+            em_uso=em_uso,
+            disponiveis=disponiveis,
+            maximo=getattr(pool, 'max_connections', None))
+
+
+def _somar_contadores(contadores):
+    # a soma de contadores de vários pools; desconhecida se algum for
+    contadores = list(contadores)
+    return None if None in contadores else sum(contadores)
+
+
+class ProvisaoViaRedis(ProvisaoBase):
+    """
+    Implementa um provisionamento baseado em um servidor `Redis`_.
+    Produtos e serviços solicitados serão obtidos do web services do IBPT e
+    então provisionados, com uma expiração padrão de 24h de modo que, dentro
+    desse prazo, toda solicitação feita para um produto ou serviço provisionados
+    serão obtidos de um servidor Redis, ao invés de acessar o web services.
+    
+    .. versionadded:: 0.3
+    """
+    
+    def __init__(self, redis=None, expires=EXPIRA_EM_24H,
+            expires_nao_encontrado=EXPIRA_EM_1H, trava_expira=10,
+            consulta_unica=None, codec=None, revalidar_apos=None,
+            revalidacao=None, max_conexoes=None, bloquear=False,
+            compartilhar_conexoes=True, variacao_expiracao=0,
+            indexar_expiracoes=False, versao=None, **kwargs):
+        """
+        Inicia uma instância de :class:`ProvisaoViaRedis`.
+        
+        :param redis: Uma instância do servidor Redis. Normalmente, deverá ser
+            uma instância ``redis.StrictRedis``(veja `redis-py`_). Mas poderá
+            ser qualquer implementação que se comporte da mesma maneira. Se
+            este argumento não for informado, será criada uma instância de
+            ``redis.StrictRedis``, cujos argumentos deverão ser os mesmos
+            argumentos esperados pela classe ``StrictRedis``.
+            
+        :param int expires: Especifica o tempo que uma consulta à produto ou
+            serviço deverá durar até que expire, exigindo que seja feita uma
+            nova consulta ao web services. Em segundos. Padrão é 24 horas.
+
+        :param int expires_nao_encontrado: Especifica o tempo que um produto
+            ou serviço não encontrado no web services permanece provisionado
+            como tal. Nesse prazo, as solicitações por aquele produto ou
+            serviço lançam :class:`~ibptws.excecoes.ErroProdutoNaoEncontrado`
+            ou :class:`~ibptws.excecoes.ErroServicoNaoEncontrado` sem acessar
+            o web services. Em segundos. Padrão é 1 hora. Informe ``0`` para
+            não provisionar produtos e serviços não encontrados.
+
+        :param int trava_expira: Tempo máximo, em segundos, que um processo
+            mantém a trava (*lock*) no Redis enquanto consulta o web services
+            por uma chave não provisionada. Outros processos que solicitarem
+            a mesma chave nesse intervalo aguardam pelo provisionamento ao
+            invés de também consultarem o web services. Informe ``0`` para
+            não utilizar a trava entre processos.
+
+        :param consulta_unica: Uma instância de :class:`ConsultaUnica` que
+            coalesce as consultas simultâneas das *threads* do processo. Se
+            não for informada, será criada uma para esta instância. Informe a
+            mesma instância para compartilhá-la entre provisionamentos que
+            utilizem o mesmo servidor Redis.
+
+        :param codec: Determina como produtos e serviços são armazenados no
+            Redis. Padrão é :class:`CodecHash`, que armazena cada produto ou
+            serviço como um *hash*. Veja também :class:`CodecBinario`.
+
+        :param int revalidar_apos: **Opcional** Tempo, em segundos, após o
+            qual um produto ou serviço provisionado é considerado
+            desatualizado. Uma solicitação por um produto ou serviço
+            desatualizado é atendida imediatamente com os dados
+            provisionados, enquanto uma nova consulta ao web services é feita
+            em segundo plano. Somente após ``expires`` as solicitações
+            aguardam pela consulta ao web services. Deve ser menor que
+            ``expires``. Se não for informado, não há revalidação.
+
+        :param revalidacao: Uma instância de
+            :class:`RevalidacaoEmSegundoPlano`, que executa as revalidações.
+            Se não for informada e ``revalidar_apos`` for informado, será
+            criada uma para esta instância.
+
+        :param int max_conexoes: **Opcional** Número máximo de conexões
+            mantidas com o servidor Redis, quando ``redis`` não for
+            informado. Em aplicações com várias *threads* deve ser, no
+            mínimo, o número de *threads* que farão consultas simultâneas.
+
+        :param bool bloquear: Se ``True``, uma consulta aguardará até que
+            haja uma conexão livre ao invés de falhar quando todas as
+            ``max_conexoes`` estiverem em uso (``BlockingConnectionPool``).
+
+        :param bool compartilhar_conexoes: Se ``True`` (padrão), instâncias
+            criadas com os mesmos argumentos de conexão compartilham o mesmo
+            *pool* de conexões (veja :func:`pool_de_conexoes`).
+
+        :param float variacao_expiracao: Fração máxima, entre ``0`` e ``1``,
+            pela qual a expiração de cada chave é reduzida. Com ``0.1``, por
+            exemplo, uma chave provisionada com expiração de 24h expira entre
+            21h36min e 24h depois, evitando que todas as chaves provisionadas
+            de uma só vez (como na carga de um catálogo) expirem ao mesmo
+            tempo. A redução é pseudoaleatória, mas determinada pela chave,
+            de modo que a idade de uma chave pode ser obtida da expiração
+            restante (veja ``revalidar_apos``). Padrão é ``0`` (sem
+            variação).
+
+        :param bool indexar_expiracoes: Se ``True``, mantém no Redis um
+            índice das expirações dos produtos e serviços provisionados (o
+            *sorted set* :data:`INDICE_EXPIRACOES`) e das suas leituras
+            (:data:`INDICE_LEITURAS`), necessários para :meth:`renovar` e
+            :class:`RenovacaoProgramada`. Cada leitura de chaves
+            provisionadas requer, então, uma ida e volta adicional ao Redis.
+
+        :param versao: **Opcional** A versão da tabela do IBPT, que passa a
+            fazer parte das chaves no Redis (veja :meth:`mudar_versao`). Pode
+            ser uma string, como ``'17.1.A'``, ou um objeto com os atributos
+            ``versao`` e ``vigencia_inicio``, como uma
+            :class:`~ibptws.tabelas.Tabela`. Se não for informada, as chaves
+            não são versionadas.
+
+        A conexão com o servidor Redis é estabelecida sob demanda, na
+        primeira consulta, de modo seguro entre *threads*, e é recriada
+        automaticamente se o processo for bifurcado (*fork*), como fazem os
+        *workers* do *gunicorn*.
+        """
+        self._redis = redis
+        self._injetado = redis is not None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._max_conexoes = max_conexoes
+        self._bloquear = bloquear
+        self._compartilhar_conexoes = compartilhar_conexoes
+        self._variacao_expiracao = variacao_expiracao
+        self._indexar_expiracoes = indexar_expiracoes
+        self._codec = codec or CodecHash()
+        self._expires = expires
+        self._expires_nao_encontrado = expires_nao_encontrado
+        self._trava_expira = trava_expira
+        self._trava_intervalo = 0.05
+        self._consultas = consulta_unica or ConsultaUnica()
+        self._revalidar_apos = revalidar_apos
+        self._revalidacao = revalidacao or (RevalidacaoEmSegundoPlano()
+                if revalidar_apos is not None else None)
+        self._versao = _identificar_versao(versao)
+        self._transicao = None
+        self._ao_mudar_versao = []
+        self._kwargs = kwargs
+        
+    
+    def _connect(self):
+        if self._redis is not None and (
+                self._injetado or self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._redis is None or (
+                    not self._injetado and self._pid != os.getpid()):
+                # após um fork, o cliente herdado é simplesmente descartado
+                # (sem fechar as conexões do processo pai)
+                if self._compartilhar_conexoes:
+                    pool = pool_de_conexoes(max_conexoes=self._max_conexoes,
+                            bloquear=self._bloquear, **self._kwargs)
+                else:
+                    pool = _criar_pool(self._max_conexoes, self._bloquear,
+                            self._kwargs)
+                self._redis = redis.StrictRedis(connection_pool=pool)
+                self._pid = os.getpid()
+
+
+    def estatisticas_conexoes(self):
+        """
+        Retorna os contadores do *pool* de conexões com o servidor Redis.
+
+        :rtype: EstatisticasConexoes
+        """
+        self._connect()
+        return _estatisticas_pool(self._redis.connection_pool)
+
+
+    def _clientes(self):
+        # todos os clientes Redis utilizados por este provisionamento
+        self._connect()
+        return [self._redis]
+
+
+    def _cliente(self, chave):
+        # o cliente Redis onde a chave está provisionada
+        return self._redis
+
+
+    def _agrupar(self, chaves):
+        # agrupa as chaves pelo cliente Redis onde estão provisionadas
+        return [(self._redis, list(chaves))]
+
+
+    def _ler_dados(self, chaves, ttl=False):
+        # lê as chaves em uma ida e volta a cada cliente, preservando a ordem
+        grupos = self._agrupar(chaves)
+        if len(grupos) == 1:
+            return self._codec.ler(grupos[0][0], grupos[0][1], ttl=ttl)
+        lidos = {}
+        for cliente, grupo in grupos:
+            resultado = self._codec.ler(cliente, grupo, ttl=ttl)
+            lidos.update(zip(grupo, zip(*resultado) if ttl else resultado))
+        if ttl:
+            todos_dados = [lidos[chave][0] for chave in chaves]
+            return todos_dados, [lidos[chave][1] for chave in chaves]
+        return [lidos[chave] for chave in chaves]
+
+
+    def _gravar_lote(self, itens):
+        # itens: dicionário da chave no Redis para o produto, serviço ou
+        # exceção a ser provisionado; uma ida e volta a cada cliente
+        for cliente, grupo in self._agrupar(itens):
+            with cliente.pipeline(transaction=False) as pipe:
+                for chave in grupo:
+                    self._gravar(pipe, chave, itens[chave])
+                pipe.execute()
+
+
+    def _travar(self, chave):
+        # adquire a trava entre processos para consultar o web services por
+        # essa chave, retornando o token da trava ou None
+        token = uuid.uuid4().hex
+        if self._cliente(chave).set('trava:{}'.format(chave), token,
+                nx=True, px=int(self._trava_expira * 1000)):
+            return token
+        return None
+
+
+    def _destravar(self, chave, token):
+        # a verificação e a remoção não são atômicas, mas na pior das
+        # hipóteses outro processo fará uma consulta adicional
+        cliente = self._cliente(chave)
+        trava = 'trava:{}'.format(chave)
+        if _str(cliente.get(trava) or '') == token:
+            cliente.delete(trava)
+        
+        
+    def _get(self, metodo, classe_entidade, chave, *args, **kwargs):
+        self._connect()
+        dados = self._ler_instrumentado(self._ler, [chave], metodo, [args])[0]
+        
+        if dados is not None:
+            # compõe a entidade dos dados obtidos do provisionamento...
+            return self._codec.decodificar(classe_entidade, dados)
+
+        # não foi possível obter do provisionamento; apenas uma das threads
+        # que solicitarem a mesma chave ao mesmo tempo irá provisioná-la...
+        return self._consultas.executar(chave, self._provisionar,
+                metodo, classe_entidade, chave, args, kwargs)
+
+
+    def _ler(self, chaves, metodo, argumentos):
+        # lê as chaves do provisionamento; no modo de revalidação, agenda a
+        # revalidação das chaves desatualizadas (os argumentos são aqueles
+        # que devem ser passados ao método de consulta para cada chave)
+        if self._revalidar_apos is None:
+            todos_dados = self._ler_dados(chaves)
+            self._registrar_leituras(chaves, todos_dados)
+            return self._ler_anteriores(chaves, todos_dados)
+
+        todos_dados, restantes = self._ler_dados(chaves, ttl=True)
+        self._registrar_leituras(chaves, todos_dados)
+        for chave, dados, restante, args in zip(
+                chaves, todos_dados, restantes, argumentos):
+            if dados is None or self._codec.nao_encontrado(dados):
+                continue
+            # a idade da chave é a expiração com que foi gravada menos a
+            # expiração restante
+            idade = self._expiracao(self._expires, chave) * 1000 - restante
+            if 0 <= restante and idade > self._revalidar_apos * 1000:
+                self._revalidacao.agendar(chave, self._revalidar,
+                        metodo, chave, args)
+        return self._ler_anteriores(chaves, todos_dados)
+
+
+    def _registrar_leituras(self, chaves, todos_dados):
+        # registra no índice de leituras as chaves encontradas, para que
+        # sejam renovadas (veja renovar)
+        if not self._indexar_expiracoes:
+            return
+        lidas = [chave for chave, dados in zip(chaves, todos_dados)
+                if dados is not None]
+        for cliente, grupo in self._agrupar(lidas):
+            if grupo:
+                with cliente.pipeline(transaction=False) as pipe:
+                    self._incluir_leituras(pipe, grupo)
+                    pipe.execute()
+
+
+    def _incluir_leituras(self, pipe, chaves):
+        # inclui no pipeline o registro da leitura das chaves
+        agora = time.time()
+        argumentos = []
+        for chave in chaves:
+            argumentos.extend((agora, chave))
+        pipe.execute_command('ZADD', INDICE_LEITURAS, *argumentos)
+
+
+    def _ler_anteriores(self, chaves, todos_dados):
+        # durante a transição entre versões, lê da versão anterior as chaves
+        # que ainda não foram provisionadas na versão atual
+        if self._transicao is None:
+            return todos_dados
+        anteriores = OrderedDict()
+        for i, (chave, dados) in enumerate(zip(chaves, todos_dados)):
+            if dados is None:
+                anterior = self._chave_anterior(chave)
+                if anterior is not None:
+                    anteriores[i] = anterior
+        if anteriores:
+            todos_dados = list(todos_dados)
+            for i, dados in zip(anteriores,
+                    self._ler_dados(list(anteriores.values()))):
+                todos_dados[i] = dados
+        return todos_dados
+
+
+    def _revalidar(self, metodo, chave, args):
+        token = None
+        if self._trava_expira:
+            token = self._travar(chave)
+            if token is None:
+                # outro processo já está consultando o web services
+                return
+        try:
+            try:
+                entidade = metodo(*args)
+            except ErroNaoEncontrado as ex:
+                self._provisionar_dados(chave, ex)
+                return
+            self._provisionar_dados(chave, entidade)
+        finally:
+            if token is not None:
+                self._destravar(chave, token)
+
+
+    def _provisionar(self, metodo, classe_entidade, chave, args, kwargs):
+        # outra thread (ou processo) pode ter provisionado a chave enquanto
+        # esta thread aguardava a vez de consultar
+        dados = self._ler_dados([chave])[0]
+        if dados is not None:
+            return self._codec.decodificar(classe_entidade, dados)
+
+        token = None
+        if self._trava_expira:
+            token = self._travar(chave)
+            if token is None:
+                # outro processo está consultando o web services por essa
+                # mesma chave; aguarda que ela seja provisionada
+                entidade = self._aguardar(classe_entidade, chave)
+                if entidade is not None:
+                    return entidade
+
+        try:
+            # obtém do web services do IBPT...
+            try:
+                entidade = metodo(*args, **kwargs)
+            except ErroNaoEncontrado as ex:
+                # ...provisionando também o fato de não ter sido encontrado
+                self._provisionar_dados(chave, ex)
+                raise
+            # ...e provisiona os dados obtidos
+            self._provisionar_dados(chave, entidade)
+        finally:
+            if token is not None:
+                self._destravar(chave, token)
+
+        return entidade
+
+
+    def _provisionar_dados(self, chave, valor):
+        with self._cliente(chave).pipeline() as pipe:
+            self._gravar(pipe, chave, valor)
+            pipe.execute()
+
+
+    def _gravar(self, pipe, chave, valor):
+        # inclui no pipeline a gravação de um produto, serviço ou exceção
+        # ErroNaoEncontrado, com a expiração correspondente
+        if isinstance(valor, ErroNaoEncontrado):
+            if self._expires_nao_encontrado:
+                self._codec.gravar(pipe, chave, valor, self._expiracao(
+                        self._expires_nao_encontrado, chave))
+                if self._indexar_expiracoes:
+                    pipe.zrem(INDICE_EXPIRACOES, chave)
+            return
+        expires = self._expiracao(self._expires, chave)
+        self._codec.gravar(pipe, chave, valor, expires)
+        if self._indexar_expiracoes:
+            pipe.execute_command('ZADD', INDICE_EXPIRACOES,
+                    time.time() + expires, chave)
+
+
+    def _expiracao(self, expires, chave):
+        # reduz a expiração por uma fração pseudoaleatória da chave, para
+        # que as chaves provisionadas ao mesmo tempo não expirem todas ao
+        # mesmo tempo; por ser determinada pela chave, a expiração com que
+        # uma chave foi gravada é conhecida na leitura (veja _ler)
+        if not self._variacao_expiracao:
+            return expires
+        fracao = (_hash(chave) % 1000000) / 1000000.0
+        return max(1, int(expires - expires * self._variacao_expiracao *
+                fracao))
+
+
+    def _aguardar(self, classe_entidade, chave):
+        trava = 'trava:{}'.format(chave)
+        limite = time.time() + self._trava_expira
+        while time.time() < limite:
+            time.sleep(self._trava_intervalo)
+            dados = self._ler_dados([chave])[0]
+            if dados is not None:
+                return self._codec.decodificar(classe_entidade, dados)
+            if not self._cliente(chave).exists(trava):
+                # o processo que detinha a trava terminou sem provisionar a
+                # chave (provavelmente um erro ao consultar o web services)
+                break
+        return None
+        
+        
+    @property
+    def versao(self):
+        """
+        Identificação da versão da tabela do IBPT em uso ou ``None``, se as
+        chaves não forem versionadas.
+        """
+        return self._versao
+
+
+    def _chave(self, chave):
+        # a chave no Redis, na versão atual da tabela
+        return _versionar(self._versao, chave)
+
+
+    def _chave_anterior(self, chave):
+        # a chave na versão anterior da tabela, se a chave ainda estiver em
+        # transição para a versão atual; cada chave muda de versão em um
+        # momento diferente (mas o mesmo em todos os processos) dentro do
+        # prazo da transição
+        transicao = self._transicao
+        if transicao is None:
+            return None
+        anterior, inicio, prazo = transicao
+        base = _sem_versao(chave)
+        if time.time() >= inicio + prazo * (_hash(base) % 1000) / 1000.0:
+            if time.time() >= inicio + prazo:
+                self._transicao = None
+            return None
+        return _versionar(anterior, base)
+
+
+    def ao_mudar_versao(self, funcao):
+        """
+        Registra uma função, sem argumentos, que será invocada sempre que a
+        versão da tabela mudar neste processo. Utilize para descartar as
+        cópias mantidas em memória, por exemplo:
+
+        .. sourcecode:: python
+
+            >>> via_redis = ProvisaoViaRedis(versao='17.1.A')
+            >>> provisao = ProvisaoEmMemoria(via_redis)
+            >>> via_redis.ao_mudar_versao(provisao.limpar)
+
+        """
+        self._ao_mudar_versao.append(funcao)
+
+
+    def mudar_versao(self, versao, transicao=0, inicio=None):
+        """
+        Muda, apenas neste processo, a versão da tabela do IBPT em uso. As
+        chaves da versão anterior deixam de ser lidas e expiram normalmente.
+        Para mudar a versão em todos os processos, veja
+        :meth:`publicar_versao`.
+
+        :param versao: A nova versão (veja o argumento ``versao``).
+
+        :param float transicao: Prazo, em segundos, para a transição
+            gradual. Nesse prazo, cada produto ou serviço ainda não
+            provisionado na nova versão continua sendo lido da versão
+            anterior até um momento próprio, sorteado de modo estável dentro
+            do prazo, de modo que as consultas ao web services se distribuem
+            ao longo da transição. Padrão é ``0`` (mudança imediata).
+
+        :param float inicio: Início da transição (``time.time()``). Padrão
+            é o momento atual.
+
+        :return: ``True`` se a versão mudou.
+        """
+        versao = _identificar_versao(versao)
+        with self._lock:
+            if versao == self._versao:
+                return False
+            if transicao:
+                self._transicao = (self._versao,
+                        time.time() if inicio is None else inicio, transicao)
+            else:
+                self._transicao = None
+            self._versao = versao
+        for funcao in list(self._ao_mudar_versao):
+            funcao()
+        return True
+
+
+    def publicar_versao(self, versao, transicao=0, aquecer=0):
+        """
+        Muda a versão da tabela do IBPT em todos os processos. A versão é
+        gravada no Redis (veja :data:`VERSAO_TABELA` e
+        :meth:`sincronizar_versao`) e anunciada no canal
+        :data:`CANAL_INVALIDACAO`, que os processos assinam através de
+        :class:`InvalidacaoViaRedis`.
+
+        :param versao: A nova versão (veja o argumento ``versao``).
+
+        :param float transicao: Prazo para a transição gradual (veja
+            :meth:`mudar_versao`).
+
+        :param int aquecer: **Opcional** Número de produtos e serviços da
+            versão anterior que serão provisionados na nova versão, em uma
+            *thread* em segundo plano (veja :meth:`aquecer`).
+
+        :return: A *thread* do aquecimento ou ``None``.
+        """
+        anterior = self._versao
+        mensagem = _mensagem_versao(_identificar_versao(versao), time.time(),
+                transicao)
+        self._connect()
+        cliente = self._cliente(VERSAO_TABELA)
+        cliente.set(VERSAO_TABELA, mensagem)
+        cliente.publish(CANAL_INVALIDACAO, mensagem)
+        self.mudar_versao(*_interpretar_versao(mensagem))
+        if not aquecer:
+            return None
+        thread = threading.Thread(target=self.aquecer,
+                args=(anterior, aquecer), name='ibptws-aquecimento')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+    def sincronizar_versao(self):
+        """
+        Passa a utilizar a versão da tabela gravada no Redis por
+        :meth:`publicar_versao`, se houver.
+
+        :return: ``True`` se a versão mudou.
+        """
+        self._connect()
+        mensagem = self._cliente(VERSAO_TABELA).get(VERSAO_TABELA)
+        if mensagem is None:
+            return False
+        return self.mudar_versao(*_interpretar_versao(mensagem))
+
+
+    def aquecer(self, versao_anterior, limite=100, lote=50):
+        """
+        Provisiona na versão atual os produtos e serviços mais recentes da
+        versão anterior, consultando novamente o web services, de modo que
+        os produtos e serviços mais consultados já estejam provisionados
+        quando forem solicitados na nova versão. Exige que as expirações
+        sejam indexadas (veja o argumento ``indexar_expiracoes``); os mais
+        recentes são aqueles provisionados ou renovados por último.
+
+        :param versao_anterior: A versão anterior.
+        :param int limite: Número máximo de chaves lidas do índice de cada
+            servidor Redis.
+        :param int lote: Número de chaves consultadas por vez.
+
+        :return: O número de chaves provisionadas.
+        :rtype: int
+        """
+        anterior = _identificar_versao(versao_anterior)
+        chaves = []
+        for cliente in self._clientes():
+            for chave in cliente.zrevrangebyscore(INDICE_EXPIRACOES, '+inf',
+                    time.time(), start=0, num=limite):
+                chave = _str(chave)
+                if _versao_da_chave(chave) == anterior:
+                    chaves.append(self._chave(_sem_versao(chave)))
+        chaves = unicos(chaves)
+        return sum(self._reprovisionar(chaves[i:i + lote])
+                for i in range(0, len(chaves), lote))
+
+
+    def renovar(self, antecedencia=10 * 60, lote=50):
+        """
+        Renova, consultando novamente o web services, até ``lote`` produtos
+        e serviços provisionados que expiram nos próximos ``antecedencia``
+        segundos. Exige que as expirações sejam indexadas (veja o argumento
+        ``indexar_expiracoes``). Apenas as chaves lidas desde que foram
+        provisionadas (ou renovadas pela última vez) são renovadas; as
+        demais deixaram de ser solicitadas e são removidas do índice, de
+        modo que expiram normalmente. Chaves que já expiraram também são
+        removidas do índice.
+
+        :return: O número de chaves renovadas.
+        :rtype: int
+        """
+        return sum(self._renovar(cliente, antecedencia, lote)
+                for cliente in self._clientes())
+
+
+    def _renovar(self, cliente, antecedencia, lote):
+        agora = time.time()
+        cliente.zremrangebyscore(INDICE_EXPIRACOES, '-inf', agora)
+        cliente.zremrangebyscore(INDICE_LEITURAS, '-inf',
+                agora - self._expires)
+        chaves = [_str(chave) for chave in cliente.zrangebyscore(
+                INDICE_EXPIRACOES, agora, agora + antecedencia,
+                start=0, num=lote)]
+        if not chaves:
+            return 0
+
+        # chaves de outras versões da tabela não são renovadas, nem as que
+        # não foram lidas desde que foram gravadas
+        with cliente.pipeline(transaction=False) as pipe:
+            for chave in chaves:
+                pipe.zscore(INDICE_EXPIRACOES, chave)
+                pipe.zscore(INDICE_LEITURAS, chave)
+            scores = pipe.execute()
+        renovaveis, descartadas = [], []
+        for chave, expira_em, lida_em in zip(chaves, scores[::2],
+                scores[1::2]):
+            gravada_em = (expira_em or 0) - self._expiracao(
+                    self._expires, chave)
+            if _versao_da_chave(chave) == self._versao and \
+                    lida_em is not None and lida_em >= gravada_em:
+                renovaveis.append(chave)
+            else:
+                descartadas.append(chave)
+        if descartadas:
+            cliente.zrem(INDICE_EXPIRACOES, *descartadas)
+            cliente.zrem(INDICE_LEITURAS, *descartadas)
+        return self._reprovisionar(renovaveis)
+
+
+    def _reprovisionar(self, chaves):
+        # consulta novamente o web services e provisiona as chaves
+        produtos, servicos, travas = OrderedDict(), OrderedDict(), {}
+        for chave in chaves:
+            if self._trava_expira:
+                # outro processo pode estar consultando essa mesma chave
+                token = self._travar(chave)
+                if token is None:
+                    continue
+                travas[chave] = token
+            tipo, _, resto = _sem_versao(chave).partition(':')
+            if tipo == 'ncm':
+                ncm, _, ex = resto.rpartition(':')
+                produtos[(ncm, int(ex))] = chave
+            else:
+                servicos[resto] = chave
+
+        try:
+            itens = OrderedDict()
+            if produtos:
+                for chave, valor in get_produtos(list(produtos)).items():
+                    itens[produtos[chave]] = valor
+            if servicos:
+                for chave, valor in get_servicos(list(servicos)).items():
+                    itens[servicos[chave]] = valor
+            itens = OrderedDict((chave, valor) for chave, valor in itens.items()
+                    if isinstance(valor, ErroNaoEncontrado)
+                            or not isinstance(valor, Exception))
+            self._gravar_lote(itens)
+        finally:
+            for chave, token in travas.items():
+                self._destravar(chave, token)
+
+        return len(itens)
+
+
+    def get_produto(self, ncm, ncm_ex):
+        chave = self._chave('ncm:{}:{}'.format(ncm, ncm_ex))
+        return self._get(get_produto, Produto, chave, ncm, ncm_ex)
+        
+    
+    def get_servico(self, nbs):
+        chave = self._chave('nbs:{}'.format(nbs))
+        return self._get(get_servico, Servico, chave, nbs)
+
+
+    def _consultar(self, classe_entidade, chave):
+        self._connect()
+        dados = self._ler_instrumentado(lambda: self._ler_anteriores(
+                [chave], self._ler_dados([chave])))[0]
+        if dados is None:
+            return None
+        return self._codec.decodificar(classe_entidade, dados)
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        return self._consultar(Produto,
+                self._chave('ncm:{}:{}'.format(ncm, ncm_ex)))
+
+
+    def consultar_servico(self, nbs):
+        return self._consultar(Servico, self._chave('nbs:{}'.format(nbs)))
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        self._connect()
+        self._provisionar_dados(self._chave('ncm:{}:{}'.format(ncm, ncm_ex)),
+                produto)
+
+
+    def provisionar_servico(self, nbs, servico):
+        self._connect()
+        self._provisionar_dados(self._chave('nbs:{}'.format(nbs)), servico)
+
+
+    def _get_lote(self, metodo, metodo_lote, classe_entidade, chaves_redis):
+        # chaves_redis: dicionário ordenado, da chave do lote para a chave
+        # no Redis; lê todas as chaves em uma única ida e volta...
+        self._connect()
+        todos_dados = self._ler_instrumentado(self._ler,
+                list(chaves_redis.values()), metodo,
+                [chave if isinstance(chave, tuple) else (chave,)
+                        for chave in chaves_redis])
+
+        resultados = OrderedDict()
+        faltantes = []
+        for chave, dados in zip(chaves_redis, todos_dados):
+            if dados is not None:
+                try:
+                    resultados[chave] = self._codec.decodificar(
+                            classe_entidade, dados)
+                except ErroNaoEncontrado as ex:
+                    resultados[chave] = ex
+            else:
+                resultados[chave] = None
+                faltantes.append(chave)
+
+        if not faltantes:
+            return resultados
+
+        # ...obtém apenas as chaves faltantes do web services, com as travas
+        # entre processos, como em _provisionar...
+        travas, aguardar = {}, []
+        if self._trava_expira:
+            for chave in faltantes:
+                token = self._travar(chaves_redis[chave])
+                if token is None:
+                    # outro processo está consultando essa chave
+                    aguardar.append(chave)
+                else:
+                    travas[chave] = token
+            faltantes = [chave for chave in faltantes if chave in travas]
+        try:
+            # outro processo pode ter provisionado as chaves enquanto esta
+            # thread as travava
+            faltantes = self._decodificar_lote(classe_entidade, chaves_redis,
+                    faltantes, resultados)
+            self._consultar_lote(metodo_lote, chaves_redis, faltantes,
+                    resultados)
+        finally:
+            for chave, token in travas.items():
+                self._destravar(chaves_redis[chave], token)
+
+        # ...e aguarda as chaves travadas por outros processos, consultando
+        # aquelas que não forem provisionadas no prazo da trava
+        nao_provisionadas = []
+        for chave in aguardar:
+            try:
+                entidade = self._aguardar(classe_entidade, chaves_redis[chave])
+            except ErroNaoEncontrado as ex:
+                entidade = ex
+            if entidade is None:
+                nao_provisionadas.append(chave)
+            else:
+                resultados[chave] = entidade
+        self._consultar_lote(metodo_lote, chaves_redis, nao_provisionadas,
+                resultados)
+
+        return resultados
+
+
+    def _decodificar_lote(self, classe_entidade, chaves_redis, chaves,
+            resultados):
+        # lê as chaves em uma ida e volta, incluindo as encontradas nos
+        # resultados; retorna as chaves não encontradas
+        if not chaves:
+            return chaves
+        faltantes = []
+        for chave, dados in zip(chaves, self._ler_dados(
+                [chaves_redis[chave] for chave in chaves])):
+            if dados is None:
+                faltantes.append(chave)
+                continue
+            try:
+                resultados[chave] = self._codec.decodificar(
+                        classe_entidade, dados)
+            except ErroNaoEncontrado as ex:
+                resultados[chave] = ex
+        return faltantes
+
+
+    def _consultar_lote(self, metodo_lote, chaves_redis, chaves, resultados):
+        # obtém as chaves do web services e as provisiona em uma ida e volta
+        if not chaves:
+            return
+        itens = OrderedDict()
+        for chave, valor in metodo_lote(chaves).items():
+            resultados[chave] = valor
+            if isinstance(valor, ErroNaoEncontrado) or \
+                    not isinstance(valor, Exception):
+                itens[chaves_redis[chave]] = valor
+        self._gravar_lote(itens)
+
+
+    def get_produtos(self, chaves):
+        chaves_redis = OrderedDict(
+                ((ncm, ncm_ex), self._chave('ncm:{}:{}'.format(ncm, ncm_ex)))
+                for ncm, ncm_ex in chaves_de_produtos(chaves))
+        return self._get_lote(get_produto, get_produtos, Produto,
+                chaves_redis)
+
+
+    def get_servicos(self, codigos):
+        chaves_redis = OrderedDict(
+                (nbs, self._chave('nbs:{}'.format(nbs)))
+                for nbs in unicos(codigos))
+        return self._get_lote(get_servico, get_servicos, Servico,
+                chaves_redis)
+
+
+class AnelConsistente(object):
+    """
+    Distribui chaves entre nós por *hashing* consistente: cada nó ocupa
+    ``replicas`` pontos em um anel e uma chave pertence ao primeiro nó que
+    a sucede no anel. Ao incluir ou remover um nó, apenas as chaves que lhe
+    cabem mudam de nó (em média, ``1/n`` das chaves).
+
+    .. sourcecode:: python
+
+        >>> anel = AnelConsistente(['redis-a', 'redis-b', 'redis-c'])
+        >>> anel.no('ncm:02091021:0') == anel.no('ncm:02091021:0')
+        True
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, nos, replicas=160):
+        self.nos = list(nos)
+        self.replicas = replicas
+        pontos = sorted((_hash('{}#{}'.format(no, i)), no)
+                for no in self.nos for i in range(replicas))
+        self._hashes = [h for h, no in pontos]
+        self._pontos = [no for h, no in pontos]
+
+
+    def no(self, chave):
+        """Retorna o nó ao qual a chave pertence."""
+        i = bisect.bisect(self._hashes, _hash(chave))
+        return self._pontos[i % len(self._pontos)]
+
+
+class ProvisaoViaRedisDistribuida(ProvisaoViaRedis):
+    """
+    Implementa um provisionamento distribuído entre vários servidores Redis.
+    Cada chave ``ncm:`` ou ``nbs:`` (e a sua trava) é provisionada em apenas
+    um dos servidores, escolhido por :class:`AnelConsistente`. As consultas
+    em lote fazem uma única ida e volta a cada servidor envolvido.
+
+    Todos os demais argumentos são os mesmos de :class:`ProvisaoViaRedis`,
+    exceto aqueles que criam a conexão com o servidor Redis.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaRedisDistribuida({
+        ...         'redis-a': redis.StrictRedis(host='10.0.0.1'),
+        ...         'redis-b': redis.StrictRedis(host='10.0.0.2'),
+        ...     })  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, clientes, replicas=160, **kwargs):
+        """
+        Inicia uma instância de :class:`ProvisaoViaRedisDistribuida`.
+
+        :param clientes: Um dicionário cujas chaves identificam cada servidor
+            e cujos valores são instâncias ``redis.StrictRedis``, ou uma
+            lista dessas instâncias, que serão identificadas pelo endereço
+            do servidor. A distribuição das chaves depende apenas dessa
+            identificação, portanto ela deve ser a mesma em todos os
+            processos e não deve mudar ao incluir ou remover servidores.
+
+        :param int replicas: Número de pontos de cada servidor no anel.
+        """
+        if not isinstance(clientes, dict):
+            nomes = [_nome_cliente(cliente) for cliente in clientes]
+            if len(set(nomes)) != len(nomes):
+                raise ValueError('Não foi possível identificar os servidores '
+                        'Redis pelos seus endereços; informe os clientes em '
+                        'um dicionário, identificados por nome.')
+            clientes = OrderedDict(zip(nomes, clientes))
+        if not clientes:
+            raise ValueError('Informe ao menos um servidor Redis.')
+        super(ProvisaoViaRedisDistribuida, self).__init__(**kwargs)
+        self._nos = clientes
+        self._anel = AnelConsistente(clientes, replicas=replicas)
+
+
+    def _connect(self):
+        pass
+
+
+    def estatisticas_conexoes(self):
+        """
+        Retorna os contadores somados dos *pools* de conexões de todos os
+        servidores Redis.
+
+        :rtype: EstatisticasConexoes
+        """
+        return EstatisticasConexoes(*[_somar_contadores(contadores) for contadores in zip(
+                *[_estatisticas_pool(cliente.connection_pool)
+                        for cliente in self._clientes()])])
+
+
+    def _clientes(self):
+        return list(self._nos.values())
+
+
+    def _cliente(self, chave):
+        return self._nos[self._anel.no(chave)]
+
+
+    def _agrupar(self, chaves):
+        grupos = OrderedDict()
+        for chave in chaves:
+            grupos.setdefault(self._anel.no(chave), []).append(chave)
+        return [(self._nos[no], grupo) for no, grupo in grupos.items()]
+
+
+class RenovacaoProgramada(object):
+    """
+    Renova periodicamente, em uma *thread* em segundo plano, os produtos e
+    serviços de um :class:`ProvisaoViaRedis` que estão prestes a expirar,
+    em pequenos lotes, de modo que a carga sobre o web services seja
+    distribuída ao longo do tempo ao invés de concentrada no momento em que
+    as chaves expiram. No máximo ``lote`` chaves são renovadas a cada
+    ``intervalo`` segundos.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaRedis(indexar_expiracoes=True,
+        ...         variacao_expiracao=0.1)  # doctest: +SKIP
+        >>> renovacao = RenovacaoProgramada(provisao)  # doctest: +SKIP
+        >>> renovacao.iniciar()  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, provisao, antecedencia=10 * 60, lote=50, intervalo=1):
+        self.provisao = provisao
+        self.antecedencia = antecedencia
+        self.lote = lote
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._thread = None
+
+
+    def executar(self):
+        """
+        Executa um único ciclo de renovação.
+
+        :return: O número de chaves renovadas.
+        """
+        return self.provisao.renovar(antecedencia=self.antecedencia,
+                lote=self.lote)
+
+
+    def iniciar(self):
+        """Inicia a *thread* de renovação, se ainda não estiver em execução."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._executar_continuamente,
+                name='ibptws-renovacao')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def parar(self, timeout=None):
+        """Interrompe a *thread* de renovação."""
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+    def _executar_continuamente(self):
+        while not self._parar.is_set():
+            try:
+                self.executar()
+            except Exception:
+                # falhas no Redis ou no web services não interrompem a
+                # renovação; as chaves serão tentadas no próximo ciclo
+                pass
+            self._parar.wait(self.intervalo)
+
+
+class InvalidacaoViaRedis(object):
+    """
+    Assina, em uma *thread* em segundo plano, o canal
+    :data:`CANAL_INVALIDACAO`, aplicando a um :class:`ProvisaoViaRedis` as
+    mudanças de versão da tabela do IBPT anunciadas por
+    :meth:`ProvisaoViaRedis.publicar_versao` em qualquer processo. Ao
+    iniciar, e sempre que a assinatura precisar ser refeita (após uma falha
+    de conexão, por exemplo), a versão gravada no Redis é relida, de modo
+    que uma mudança anunciada enquanto o processo não estava assinando o
+    canal não é perdida.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaRedis(versao='17.1.A')  # doctest: +SKIP
+        >>> InvalidacaoViaRedis(provisao).iniciar()  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, provisao, intervalo=1):
+        self.provisao = provisao
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._thread = None
+
+
+    def processar(self, mensagem):
+        """
+        Aplica uma mensagem recebida no canal.
+
+        :return: ``True`` se a versão mudou.
+        """
+        return self.provisao.mudar_versao(*_interpretar_versao(mensagem))
+
+
+    def iniciar(self):
+        """Inicia a *thread* que assina o canal, se ainda não estiver em
+        execução."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._executar_continuamente,
+                name='ibptws-invalidacao')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def parar(self, timeout=None):
+        """Cancela a assinatura do canal e interrompe a *thread*."""
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+    def _executar_continuamente(self):
+        while not self._parar.is_set():
+            try:
+                self._assinar()
+            except Exception:
+                # falhas no Redis não interrompem a assinatura, que é
+                # refeita após o intervalo
+                self._parar.wait(self.intervalo)
+
+
+    def _assinar(self):
+        self.provisao._connect()
+        cliente = self.provisao._cliente(VERSAO_TABELA)
+        pubsub = cliente.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CANAL_INVALIDACAO)
+            self.provisao.sincronizar_versao()
+            while not self._parar.is_set():
+                mensagem = pubsub.get_message(timeout=self.intervalo)
+                if mensagem is not None and mensagem['type'] == 'message':
+                    self.processar(mensagem['data'])
+        finally:
+            pubsub.close()
+
+
+class ProvisaoViaSQLite(ProvisaoBase):
+    """
+    Implementa um provisionamento baseado em um arquivo `SQLite`_, útil onde
+    não houver um servidor Redis disponível. Assim como em
+    :class:`ProvisaoViaRedis`, produtos e serviços não provisionados são
+    obtidos do web services do IBPT e então provisionados até que expirem.
+
+    O banco de dados é aberto em modo WAL (*write-ahead logging*), de modo
+    que vários processos na mesma máquina podem compartilhar o mesmo arquivo,
+    lendo simultaneamente enquanto um deles escreve. Cada *thread* utiliza
+    sua própria conexão. Os produtos e serviços são provisionados por
+    Estado, conforme :attr:`conf.estado` no momento da consulta.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoViaSQLite('/var/cache/ibptws.db')  # doctest: +SKIP
+        >>> calculadora = DeOlhoNoImposto(provisao=provisao)  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+
+    .. _`SQLite`: https://www.sqlite.org/
+    """
+
+    _ESQUEMA = (
+            'CREATE TABLE IF NOT EXISTS produtos ('
+                'ncm TEXT NOT NULL, '
+                'ex INTEGER NOT NULL, '
+                'uf TEXT NOT NULL, '
+                'codigo TEXT, '
+                'descricao TEXT, '
+                'nacional REAL, '
+                'importado REAL, '
+                'estadual REAL, '
+                'nao_encontrado TEXT, '
+                'expira_em REAL NOT NULL, '
+                'PRIMARY KEY (ncm, ex, uf))',
+            'CREATE INDEX IF NOT EXISTS produtos_expira_em '
+                'ON produtos (expira_em)',
+            'CREATE TABLE IF NOT EXISTS servicos ('
+                'nbs TEXT NOT NULL, '
+                'uf TEXT NOT NULL, '
+                'codigo TEXT, '
+                'descricao TEXT, '
+                'tipo TEXT, '
+                'nacional REAL, '
+                'importado REAL, '
+                'estadual REAL, '
+                'municipal REAL, '
+                'nao_encontrado TEXT, '
+                'expira_em REAL NOT NULL, '
+                'PRIMARY KEY (nbs, uf))',
+            'CREATE INDEX IF NOT EXISTS servicos_expira_em '
+                'ON servicos (expira_em)',)
+
+    def __init__(self, caminho, expires=EXPIRA_EM_24H,
+            expires_nao_encontrado=EXPIRA_EM_1H, timeout=10,
+            consulta_unica=None):
+        """
+        Inicia uma instância de :class:`ProvisaoViaSQLite`.
+
+        :param str caminho: Caminho para o arquivo do banco de dados, que
+            será criado se não existir.
+
+        :param int expires: Tempo, em segundos, que um produto ou serviço
+            permanece provisionado. Padrão é 24 horas.
+
+        :param int expires_nao_encontrado: Tempo, em segundos, que um produto
+            ou serviço não encontrado permanece provisionado como tal (veja
+            :class:`ProvisaoViaRedis`). Informe ``0`` para não provisionar.
+
+        :param float timeout: Tempo, em segundos, que uma conexão aguarda
+            enquanto o banco de dados estiver bloqueado por outro processo.
+
+        :param consulta_unica: Uma instância de :class:`ConsultaUnica`
+            (veja :class:`ProvisaoViaRedis`).
+        """
+        self._caminho = caminho
+        self._expires = expires
+        self._expires_nao_encontrado = expires_nao_encontrado
+        self._timeout = timeout
+        self._consultas = consulta_unica or ConsultaUnica()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conexoes = []
+        self._geracao = 0
+
+
+    def _conexao(self):
+        local = self._local
+        conexao = getattr(local, 'conexao', None)
+        if conexao is None or local.pid != os.getpid() or \
+                local.geracao != self._geracao:
+            conexao = sqlite3.connect(self._caminho, timeout=self._timeout,
+                    isolation_level=None, check_same_thread=False)
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('PRAGMA synchronous=NORMAL')
+            for instrucao in self._ESQUEMA:
+                conexao.execute(instrucao)
+            with self._lock:
+                # as conexões de todas as threads, para fechar()
+                self._conexoes.append((os.getpid(), conexao))
+                local.geracao = self._geracao
+            local.conexao = conexao
+            local.pid = os.getpid()
+        return conexao
+
+
+    def fechar(self):
+        """
+        Encerra as conexões de todas as *threads* (não deve ser invocado
+        durante uma consulta). As conexões são reabertas sob demanda, na
+        próxima consulta de cada *thread*. As conexões herdadas de um
+        processo bifurcado (*fork*) pertencem a ele e não são encerradas.
+        """
+        with self._lock:
+            conexoes, self._conexoes = self._conexoes, []
+            self._geracao += 1
+        for pid, conexao in conexoes:
+            if pid == os.getpid():
+                conexao.close()
+
+
+    def expurgar(self):
+        """Remove do banco de dados os produtos e serviços expirados."""
+        agora = time.time()
+        conexao = self._conexao()
+        with _transacao(conexao):
+            conexao.execute('DELETE FROM produtos WHERE expira_em <= ?',
+                    (agora,))
+            conexao.execute('DELETE FROM servicos WHERE expira_em <= ?',
+                    (agora,))
+
+
+    def provisionar_produtos(self, produtos, uf=None):
+        """
+        Provisiona vários produtos de uma só vez, em uma única transação.
+        Útil para aquecer o provisionamento, por exemplo, a partir de uma
+        tabela do IBPT (veja :mod:`ibptws.tabelas`).
+
+        :param produtos: Iterável de instâncias de
+            :class:`~ibptws.produtos.Produto`.
+
+        :param str uf: **Opcional** O Estado para o qual os produtos serão
+            provisionados. Padrão é :attr:`conf.estado`.
+        """
+        uf = uf or conf.estado
+        expira_em = time.time() + self._expires
+        conexao = self._conexao()
+        with _transacao(conexao):
+            conexao.executemany(
+                    'INSERT OR REPLACE INTO produtos (ncm, ex, uf, codigo, '
+                    'descricao, nacional, importado, estadual, '
+                    'nao_encontrado, expira_em) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+                    ((p.codigo, p.ex, uf, p.codigo, p.descricao, p.nacional,
+                            p.importado, p.estadual, expira_em)
+                            for p in produtos))
+
+
+    def provisionar_servicos(self, servicos, uf=None):
+        """
+        Provisiona vários serviços de uma só vez, em uma única transação.
+        Veja :meth:`provisionar_produtos`.
+        """
+        uf = uf or conf.estado
+        expira_em = time.time() + self._expires
+        conexao = self._conexao()
+        with _transacao(conexao):
+            conexao.executemany(
+                    'INSERT OR REPLACE INTO servicos (nbs, uf, codigo, '
+                    'descricao, tipo, nacional, importado, estadual, '
+                    'municipal, nao_encontrado, expira_em) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+                    ((s.codigo, uf, s.codigo, s.descricao, s.tipo,
+                            s.nacional, s.importado, s.estadual, s.municipal,
+                            expira_em) for s in servicos))
+
+
+    def _ler_produto(self, ncm, ncm_ex, uf):
+        registro = self._conexao().execute(
+                'SELECT codigo, descricao, nacional, importado, estadual, '
+                'nao_encontrado FROM produtos '
+                'WHERE ncm = ? AND ex = ? AND uf = ? AND expira_em > ?',
+                (str(ncm), int(ncm_ex), uf, time.time())).fetchone()
+        if registro is None:
+            return None
+        codigo, descricao, nacional, importado, estadual, erro = registro
+        if erro is not None:
+            raise ErroProdutoNaoEncontrado(erro)
+        return Produto(codigo=codigo, uf=uf, ex=int(ncm_ex),
+                descricao=descricao, nacional=nacional, importado=importado,
+                estadual=estadual)
+
+
+    def _ler_servico(self, nbs, uf):
+        registro = self._conexao().execute(
+                'SELECT codigo, descricao, tipo, nacional, importado, '
+                'estadual, municipal, nao_encontrado FROM servicos '
+                'WHERE nbs = ? AND uf = ? AND expira_em > ?',
+                (str(nbs), uf, time.time())).fetchone()
+        if registro is None:
+            return None
+        (codigo, descricao, tipo, nacional, importado, estadual, municipal,
+                erro) = registro
+        if erro is not None:
+            raise ErroServicoNaoEncontrado(erro)
+        return Servico(codigo=codigo, uf=uf, descricao=descricao, tipo=tipo,
+                nacional=nacional, importado=importado, estadual=estadual,
+                municipal=municipal)
+
+
+    def _gravar_produto(self, ncm, ncm_ex, uf, produto=None, erro=None):
+        expires = self._expires if erro is None else \
+                self._expires_nao_encontrado
+        self._conexao().execute(
+                'INSERT OR REPLACE INTO produtos (ncm, ex, uf, codigo, '
+                'descricao, nacional, importado, estadual, nao_encontrado, '
+                'expira_em) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(ncm), int(ncm_ex), uf)
+                + ((produto.codigo, produto.descricao, produto.nacional,
+                        produto.importado, produto.estadual)
+                        if produto else (None,) * 5)
+                + (erro, time.time() + expires))
+
+
+    def _gravar_servico(self, nbs, uf, servico=None, erro=None):
+        expires = self._expires if erro is None else \
+                self._expires_nao_encontrado
+        self._conexao().execute(
+                'INSERT OR REPLACE INTO servicos (nbs, uf, codigo, '
+                'descricao, tipo, nacional, importado, estadual, municipal, '
+                'nao_encontrado, expira_em) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(nbs), uf)
+                + ((servico.codigo, servico.descricao, servico.tipo,
+                        servico.nacional, servico.importado,
+                        servico.estadual, servico.municipal)
+                        if servico else (None,) * 7)
+                + (erro, time.time() + expires))
+
+
+    def get_produto(self, ncm, ncm_ex):
+        uf = conf.estado
+        produto = self._ler_instrumentado(self._ler_produto, ncm, ncm_ex, uf)
+        if produto is not None:
+            return produto
+
+        def provisionar():
+            produto = self._ler_produto(ncm, ncm_ex, uf)
+            if produto is not None:
+                return produto
+            try:
+                produto = get_produto(ncm, ncm_ex)
+            except ErroNaoEncontrado as ex:
+                if self._expires_nao_encontrado:
+                    self._gravar_produto(ncm, ncm_ex, uf, erro=str(ex))
+                raise
+            self._gravar_produto(ncm, ncm_ex, uf, produto=produto)
+            return produto
+
+        chave = 'ncm:{}:{}:{}'.format(uf, ncm, ncm_ex)
+        return self._consultas.executar(chave, provisionar)
+
+
+    def get_servico(self, nbs):
+        uf = conf.estado
+        servico = self._ler_instrumentado(self._ler_servico, nbs, uf)
+        if servico is not None:
+            return servico
+
+        def provisionar():
+            servico = self._ler_servico(nbs, uf)
+            if servico is not None:
+                return servico
+            try:
+                servico = get_servico(nbs)
+            except ErroNaoEncontrado as ex:
+                if self._expires_nao_encontrado:
+                    self._gravar_servico(nbs, uf, erro=str(ex))
+                raise
+            self._gravar_servico(nbs, uf, servico=servico)
+            return servico
+
+        chave = 'nbs:{}:{}'.format(uf, nbs)
+        return self._consultas.executar(chave, provisionar)
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        return self._ler_instrumentado(self._ler_produto, ncm, ncm_ex,
+                conf.estado)
+
+
+    def consultar_servico(self, nbs):
+        return self._ler_instrumentado(self._ler_servico, nbs, conf.estado)
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        if not isinstance(produto, ErroNaoEncontrado):
+            self._gravar_produto(ncm, ncm_ex, conf.estado, produto=produto)
+        elif self._expires_nao_encontrado:
+            self._gravar_produto(ncm, ncm_ex, conf.estado, erro=str(produto))
+
+
+    def provisionar_servico(self, nbs, servico):
+        if not isinstance(servico, ErroNaoEncontrado):
+            self._gravar_servico(nbs, conf.estado, servico=servico)
+        elif self._expires_nao_encontrado:
+            self._gravar_servico(nbs, conf.estado, erro=str(servico))
+
+
+class ProvisaoEmArquivo(ProvisaoBase):
+    """
+    Implementa um provisionamento persistente em um arquivo local, para
+    terminais sem servidor Redis: os produtos e serviços obtidos do web
+    services são acrescentados a um arquivo de registros (*append-only
+    log*), que é lido integralmente na primeira consulta. Assim, após
+    reiniciar, os produtos e serviços ainda não expirados são servidos sem
+    nenhum acesso à rede.
+
+    Vários processos podem compartilhar o mesmo arquivo: as escritas são
+    serializadas por uma trava de arquivo (``fcntl.flock``, em um arquivo
+    ``.trava`` ao lado do arquivo de registros) e cada processo lê os
+    registros acrescentados pelos demais antes de consultar o web services.
+    Os registros substituídos ou expirados são descartados periodicamente,
+    reescrevendo o arquivo (veja :meth:`compactar`). Em plataformas sem
+    ``fcntl`` não há trava entre processos. Os produtos e serviços são
+    provisionados por Estado, conforme :attr:`conf.estado`.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoEmArquivo('/var/cache/ibptws.log')  # doctest: +SKIP
+        >>> calculadora = DeOlhoNoImposto(provisao=provisao)  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    # crc32, expira em, tamanho da chave, tamanho dos dados
+    _REGISTRO = struct.Struct('<IdHI')
+
+    def __init__(self, caminho, expires=EXPIRA_EM_24H,
+            expires_nao_encontrado=EXPIRA_EM_1H, compactar_apos=1000,
+            sincronizar=False, consulta_unica=None):
+        """
+        Inicia uma instância de :class:`ProvisaoEmArquivo`.
+
+        :param str caminho: Caminho para o arquivo de registros, que será
+            criado se não existir.
+
+        :param int expires: Tempo, em segundos, que um produto ou serviço
+            permanece provisionado. Padrão é 24 horas.
+
+        :param int expires_nao_encontrado: Tempo, em segundos, que um produto
+            ou serviço não encontrado permanece provisionado como tal (veja
+            :class:`ProvisaoViaRedis`). Informe ``0`` para não provisionar.
+
+        :param int compactar_apos: O arquivo é compactado quando o número de
+            registros substituídos (por registros mais recentes da mesma
+            chave) ultrapassar este valor e o número de chaves provisionadas.
+
+        :param bool sincronizar: Se ``True``, cada registro é gravado em
+            disco (``fsync``) antes de a consulta retornar, protegendo-o de
+            uma queda de energia ao custo de escritas mais lentas.
+
+        :param consulta_unica: Uma instância de :class:`ConsultaUnica`
+            (veja :class:`ProvisaoViaRedis`).
+        """
+        self._caminho = caminho
+        self._expires = expires
+        self._expires_nao_encontrado = expires_nao_encontrado
+        self._compactar_apos = compactar_apos
+        self._sincronizar = sincronizar
+        self._consultas = consulta_unica or ConsultaUnica()
+        self._codec = CodecBinario(ler_legado=False)
+        self._lock = threading.RLock()
+        self._itens = {}
+        self._descartaveis = 0
+        self._posicao = 0
+        self._identidade = None
+
+
+    def _travar(self, exclusiva):
+        return _TravaArquivo(self._caminho + '.trava', exclusiva)
+
+
+    def _atualizar(self):
+        # lê os registros acrescentados desde a última leitura (por este ou
+        # por outros processos); se o arquivo foi compactado por outro
+        # processo, relê o arquivo inteiro. Deve ser chamado com self._lock
+        try:
+            estado = os.stat(self._caminho)
+        except OSError:
+            return
+        identidade = (estado.st_dev, estado.st_ino)
+        if identidade != self._identidade:
+            self._itens = {}
+            self._descartaveis = 0
+            self._posicao = 0
+            self._identidade = identidade
+        if estado.st_size <= self._posicao:
+            return
+        with open(self._caminho, 'rb') as arquivo:
+            arquivo.seek(self._posicao)
+            dados = arquivo.read()
+        self._posicao += self._interpretar(dados)
+
+
+    def _interpretar(self, dados):
+        # retorna o número de bytes de registros completos interpretados;
+        # um registro incompleto ou corrompido (uma escrita interrompida)
+        # encerra a leitura
+        posicao = 0
+        tamanho_registro = self._REGISTRO.size
+        while posicao + tamanho_registro <= len(dados):
+            crc, expira_em, tamanho_chave, tamanho_dados = \
+                    self._REGISTRO.unpack_from(dados, posicao)
+            inicio = posicao + tamanho_registro
+            fim = inicio + tamanho_chave + tamanho_dados
+            if fim > len(dados):
+                break
+            corpo = dados[posicao + 4:fim]
+            if zlib.crc32(corpo) & 0xffffffff != crc:
+                break
+            chave = dados[inicio:inicio + tamanho_chave].decode('utf-8')
+            if chave in self._itens:
+                self._descartaveis += 1
+            self._itens[chave] = (expira_em,
+                    dados[inicio + tamanho_chave:fim])
+            posicao = fim
+        return posicao
+
+
+    def _registro(self, chave, expira_em, dados):
+        chave = chave.encode('utf-8')
+        corpo = self._REGISTRO.pack(0, expira_em, len(chave),
+                len(dados))[4:] + chave + dados
+        return struct.pack('<I', zlib.crc32(corpo) & 0xffffffff) + corpo
+
+
+    def _ler(self, chave, classe_entidade):
+        item = self._itens.get(chave)
+        if item is None or item[0] <= time.time():
+            return None
+        return self._codec.decodificar(classe_entidade, item[1])
+
+
+    def _gravar(self, chave, valor):
+        if isinstance(valor, ErroNaoEncontrado):
+            if not self._expires_nao_encontrado:
+                return
+            expira_em = time.time() + self._expires_nao_encontrado
+        else:
+            expira_em = time.time() + self._expires
+        dados = self._codec.codificar(valor)
+        with self._lock, self._travar(exclusiva=True):
+            self._atualizar()
+            self._descartar_incompleto()
+            with open(self._caminho, 'ab') as arquivo:
+                arquivo.write(self._registro(chave, expira_em, dados))
+                arquivo.flush()
+                if self._sincronizar:
+                    os.fsync(arquivo.fileno())
+            self._atualizar()
+            if self._descartaveis > max(self._compactar_apos,
+                    len(self._itens)):
+                self._compactar()
+
+
+    def _descartar_incompleto(self):
+        # com a trava exclusiva, os bytes após o último registro completo
+        # são de uma escrita interrompida e são descartados; do contrário, os
+        # registros acrescentados a seguir jamais seriam lidos. Sem fcntl não
+        # há trava e a escrita pode estar em andamento em outro processo.
+        # Deve ser chamado com self._lock
+        if fcntl is None or self._identidade is None:
+            return
+        try:
+            tamanho = os.path.getsize(self._caminho)
+        except OSError:
+            return
+        if tamanho > self._posicao:
+            with open(self._caminho, 'r+b') as arquivo:
+                arquivo.truncate(self._posicao)
+
+
+    def compactar(self):
+        """
+        Reescreve o arquivo apenas com os registros válidos, descartando os
+        registros substituídos ou expirados.
+        """
+        with self._lock, self._travar(exclusiva=True):
+            self._atualizar()
+            self._compactar()
+
+
+    def _compactar(self):
+        agora = time.time()
+        temporario = '{}.{}.tmp'.format(self._caminho, os.getpid())
+        with open(temporario, 'wb') as arquivo:
+            for chave, (expira_em, dados) in self._itens.items():
+                if expira_em > agora:
+                    arquivo.write(self._registro(chave, expira_em, dados))
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        if hasattr(os, 'replace'):
+            os.replace(temporario, self._caminho)
+        else:
+            os.rename(temporario, self._caminho)
+        self._identidade = None
+        self._atualizar()
+
+
+    def _ler_carregado(self, chave, classe_entidade):
+        with self._lock:
+            if self._identidade is None:
+                # primeira consulta: carrega o arquivo inteiro
+                with self._travar(exclusiva=False):
+                    self._atualizar()
+            return self._ler(chave, classe_entidade)
+
+
+    def _get(self, chave, classe_entidade, metodo, *args):
+        entidade = self._ler_instrumentado(self._ler_carregado, chave,
+                classe_entidade)
+        if entidade is not None:
+            return entidade
+
+        def provisionar():
+            # outro processo pode ter provisionado a chave
+            with self._lock, self._travar(exclusiva=False):
+                self._atualizar()
+                entidade = self._ler(chave, classe_entidade)
+            if entidade is not None:
+                return entidade
+            try:
+                entidade = metodo(*args)
+            except ErroNaoEncontrado as ex:
+                self._gravar(chave, ex)
+                raise
+            self._gravar(chave, entidade)
+            return entidade
+
+        return self._consultas.executar(chave, provisionar)
+
+
+    def get_produto(self, ncm, ncm_ex):
+        chave = 'ncm:{}:{}:{}'.format(conf.estado, ncm, ncm_ex)
+        return self._get(chave, Produto, get_produto, ncm, ncm_ex)
+
+
+    def get_servico(self, nbs):
+        chave = 'nbs:{}:{}'.format(conf.estado, nbs)
+        return self._get(chave, Servico, get_servico, nbs)
+
+
+    def _consultar(self, chave, classe_entidade):
+        return self._ler_instrumentado(self._ler_atualizado, chave,
+                classe_entidade)
+
+
+    def _ler_atualizado(self, chave, classe_entidade):
+        with self._lock, self._travar(exclusiva=False):
+            self._atualizar()
+            return self._ler(chave, classe_entidade)
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        return self._consultar('ncm:{}:{}:{}'.format(
+                conf.estado, ncm, ncm_ex), Produto)
+
+
+    def consultar_servico(self, nbs):
+        return self._consultar('nbs:{}:{}'.format(conf.estado, nbs), Servico)
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        self._gravar('ncm:{}:{}:{}'.format(conf.estado, ncm, ncm_ex), produto)
+
+
+    def provisionar_servico(self, nbs, servico):
+        self._gravar('nbs:{}:{}'.format(conf.estado, nbs), servico)
+
+
+class ProvisaoEmCamadas(ProvisaoBase):
+    """
+    Compõe uma lista de provisionamentos em camadas, da mais rápida para a
+    mais lenta, por exemplo, memória, Redis, web services do IBPT e, por
+    fim, a tabela do IBPT em um arquivo local:
+
+    .. sourcecode:: python
+
+        >>> from ibptws.tabelas import ProvisaoTabelaLocal
+        >>> provisao = ProvisaoEmCamadas([
+        ...         ProvisaoEmMemoria(),
+        ...         (ProvisaoViaRedis(), 0.05),
+        ...         (SemProvisao(), 5),
+        ...         ProvisaoTabelaLocal('tabela.csv'),
+        ...     ])  # doctest: +SKIP
+
+    Cada camada é consultada em ordem através de
+    :meth:`~ProvisaoBase.consultar_produto` ou
+    :meth:`~ProvisaoBase.consultar_servico`, de modo que um provisionamento
+    que funciona como *cache* responde apenas com o que já tem provisionado.
+    A primeira camada que responder interrompe a consulta e a resposta é
+    gravada de volta em todas as camadas anteriores (mais rápidas), através
+    de :meth:`~ProvisaoBase.provisionar_produto` ou
+    :meth:`~ProvisaoBase.provisionar_servico`.
+
+    Um produto ou serviço não encontrado é uma resposta: também é gravado
+    nas camadas anteriores e a exceção é lançada. Já uma camada que falhar
+    (por exemplo, o Redis fora do ar ou o web services indisponível) ou que
+    exceder o seu tempo limite é simplesmente ignorada, passando-se à
+    camada seguinte. Se nenhuma camada responder, é lançado o último erro
+    ocorrido ou, não havendo erro, a exceção de não encontrado.
+
+    Cada camada pode ser um provisionamento ou uma tupla com o
+    provisionamento e o tempo limite, em segundos, para a sua consulta.
+    Camadas com tempo limite são consultadas em uma *thread* à parte; se o
+    tempo se esgotar a consulta continua em segundo plano, mas o seu
+    resultado é descartado.
+
+    A camada que respondeu a última consulta da *thread* corrente fica em
+    :attr:`ultima_camada` e o número de respostas de cada camada pode ser
+    obtido através de :meth:`respostas`. Se houver instrumentação, é
+    registrado também o contador ``camadas_respostas`` (rótulo ``camada``).
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, camadas, max_workers=None):
+        """
+        Inicia uma instância de :class:`ProvisaoEmCamadas`.
+
+        :param list camadas: Lista de provisionamentos ou de tuplas
+            ``(provisao, timeout)``, da camada mais rápida para a mais lenta.
+
+        :param int max_workers: **Opcional** Número máximo de *threads* para
+            as consultas às camadas com tempo limite. O padrão é uma
+            *thread* por camada com tempo limite.
+        """
+        self._camadas = []
+        for camada in camadas:
+            if isinstance(camada, ProvisaoBase):
+                camada = (camada, None)
+            provisao, timeout = camada
+            self._camadas.append((provisao, timeout))
+        if not self._camadas:
+            raise ValueError('Nenhuma camada informada')
+        self._max_workers = max_workers or max(1,
+                sum(1 for p, timeout in self._camadas if timeout is not None))
+        self._executor = None
+        self._pid = None
+        self._respostas = [0] * len(self._camadas)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+    @property
+    def camadas(self):
+        """Lista dos provisionamentos, na ordem em que são consultados."""
+        return [provisao for provisao, timeout in self._camadas]
+
+
+    @property
+    def ultima_camada(self):
+        """
+        Índice da camada que respondeu a última consulta da *thread*
+        corrente ou ``None`` se nenhuma camada respondeu.
+        """
+        return getattr(self._local, 'camada', None)
+
+
+    def respostas(self):
+        """
+        Retorna o número de consultas respondidas por cada camada.
+
+        :return: Lista de tuplas ``(provisao, respostas)``, na ordem das
+            camadas.
+        """
+        with self._lock:
+            return list(zip(self.camadas, self._respostas))
+
+
+    def get_produto(self, ncm, ncm_ex):
+        descricao = 'NCM={!r}, EX={!r}'.format(ncm, ncm_ex)
+        return self._get('consultar_produto', 'provisionar_produto',
+                ErroProdutoNaoEncontrado, descricao, ncm, ncm_ex)
+
+
+    def get_servico(self, nbs):
+        return self._get('consultar_servico', 'provisionar_servico',
+                ErroServicoNaoEncontrado, 'NBS/LC116={!r}'.format(nbs), nbs)
+
+
+    def consultar_produto(self, ncm, ncm_ex):
+        try:
+            return self.get_produto(ncm, ncm_ex)
+        except ErroNaoEncontrado:
+            if self.ultima_camada is None:
+                return None
+            raise
+
+
+    def consultar_servico(self, nbs):
+        try:
+            return self.get_servico(nbs)
+        except ErroNaoEncontrado:
+            if self.ultima_camada is None:
+                return None
+            raise
+
+
+    def provisionar_produto(self, ncm, ncm_ex, produto):
+        self._provisionar(len(self._camadas), 'provisionar_produto',
+                ncm, ncm_ex, produto)
+
+
+    def provisionar_servico(self, nbs, servico):
+        self._provisionar(len(self._camadas), 'provisionar_servico',
+                nbs, servico)
+
+
+    def _get(self, consultar, provisionar, classe_erro, descricao, *args):
+        self._local.camada = None
+        erros = []
+        valor = self._ler_instrumentado(self._ler_camadas, consultar,
+                provisionar, args, erros)
+        if isinstance(valor, ErroNaoEncontrado):
+            raise valor
+        if valor is not None:
+            return valor
+        if erros:
+            raise erros[-1]
+        raise classe_erro(descricao)
+
+
+    def _ler_camadas(self, consultar, provisionar, args, erros):
+        # retorna a resposta da primeira camada que tiver o item (inclusive
+        # uma exceção ErroNaoEncontrado) ou None, acrescentando a erros as
+        # falhas das camadas indisponíveis
+        for indice, (provisao, timeout) in enumerate(self._camadas):
+            try:
+                valor = self._consultar(getattr(provisao, consultar),
+                        timeout, args)
+            except ErroNaoEncontrado as ex:
+                valor = ex
+            except Exception as ex:
+                # camada indisponível ou tempo esgotado; tenta a seguinte
+                erros.append(ex)
+                continue
+
+            if valor is None:
+                continue
+
+            self._registrar(indice, provisao)
+            self._provisionar(indice, provisionar, *(args + (valor,)))
+            return valor
+
+        return None
+
+
+    def _consultar(self, metodo, timeout, args):
+        if timeout is None:
+            return metodo(*args)
+        return self._executor_camadas().submit(metodo, *args).result(timeout)
+
+
+    def _provisionar(self, indice, metodo, *args):
+        for provisao, timeout in self._camadas[:indice]:
+            try:
+                getattr(provisao, metodo)(*args)
+            except Exception:
+                # a gravação nas camadas anteriores é apenas uma otimização;
+                # uma falha não deve impedir a resposta
+                pass
+
+
+    def _registrar(self, indice, provisao):
+        self._local.camada = indice
+        with self._lock:
+            self._respostas[indice] += 1
+        instrumentacao = conf.instrumentacao
+        if instrumentacao is not None:
+            instrumentacao.contar('camadas_respostas',
+                    camada=type(provisao).__name__)
+
+
+    def _executor_camadas(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    # após um fork, as threads do executor herdado não
+                    # existem no processo filho
+                    self._executor = ThreadPoolExecutor(
+                            max_workers=self._max_workers)
+                    self._pid = os.getpid()
+        return self._executor
+
+
+    def encerrar(self, wait=True):
+        """Encerra as *threads* utilizadas nas consultas com tempo limite."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+class _TravaArquivo(object):
+
+    def __init__(self, caminho, exclusiva):
+        self._caminho = caminho
+        self._exclusiva = exclusiva
+        self._arquivo = None
+
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._arquivo = open(self._caminho, 'a')
+            fcntl.flock(self._arquivo.fileno(),
+                    fcntl.LOCK_EX if self._exclusiva else fcntl.LOCK_SH)
+        return self
+
+
+    def __exit__(self, tipo, valor, tb):
+        if self._arquivo is not None:
+            fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_UN)
+            self._arquivo.close()
+            self._arquivo = None
+
+
+class _transacao(object):
+
+    def __init__(self, conexao):
+        self._conexao = conexao
+
+    def __enter__(self):
+        self._conexao.execute('BEGIN IMMEDIATE')
+        return self._conexao
+
+    def __exit__(self, tipo, valor, tb):
+        self._conexao.execute('COMMIT' if tipo is None else 'ROLLBACK')
+
+
+def _em_lote(metodo, chaves):
+    resultados = OrderedDict()
+    for chave in chaves:
+        argumentos = chave if isinstance(chave, tuple) else (chave,)
+        try:
+            resultados[chave] = metodo(*argumentos)
+        except Exception as ex:
+            resultados[chave] = ex
+    return resultados
+
+
+# um produto ou serviço não encontrado, mantido em memória sem a instância
+# da exceção (e, portanto, sem o seu traceback)
+_NaoEncontrado = namedtuple('_NaoEncontrado', 'classe args')
+
+
+def _guardar(valor):
+    if isinstance(valor, ErroNaoEncontrado):
+        return _NaoEncontrado(type(valor), valor.args)
+    return valor
+
+
+def _restaurar(valor):
+    if isinstance(valor, _NaoEncontrado):
+        return valor.classe(*valor.args)
+    return valor
+
+
+_ERROS_NAO_ENCONTRADO = {
+        Produto: ErroProdutoNaoEncontrado,
+        Servico: ErroServicoNaoEncontrado,}
+
+
+def unicode_to_str(d):
+    """
+    Runs through dictionary keys, converting every unicode value to str.
+    """
+    convert = lambda v: v.encode('utf-8') if isinstance(v, unicode) else v
+    return {k: convert(v) for k, v in d.items()}
+
+
+def _texto(valor, formato_tamanho):
+    dados = valor.encode('utf-8')
+    return struct.pack('<' + formato_tamanho, len(dados)) + dados
+
+
+def _ler_texto(dados, posicao, formato_tamanho):
+    formato = '<' + formato_tamanho
+    tamanho, = struct.unpack_from(formato, dados, posicao)
+    inicio = posicao + struct.calcsize(formato)
+    return (bytes(dados[inicio:inicio + tamanho]).decode('utf-8'),
+            inicio + tamanho)
+
+
+def _hash(valor):
+    # estável entre processos, ao contrário de hash()
+    return int(hashlib.md5(valor.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _identificar_versao(versao):
+    # a identificação da versão da tabela que faz parte das chaves no Redis
+    if versao is not None and not isinstance(versao, (str, unicode)):
+        inicio = getattr(versao, 'vigencia_inicio', None)
+        versao = '{}@{}'.format(versao.versao or '',
+                inicio.strftime('%Y%m%d')) if inicio else versao.versao
+    if not versao:
+        return None
+    if '/' in versao or '|' in versao:
+        raise ValueError('Versão inválida: {!r}'.format(versao))
+    return versao
+
+
+def _versionar(versao, chave):
+    return chave if versao is None else '{}/{}'.format(versao, chave)
+
+
+def _versao_da_chave(chave):
+    return chave.rpartition('/')[0] or None
+
+
+def _sem_versao(chave):
+    return chave.rpartition('/')[2]
+
+
+def _mensagem_versao(versao, inicio, transicao):
+    return '{}|{!r}|{!r}'.format(versao or '', inicio, transicao)
+
+
+def _interpretar_versao(mensagem):
+    versao, inicio, transicao = _str(mensagem).rsplit('|', 2)
+    return versao or None, float(transicao), float(inicio)
+
+
+def _nome_cliente(cliente):
+    argumentos = cliente.connection_pool.connection_kwargs
+    if argumentos.get('path'):
+        return '{}/{}'.format(argumentos['path'], argumentos.get('db', 0))
+    return '{}:{}/{}'.format(argumentos.get('host', 'localhost'),
+            argumentos.get('port', 6379), argumentos.get('db', 0))
+
+
+def _str(valor):
+    return valor.decode('utf-8') if isinstance(valor, bytes) else valor
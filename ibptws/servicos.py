@@ -25,6 +25,7 @@ import requests
 from .config import conf
 from .excecoes import ErroIdentificacao
 from .excecoes import ErroServicoNaoEncontrado
+from .lotes import consultar_em_lote
 
 
 _Servico = namedtuple('_Servico',
@@ -79,10 +80,47 @@ def get_servico(codigo_nbs):
         expirado ou não estiverem corretos.
     """
 
-    response = requests.get(conf.endpoint.servicos, params=dict(
-            token=conf.token, cnpj=conf.cnpj, uf=conf.estado,
-            codigo=codigo_nbs))
+    instrumentacao = conf.instrumentacao
+    if instrumentacao is not None:
+        return instrumentacao.consulta('servicos', _consultar, codigo_nbs)
+    return _consultar(codigo_nbs)
 
+
+def get_servicos(codigos, max_workers=None):
+    """Consulta vários serviços de uma só vez. Os códigos repetidos são
+    consultados apenas uma vez e as consultas são feitas em paralelo.
+
+    :param codigos: Iterável de códigos NBS/LC116.
+
+    :param int max_workers: **Opcional** Número máximo de consultas
+        simultâneas (veja :attr:`Configuracoes.consultas_simultaneas`).
+
+    :return: Dicionário ordenado cujas chaves são os códigos NBS/LC116 e
+        cujos valores são instâncias de :class:`Servico` ou, se a consulta
+        daquele código falhar, a exceção lançada (por exemplo,
+        :class:`~ibptws.excecoes.ErroServicoNaoEncontrado`).
+
+    :rtype: collections.OrderedDict
+
+    .. versionadded:: 0.5
+    """
+    return consultar_em_lote(get_servico, codigos, max_workers=max_workers)
+
+
+def _consultar(codigo_nbs):
+    response = conf.transporte.get(conf.endpoint.servicos,
+            params=_parametros(codigo_nbs))
+    return _servico_da_resposta(response, codigo_nbs)
+
+
+def _parametros(codigo_nbs):
+    return dict(token=conf.token, cnpj=conf.cnpj, uf=conf.estado,
+            codigo=codigo_nbs)
+
+
+def _servico_da_resposta(response, codigo_nbs):
+    # interpreta a resposta do web services; compartilhado entre as
+    # consultas síncronas e assíncronas (veja ibptws.assincrono)
     if response.status_code == requests.codes.ok:
         data = response.json()
         return Servico(**{k.lower():v for k,v in data.items()})
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tabelas.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Leitura das tabelas de alíquotas publicadas semestralmente pelo IBPT, por
+Estado, como arquivos CSV (por exemplo, ``TabelaIBPTaxSP17.1.A.csv``), que
+permitem consultar os valores aproximados dos tributos sem acessar o web
+services.
+
+As tabelas também podem ser compiladas para um formato binário compacto
+(veja :func:`compilar_tabela`) que é mapeado em memória por
+:class:`ProvisaoTabelaCompilada`, de modo que a carga é praticamente
+instantânea e vários processos compartilham as mesmas páginas de memória
+através do *cache* do sistema operacional.
+
+.. versionadded:: 0.5
+"""
+
+import csv
+import io
+import mmap
+import os
+import re
+import struct
+
+from collections import namedtuple
+from datetime import date
+from datetime import datetime
+
+from .config import conf
+from .excecoes import ErroProdutoNaoEncontrado
+from .excecoes import ErroServicoNaoEncontrado
+from .produtos import Produto
+from .provisoes import ProvisaoBase
+from .servicos import Servico
+
+
+TIPO_NCM = '0'
+TIPO_NBS = '1'
+TIPO_LC116 = '2'
+
+TIPOS_SERVICO = {
+        TIPO_NBS: 'NBS',
+        TIPO_LC116: 'LC116',}
+
+_COLUNAS = {
+        'codigo': ('codigo',),
+        'ex': ('ex',),
+        'tipo': ('tipo', 'tabela'),
+        'descricao': ('descricao',),
+        'nacional': ('nacionalfederal', 'aliqnac'),
+        'importado': ('importadosfederal', 'aliqimp'),
+        'estadual': ('estadual',),
+        'municipal': ('municipal',),
+        'vigenciainicio': ('vigenciainicio',),
+        'vigenciafim': ('vigenciafim',),
+        'versao': ('versao',),}
+
+_UF_NO_NOME = re.compile(r'IBPTax([A-Z]{2})', re.IGNORECASE)
+
+ESCALA = 10000
+"""Escala das alíquotas no formato compilado, que são armazenadas como
+números inteiros (``4.2`` é armazenado como ``42000``)."""
+
+_ASSINATURA = b'IBPT'
+_FORMATO = 1
+
+# assinatura, formato, UF, versão da tabela, início e fim da vigência (dias
+# desde 01/01/0001, zero se ausente), quantidade de produtos e de serviços e
+# o deslocamento do início de cada seção: produtos, serviços e descrições
+_CABECALHO = struct.Struct('<4sH2s16sIIIIIII')
+
+# chave (NCM * 1000 + EX), alíquotas nacional, importado e estadual,
+# deslocamento e tamanho da descrição
+_PRODUTO = struct.Struct('<QIIIII')
+
+# chave (código * 100 + número de dígitos), tipo (0 NBS, 1 LC116),
+# alíquotas nacional, importado, estadual e municipal, deslocamento e
+# tamanho da descrição
+_SERVICO = struct.Struct('<QB3xIIIIII')
+
+_CHAVE = struct.Struct('<Q')
+
+_TIPOS_COMPILADOS = ('NBS', 'LC116')
+
+
+Tabela = namedtuple('Tabela',
+        'uf versao vigencia_inicio vigencia_fim produtos servicos')
+"""
+Conteúdo de uma tabela do IBPT. Os atributos ``produtos`` e ``servicos`` são
+dicionários cujas chaves são, respectivamente, tuplas ``(ncm, ex)`` e códigos
+NBS/LC116 normalizados (veja :func:`chave_produto` e :func:`chave_servico`).
+"""
+
+
+def chave_produto(ncm, ncm_ex):
+    """
+    Normaliza o código NCM e a exceção, compondo a chave do produto na
+    tabela. O NCM é sempre composto de oito dígitos.
+
+    .. sourcecode:: python
+
+        >>> chave_produto('2091021', '')
+        ('02091021', 0)
+        >>> chave_produto('0209.10.21', 1)
+        ('02091021', 1)
+
+    """
+    return (str(ncm).replace('.', '').strip().zfill(8), int(ncm_ex or 0))
+
+
+def chave_servico(nbs):
+    """
+    Normaliza o código NBS/LC116, compondo a chave do serviço na tabela.
+
+    .. sourcecode:: python
+
+        >>> chave_servico('1.0101.10.00')
+        '101011000'
+
+    """
+    return str(nbs).replace('.', '').strip()
+
+
+def ler_tabela(arquivo, uf=None, encoding='iso-8859-1'):
+    """
+    Lê uma tabela de alíquotas do IBPT no formato CSV, separado por ponto e
+    vírgula, com uma linha de cabeçalho.
+
+    :param arquivo: Caminho para o arquivo ou um objeto de arquivo (texto).
+
+    :param str uf: **Opcional** Sigla do Estado ao qual a tabela se refere.
+        Se não informado, será obtido do nome do arquivo (como em
+        ``TabelaIBPTaxSP17.1.A.csv``) ou, por fim, de :attr:`conf.estado`.
+
+    :param str encoding: Codificação do arquivo. As tabelas do IBPT são
+        distribuídas em ISO-8859-1.
+
+    :rtype: Tabela
+    """
+    if isinstance(arquivo, str):
+        uf = uf or _uf_do_nome(arquivo)
+        with io.open(arquivo, encoding=encoding, newline='') as f:
+            return _ler(f, uf)
+    return _ler(arquivo, uf or _uf_do_nome(getattr(arquivo, 'name', '')))
+
+
+def _uf_do_nome(caminho):
+    m = _UF_NO_NOME.search(os.path.basename(str(caminho)))
+    return m.group(1).upper() if m else None
+
+
+def _ler(f, uf):
+    uf = uf or conf.estado
+    leitor = csv.reader(f, delimiter=';')
+    indices = _indices(next(leitor))
+
+    i_codigo = indices['codigo']
+    i_ex = indices['ex']
+    i_tipo = indices['tipo']
+    i_descricao = indices['descricao']
+    i_nacional = indices['nacional']
+    i_importado = indices['importado']
+    i_estadual = indices.get('estadual')
+    i_municipal = indices.get('municipal')
+
+    produtos = {}
+    servicos = {}
+    primeira = None
+
+    for linha in leitor:
+        if not linha or not linha[i_codigo].strip():
+            continue
+        primeira = primeira or linha
+        tipo = linha[i_tipo].strip()
+        codigo = linha[i_codigo].strip()
+        nacional = _aliquota(linha[i_nacional])
+        importado = _aliquota(linha[i_importado])
+        estadual = (_aliquota(linha[i_estadual])
+                if i_estadual is not None else 0.0)
+        if tipo == TIPO_NCM:
+            chave = chave_produto(codigo, linha[i_ex].strip())
+            produtos[chave] = Produto(
+                    codigo=chave[0],
+                    uf=uf,
+                    ex=chave[1],
+                    descricao=linha[i_descricao],
+                    nacional=nacional,
+                    importado=importado,
+                    estadual=estadual)
+        elif tipo in TIPOS_SERVICO:
+            chave = chave_servico(codigo)
+            servicos[chave] = Servico(
+                    codigo=chave,
+                    uf=uf,
+                    descricao=linha[i_descricao],
+                    tipo=TIPOS_SERVICO[tipo],
+                    nacional=nacional,
+                    importado=importado,
+                    estadual=estadual,
+                    municipal=(_aliquota(linha[i_municipal])
+                            if i_municipal is not None else 0.0))
+
+    def coluna(nome, conversao=lambda v: v):
+        if primeira is None or nome not in indices:
+            return None
+        return conversao(primeira[indices[nome]].strip())
+
+    return Tabela(
+            uf=uf,
+            versao=coluna('versao'),
+            vigencia_inicio=coluna('vigenciainicio', _data),
+            vigencia_fim=coluna('vigenciafim', _data),
+            produtos=produtos,
+            servicos=servicos)
+
+
+def _indices(cabecalho):
+    nomes = [c.strip().lower() for c in cabecalho]
+    indices = {}
+    for coluna, alternativas in _COLUNAS.items():
+        for nome in alternativas:
+            if nome in nomes:
+                indices[coluna] = nomes.index(nome)
+                break
+    faltando = {'codigo', 'ex', 'tipo', 'descricao', 'nacional', 'importado'}
+    faltando.difference_update(indices)
+    if faltando:
+        raise ValueError('Tabela IBPT sem as colunas: {}'.format(
+                ', '.join(sorted(faltando))))
+    return indices
+
+
+def _aliquota(valor):
+    valor = valor.strip()
+    return float(valor.replace(',', '.')) if valor else 0.0
+
+
+def _data(valor):
+    try:
+        return datetime.strptime(valor, '%d/%m/%Y').date()
+    except ValueError:
+        return None
+
+
+class ProvisaoTabelaLocal(ProvisaoBase):
+    """
+    Implementa um provisionamento baseado na tabela de alíquotas publicada
+    pelo IBPT (veja :func:`ler_tabela`). A tabela é carregada inteiramente
+    em memória, de modo que as consultas a produtos e serviços não acessam a
+    rede e retornam as mesmas instâncias de
+    :class:`~ibptws.produtos.Produto` e :class:`~ibptws.servicos.Servico`
+    que seriam obtidas do web services.
+
+    .. sourcecode:: python
+
+        >>> provisao = ProvisaoTabelaLocal('TabelaIBPTaxSP17.1.A.csv')  # doctest: +SKIP
+        >>> calculadora = DeOlhoNoImposto(provisao=provisao)  # doctest: +SKIP
+
+    Note que a tabela reflete o Estado e o semestre para os quais foi
+    publicada; uma nova tabela deverá ser obtida a cada semestre.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, arquivo, uf=None, encoding='iso-8859-1'):
+        """
+        Inicia uma instância de :class:`ProvisaoTabelaLocal`, lendo a tabela
+        de alíquotas. Os argumentos são os mesmos de :func:`ler_tabela`.
+        """
+        self.tabela = ler_tabela(arquivo, uf=uf, encoding=encoding)
+
+
+    def get_produto(self, ncm, ncm_ex):
+        return self._ler_instrumentado(self._ler_produto, ncm, ncm_ex)
+
+
+    def get_servico(self, nbs):
+        return self._ler_instrumentado(self._ler_servico, nbs)
+
+
+    def _ler_produto(self, ncm, ncm_ex):
+        try:
+            return self.tabela.produtos[chave_produto(ncm, ncm_ex)]
+        except KeyError:
+            raise ErroProdutoNaoEncontrado('NCM={!r}, EX={!r}'.format(
+                    ncm, ncm_ex))
+
+
+    def _ler_servico(self, nbs):
+        try:
+            return self.tabela.servicos[chave_servico(nbs)]
+        except KeyError:
+            raise ErroServicoNaoEncontrado('NBS/LC116={!r}'.format(nbs))
+
+
+
+def compilar_tabela(origem, destino, uf=None, encoding='iso-8859-1'):
+    """
+    Compila uma tabela do IBPT para o formato binário lido por
+    :class:`ProvisaoTabelaCompilada`. O arquivo resultante contém os
+    produtos e os serviços em registros de tamanho fixo, ordenados pela
+    chave numérica, com as alíquotas em ponto fixo (veja :data:`ESCALA`) e
+    as descrições, sem repetições, em uma área à parte.
+
+    :param origem: Uma instância de :class:`Tabela` ou qualquer argumento
+        aceito por :func:`ler_tabela`, caso em que os argumentos ``uf`` e
+        ``encoding`` também serão repassados.
+
+    :param str destino: Caminho do arquivo compilado. O arquivo é escrito em
+        um arquivo temporário e então renomeado, de modo que processos que
+        já o tenham mapeado não sejam afetados.
+
+    :raises ValueError: se alguma alíquota tiver mais casas decimais do que
+        o formato compilado é capaz de representar.
+    """
+    tabela = origem if isinstance(origem, Tabela) else ler_tabela(
+            origem, uf=uf, encoding=encoding)
+
+    descricoes = bytearray()
+    internadas = {}
+
+    def internar(descricao):
+        dados = descricao.encode('utf-8')
+        if dados not in internadas:
+            internadas[dados] = len(descricoes)
+            descricoes.extend(dados)
+        return internadas[dados], len(dados)
+
+    produtos = []
+    for (ncm, ex), p in tabela.produtos.items():
+        produtos.append((int(ncm) * 1000 + ex,
+                _fixo(p.nacional), _fixo(p.importado), _fixo(p.estadual))
+                + internar(p.descricao))
+    produtos.sort()
+
+    servicos = []
+    for codigo, s in tabela.servicos.items():
+        servicos.append((int(codigo) * 100 + len(codigo),
+                _TIPOS_COMPILADOS.index(s.tipo),
+                _fixo(s.nacional), _fixo(s.importado),
+                _fixo(s.estadual), _fixo(s.municipal))
+                + internar(s.descricao))
+    servicos.sort()
+
+    inicio_produtos = _CABECALHO.size
+    inicio_servicos = inicio_produtos + len(produtos) * _PRODUTO.size
+    inicio_descricoes = inicio_servicos + len(servicos) * _SERVICO.size
+
+    temporario = '{}.{}.tmp'.format(destino, os.getpid())
+    with open(temporario, 'wb') as f:
+        f.write(_CABECALHO.pack(
+                _ASSINATURA,
+                _FORMATO,
+                (tabela.uf or '').encode('ascii')[:2],
+                (tabela.versao or '').encode('ascii')[:16],
+                tabela.vigencia_inicio.toordinal()
+                        if tabela.vigencia_inicio else 0,
+                tabela.vigencia_fim.toordinal()
+                        if tabela.vigencia_fim else 0,
+                len(produtos),
+                len(servicos),
+                inicio_produtos,
+                inicio_servicos,
+                inicio_descricoes))
+        for registro in produtos:
+            f.write(_PRODUTO.pack(*registro))
+        for registro in servicos:
+            f.write(_SERVICO.pack(*registro))
+        f.write(bytes(descricoes))
+
+    _substituir(temporario, destino)
+
+
+def _fixo(aliquota):
+    valor = int(round(aliquota * ESCALA))
+    if abs(aliquota * ESCALA - valor) > 1e-6:
+        raise ValueError('Aliquota {!r} excede a precisao do formato '
+                'compilado'.format(aliquota))
+    return valor
+
+
+def _substituir(origem, destino):
+    if hasattr(os, 'replace'):
+        os.replace(origem, destino)
+    else:
+        if os.path.exists(destino):
+            os.remove(destino)
+        os.rename(origem, destino)
+
+
+class ProvisaoTabelaCompilada(ProvisaoBase):
+    """
+    Implementa um provisionamento baseado em uma tabela do IBPT compilada
+    por :func:`compilar_tabela`. O arquivo é mapeado em memória (``mmap``) e
+    as consultas são feitas por busca binária diretamente sobre o
+    mapeamento, sem carregar a tabela para dentro do processo. Assim, a
+    carga é praticamente instantânea e todos os processos que utilizarem o
+    mesmo arquivo compartilham as mesmas páginas de memória.
+
+    .. sourcecode:: python
+
+        >>> compilar_tabela('TabelaIBPTaxSP17.1.A.csv', 'ibpt-sp.bin')  # doctest: +SKIP
+        >>> provisao = ProvisaoTabelaCompilada('ibpt-sp.bin')  # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, caminho):
+        """
+        Inicia uma instância de :class:`ProvisaoTabelaCompilada`, mapeando
+        o arquivo compilado em memória.
+
+        :param str caminho: Caminho para o arquivo compilado.
+
+        :raises ValueError: se o arquivo não for uma tabela compilada.
+        """
+        with open(caminho, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _CABECALHO.size:
+                # inclui o arquivo vazio, que não pode ser mapeado
+                raise ValueError('{!r} nao e uma tabela IBPT compilada'.format(
+                        caminho))
+            self._mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (assinatura, formato, uf, versao, inicio, fim,
+                self._n_produtos, self._n_servicos,
+                self._inicio_produtos, self._inicio_servicos,
+                self._inicio_descricoes) = _CABECALHO.unpack_from(self._mapa)
+
+        if assinatura != _ASSINATURA or formato != _FORMATO:
+            self.fechar()
+            raise ValueError('{!r} nao e uma tabela IBPT compilada'.format(
+                    caminho))
+
+        self.uf = uf.rstrip(b'\0').decode('ascii')
+        self.versao = versao.rstrip(b'\0').decode('ascii') or None
+        self.vigencia_inicio = date.fromordinal(inicio) if inicio else None
+        self.vigencia_fim = date.fromordinal(fim) if fim else None
+
+
+    def fechar(self):
+        """Desfaz o mapeamento do arquivo compilado."""
+        self._mapa.close()
+
+
+    def _buscar(self, inicio, quantidade, tamanho, chave):
+        mapa = self._mapa
+        baixo, alto = 0, quantidade
+        while baixo < alto:
+            meio = (baixo + alto) // 2
+            if _CHAVE.unpack_from(mapa, inicio + meio * tamanho)[0] < chave:
+                baixo = meio + 1
+            else:
+                alto = meio
+        if baixo < quantidade:
+            deslocamento = inicio + baixo * tamanho
+            if _CHAVE.unpack_from(mapa, deslocamento)[0] == chave:
+                return deslocamento
+        return None
+
+
+    def _descricao(self, deslocamento, tamanho):
+        inicio = self._inicio_descricoes + deslocamento
+        return self._mapa[inicio:inicio + tamanho].decode('utf-8')
+
+
+    def get_produto(self, ncm, ncm_ex):
+        return self._ler_instrumentado(self._ler_produto, ncm, ncm_ex)
+
+
+    def get_servico(self, nbs):
+        return self._ler_instrumentado(self._ler_servico, nbs)
+
+
+    def _ler_produto(self, ncm, ncm_ex):
+        codigo, ex = chave_produto(ncm, ncm_ex)
+        deslocamento = None
+        if codigo.isdigit():
+            deslocamento = self._buscar(self._inicio_produtos,
+                    self._n_produtos, _PRODUTO.size, int(codigo) * 1000 + ex)
+        if deslocamento is None:
+            raise ErroProdutoNaoEncontrado('NCM={!r}, EX={!r}'.format(
+                    ncm, ncm_ex))
+        (_, nacional, importado, estadual, inicio_descricao,
+                tamanho_descricao) = _PRODUTO.unpack_from(
+                        self._mapa, deslocamento)
+        return Produto(
+                codigo=codigo,
+                uf=self.uf,
+                ex=ex,
+                descricao=self._descricao(inicio_descricao, tamanho_descricao),
+                nacional=nacional / float(ESCALA),
+                importado=importado / float(ESCALA),
+                estadual=estadual / float(ESCALA))
+
+
+    def _ler_servico(self, nbs):
+        codigo = chave_servico(nbs)
+        deslocamento = None
+        if codigo.isdigit():
+            deslocamento = self._buscar(self._inicio_servicos,
+                    self._n_servicos, _SERVICO.size,
+                    int(codigo) * 100 + len(codigo))
+        if deslocamento is None:
+            raise ErroServicoNaoEncontrado('NBS/LC116={!r}'.format(nbs))
+        (_, tipo, nacional, importado, estadual, municipal,
+                inicio_descricao, tamanho_descricao) = _SERVICO.unpack_from(
+                        self._mapa, deslocamento)
+        return Servico(
+                codigo=codigo,
+                uf=self.uf,
+                descricao=self._descricao(inicio_descricao, tamanho_descricao),
+                tipo=_TIPOS_COMPILADOS[tipo],
+                nacional=nacional / float(ESCALA),
+                importado=importado / float(ESCALA),
+                estadual=estadual / float(ESCALA),
+                municipal=municipal / float(ESCALA))
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tests/test_assincrono.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import fakeredis
+import requests
+
+from ibptws.config import conf
+from ibptws.excecoes import ErroIdentificacao
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.excecoes import ErroServicoIndisponivel
+from ibptws.excecoes import ErroServicoNaoEncontrado
+from ibptws.assincrono import RespostaAssincrona
+from ibptws.assincrono import TransporteAIOHTTP
+from ibptws.assincrono import TransporteAssincronoBase
+from ibptws.assincrono import get_produto_async
+from ibptws.assincrono import get_servico_async
+from ibptws.assincrono import ProvisaoViaRedisAssincrona
+from ibptws.provisoes import CodecBinario
+from ibptws.provisoes import ProvisaoViaRedis
+
+
+class TransporteAssincronoMockup(TransporteAssincronoBase):
+
+    def __init__(self, dados, status_code=requests.codes.ok):
+        self.dados = dados
+        self.status_code = status_code
+        self.requisicoes = []
+
+    async def get(self, url, params=None):
+        self.requisicoes.append((url, params))
+        await asyncio.sleep(0)
+        return RespostaAssincrona(url, self.status_code,
+                json.dumps(self.dados).encode('utf-8'))
+
+
+def test_transporte_aiohttp():
+    web = pytest.importorskip('aiohttp.web')
+
+    async def produtos(request):
+        return web.json_response(dict(request.query))
+
+    async def consultar(transporte, fechar=False):
+        aplicacao = web.Application()
+        aplicacao.router.add_get('/produtos', produtos)
+        runner = web.AppRunner(aplicacao)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        try:
+            url = 'http://127.0.0.1:{}/produtos'.format(runner.addresses[0][1])
+            resposta = await transporte.get(url, params=dict(
+                    codigo='12340101', ex=0))
+            if fechar:
+                await transporte.fechar()
+            return resposta
+        finally:
+            await runner.cleanup()
+
+    transporte = TransporteAIOHTTP(max_simultaneas=2)
+    resposta = asyncio.run(consultar(transporte))
+    assert resposta.status_code == requests.codes.ok
+    assert resposta.json() == {'codigo': '12340101', 'ex': '0'}
+    (sessao, _), = transporte._sessoes.values()
+
+    # em outro event loop, uma nova sessão; a do event loop encerrado é
+    # descartada
+    resposta = asyncio.run(consultar(transporte, fechar=True))
+    assert resposta.status_code == requests.codes.ok
+    assert sessao.closed
+    assert not transporte._sessoes
+
+
+def test_transporte_aiohttp_threads():
+    web = pytest.importorskip('aiohttp.web')
+
+    async def produtos(request):
+        await asyncio.sleep(0.02)
+        return web.json_response(dict(request.query))
+
+    # o servidor executa no seu próprio event loop, em outra thread
+    servidor = asyncio.new_event_loop()
+    aplicacao = web.Application()
+    aplicacao.router.add_get('/produtos', produtos)
+    runner = web.AppRunner(aplicacao)
+    servidor.run_until_complete(runner.setup())
+    servidor.run_until_complete(
+            web.TCPSite(runner, '127.0.0.1', 0).start())
+    url = 'http://127.0.0.1:{}/produtos'.format(runner.addresses[0][1])
+    thread_servidor = threading.Thread(target=servidor.run_forever)
+    thread_servidor.start()
+
+    transporte = TransporteAIOHTTP()
+    barreira = threading.Barrier(2)
+    resultados = {}
+    sessoes = {}
+
+    async def consultar(nome):
+        barreira.wait()
+        respostas = []
+        for i in range(10):
+            resposta = await transporte.get(url, params=dict(codigo=nome, ex=i))
+            respostas.append(resposta.json())
+        sessoes[nome] = transporte._sessoes[asyncio.get_running_loop()][0]
+        # aguarda a outra thread antes de encerrar o seu event loop
+        barreira.wait()
+        return respostas
+
+    def executar(nome):
+        resultados[nome] = asyncio.run(consultar(nome))
+
+    threads = [threading.Thread(target=executar, args=(nome,))
+            for nome in ('a', 'b')]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        servidor.call_soon_threadsafe(servidor.stop)
+        thread_servidor.join()
+        servidor.run_until_complete(runner.cleanup())
+        servidor.close()
+
+    # cada thread usou sua própria sessão, sem interromper a da outra
+    for nome in ('a', 'b'):
+        assert resultados[nome] == [{'codigo': nome, 'ex': str(i)}
+                for i in range(10)]
+    assert sessoes['a'] is not sessoes['b']
+
+    asyncio.run(transporte.fechar())
+    assert sessoes['a'].closed and sessoes['b'].closed
+    assert not transporte._sessoes
+
+
+def test_transporte_aiohttp_repeticao():
+    aiohttp = pytest.importorskip('aiohttp')
+    web = pytest.importorskip('aiohttp.web')
+    respostas = []
+
+    async def produtos(request):
+        respostas.append(request.query['codigo'])
+        if request.query['codigo'] == 'lento':
+            await asyncio.sleep(1)
+        if len(respostas) == 1:
+            return web.json_response({}, status=requests.codes.unavailable)
+        return web.json_response(dict(request.query))
+
+    async def consultar(transporte):
+        aplicacao = web.Application()
+        aplicacao.router.add_get('/produtos', produtos)
+        runner = web.AppRunner(aplicacao)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        porta = runner.addresses[0][1]
+        url = 'http://127.0.0.1:{}/produtos'.format(porta)
+        resultados = []
+        try:
+            # HTTP 503 é repetido
+            resposta = await transporte.get(url, params=dict(codigo='1'))
+            resultados.append((resposta.status_code, list(respostas)))
+
+            # o tempo limite de leitura interrompe a requisição
+            inicio = time.time()
+            with pytest.raises(asyncio.TimeoutError):
+                await transporte.get(url, params=dict(codigo='lento'))
+            resultados.append(time.time() - inicio)
+        finally:
+            await runner.cleanup()
+
+        # sem o servidor, as falhas de conexão abrem o disjuntor
+        with pytest.raises(aiohttp.ClientConnectionError):
+            await transporte.get(url)
+        assert transporte.disjuntor(url).aberto
+        with pytest.raises(ErroServicoIndisponivel):
+            await transporte.get(url)
+        await transporte.fechar()
+        return resultados
+
+    transporte = TransporteAIOHTTP(timeout=(1, 0.2), max_tentativas=2,
+            espera_inicial=0, limite_falhas=2, tempo_recuperacao=60)
+    (status, requisicoes), duracao = asyncio.run(consultar(transporte))
+    assert status == requests.codes.ok
+    assert requisicoes == ['1', '1']
+    assert duracao < 1
+
+
+def test_importacao_sob_demanda():
+    # import ibptws não carrega as consultas assíncronas (nem aiohttp e redis)
+    codigo = (
+            'import sys, ibptws\n'
+            'assert "ibptws.assincrono" not in sys.modules\n'
+            'assert "aiohttp" not in sys.modules\n'
+            'assert "redis" not in sys.modules\n'
+            'from ibptws import get_produto_async, get_servico_async\n'
+            'assert "ibptws.assincrono" in sys.modules\n'
+            'assert not hasattr(ibptws, "get_produto_sincrono")\n')
+    subprocess.check_call([sys.executable, '-c', codigo])
+    import ibptws
+    assert ibptws.get_produto_async is get_produto_async
+    assert ibptws.get_servico_async is get_servico_async
+
+
+def test_produto_sucesso(monkeypatch):
+    transporte = TransporteAssincronoMockup(pytest.RESPOSTA_SUCESSO_PRODUTO())
+    monkeypatch.setattr(conf, 'transporte_assincrono', transporte)
+    produto = asyncio.run(get_produto_async('12340101'))
+    assert produto.codigo == '12340101'
+    assert produto.ex == 0
+    assert transporte.requisicoes[0][0] == conf.endpoint.produtos
+
+
+def test_servico_sucesso(monkeypatch):
+    transporte = TransporteAssincronoMockup(pytest.RESPOSTA_SUCESSO_SERVICO())
+    monkeypatch.setattr(conf, 'transporte_assincrono', transporte)
+    servico = asyncio.run(get_servico_async('0123'))
+    assert servico.codigo == '0123'
+    assert servico.tipo == 'NBS'
+
+
+def test_consultas_simultaneas(monkeypatch):
+    transporte = TransporteAssincronoMockup(pytest.RESPOSTA_SUCESSO_PRODUTO())
+    monkeypatch.setattr(conf, 'transporte_assincrono', transporte)
+
+    async def consultar():
+        return await asyncio.gather(*[
+                get_produto_async('12340101') for i in range(50)])
+
+    produtos = asyncio.run(consultar())
+    assert len(produtos) == 50
+    assert len(transporte.requisicoes) == 50
+
+
+def test_erros(monkeypatch):
+    monkeypatch.setattr(conf, 'transporte_assincrono',
+            TransporteAssincronoMockup({}, requests.codes.not_found))
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        asyncio.run(get_produto_async('12340101'))
+    with pytest.raises(ErroServicoNaoEncontrado):
+        asyncio.run(get_servico_async('0123'))
+
+    monkeypatch.setattr(conf, 'transporte_assincrono',
+            TransporteAssincronoMockup({}, requests.codes.forbidden))
+    with pytest.raises(ErroIdentificacao):
+        asyncio.run(get_produto_async('12340101'))
+
+    monkeypatch.setattr(conf, 'transporte_assincrono',
+            TransporteAssincronoMockup({}, requests.codes.teapot))
+    with pytest.raises(requests.HTTPError):
+        asyncio.run(get_servico_async('0123'))
+
+
+class TransporteProdutosMockup(TransporteAssincronoBase):
+
+    def __init__(self):
+        self.requisicoes = []
+
+    async def get(self, url, params=None):
+        self.requisicoes.append(params['codigo'])
+        await asyncio.sleep(0.01)
+        if params['codigo'] == '99999999':
+            return RespostaAssincrona(url, requests.codes.not_found, b'{}')
+        dados = pytest.RESPOSTA_SUCESSO_PRODUTO()
+        if url == conf.endpoint.servicos:
+            dados = pytest.RESPOSTA_SUCESSO_SERVICO()
+        return RespostaAssincrona(url, requests.codes.ok,
+                json.dumps(dados).encode('utf-8'))
+
+
+@pytest.mark.skipif(not hasattr(fakeredis, 'FakeAsyncRedis'),
+        reason='requer fakeredis 2.0+')
+@pytest.mark.parametrize('codec', [None, CodecBinario()])
+def test_provisaoviaredis_assincrona(monkeypatch, codec):
+    transporte = TransporteProdutosMockup()
+    monkeypatch.setattr(conf, 'transporte_assincrono', transporte)
+    servidor = fakeredis.FakeServer()
+    provisao = ProvisaoViaRedisAssincrona(codec=codec,
+            redis=fakeredis.FakeAsyncRedis(server=servidor))
+
+    async def consultar():
+        produtos = await asyncio.gather(*[
+                provisao.get_produto('12340101', 0) for i in range(10)])
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            await provisao.get_produto('99999999', 0)
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            await provisao.get_produto('99999999', 0)
+        lote = await provisao.get_produtos([('12340101', 0),
+                ('12340202', 0), ('99999999', 0)])
+        servicos = await provisao.get_servicos(['0123', '0123'])
+        return produtos, lote, servicos
+
+    produtos, lote, servicos = asyncio.run(consultar())
+    assert all(produto == produtos[0] for produto in produtos)
+    assert lote[('12340101', 0)] == produtos[0]
+    assert lote[('12340202', 0)].codigo == '12340101'
+    assert isinstance(lote[('99999999', 0)], ErroProdutoNaoEncontrado)
+    assert list(servicos.keys()) == ['0123']
+    assert transporte.requisicoes == [
+            '12340101', '99999999', '12340202', '0123']
+
+    # processos síncronos leem o mesmo provisionamento
+    sincrona = ProvisaoViaRedis(codec=codec,
+            redis=fakeredis.FakeStrictRedis(server=servidor))
+    assert sincrona.get_produto('12340101', 0) == produtos[0]
+    assert sincrona.get_servico('0123') == servicos['0123']
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        sincrona.get_produto('99999999', 0)
+    asyncio.run(provisao.fechar())
+
+
+@pytest.mark.skipif(not hasattr(fakeredis, 'FakeAsyncRedis'),
+        reason='requer fakeredis 2.0+')
+def test_provisaoviaredis_assincrona_versao(monkeypatch):
+    transporte = TransporteProdutosMockup()
+    monkeypatch.setattr(conf, 'transporte_assincrono', transporte)
+    servidor = fakeredis.FakeServer()
+    sincrona = ProvisaoViaRedis(versao='17.1.A',
+            redis=fakeredis.FakeStrictRedis(server=servidor))
+    provisao = ProvisaoViaRedisAssincrona(versao='17.1.A',
+            redis=fakeredis.FakeAsyncRedis(server=servidor))
+
+    async def consultar(*chaves):
+        return [await provisao.get_produto(ncm, 0) for ncm in chaves]
+
+    # as mesmas chaves versionadas de ProvisaoViaRedis
+    produto = asyncio.run(consultar('12340101'))[0]
+    assert sincrona.consultar_produto('12340101', 0) == produto
+
+    # durante a transição, as chaves da versão anterior continuam sendo lidas
+    sincrona.publicar_versao('17.2.A', transicao=3600)
+    assert asyncio.run(provisao.sincronizar_versao())
+    assert provisao.versao == '17.2.A'
+    asyncio.run(consultar('12340101'))
+    assert transporte.requisicoes == ['12340101']
+
+    # após a transição, são consultadas novamente na nova versão
+    provisao.mudar_versao('17.3.A')
+    asyncio.run(consultar('12340101'))
+    assert transporte.requisicoes == ['12340101', '12340101']
+    assert asyncio.run(provisao.sincronizar_versao())
+    assert provisao.versao == '17.2.A'
+    asyncio.run(provisao.fechar())
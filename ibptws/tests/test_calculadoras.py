@@ -17,14 +17,26 @@
 # limitations under the License.
 #
 
+import pickle
+import random
+
 from decimal import Decimal
+from functools import reduce
 
 import pytest
 
 import requests
 
+from ibptws.config import conf
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.produtos import Produto
+from ibptws.provisoes import ProvisaoBase
+from ibptws.servicos import Servico
 from ibptws.calculadoras import DeOlhoNoImposto
 from ibptws.calculadoras import CEM
+from ibptws.calculadoras import Resultado
+from ibptws.calculadoras import calcular_cupons
+from ibptws.calculadoras import ZERO
 
 
 def test_deolhonoimposto_inicio():
@@ -42,7 +54,7 @@ def test_deolhonoimposto_inicio():
 def test_deolhonoimposto_um_item(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_produto
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     
     valor = Decimal('10') # subtotal do produto
     
@@ -90,7 +102,7 @@ def test_deolhonoimposto_multiplos_itens(monkeypatch):
                 '0123': pytest.instancia_resp_sucesso_servico,
                 '0124': pytest.instancia_resp_sucesso_servico_alt_a,}
         return dados.get(params.get('codigo'))
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     
     calc = DeOlhoNoImposto()
 
@@ -190,3 +202,198 @@ def test_deolhonoimposto_multiplos_itens(monkeypatch):
     assert calc.total_tributos().is_zero()
     assert calc.total().is_zero()
     assert calc.percentual_sobre_total().is_zero()
+
+
+def test_deolhonoimposto_em_lote(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        dados = {
+                '12340101': pytest.instancia_resp_sucesso_produto,
+                '12340202': pytest.instancia_resp_sucesso_produto_alt_a,
+                '0123': pytest.instancia_resp_sucesso_servico,
+                '0124': pytest.instancia_resp_sucesso_servico_alt_a,}
+        return dados.get(params.get('codigo'),
+                pytest.ResponseMockup({}, requests.codes.not_found))
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    
+    produtos = [
+            ('12340101', 0, Decimal('5.00')),
+            ('12340202', 0, Decimal('15.50')),
+            ('12340101', 0, Decimal('7.30')),]
+    servicos = [
+            ('0123', Decimal('100')),
+            ('0124', Decimal('575.77')),]
+    
+    individual = DeOlhoNoImposto()
+    for ncm, ncm_ex, valor in produtos:
+        individual.produto(ncm, ncm_ex, valor)
+    for nbs, valor in servicos:
+        individual.servico(nbs, valor)
+    
+    lote = DeOlhoNoImposto()
+    # a exceção da NCM pode ser informada como string
+    lote.produtos([(ncm, str(ncm_ex), valor)
+            for ncm, ncm_ex, valor in produtos])
+    lote.servicos(servicos)
+    
+    assert lote.carga_federal_nacional() == \
+            individual.carga_federal_nacional()
+    assert lote.carga_federal_importado() == \
+            individual.carga_federal_importado()
+    assert lote.carga_estadual() == individual.carga_estadual()
+    assert lote.carga_municipal() == individual.carga_municipal()
+    assert lote.total() == individual.total()
+    
+    # nenhum item é acumulado se algum deles não for encontrado
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        lote.produtos([('12340101', 0, Decimal('1')), ('99999999', 0, 1)])
+    assert lote.total() == individual.total()
+
+
+def test_deolhonoimposto_detalhado(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+
+    calc = DeOlhoNoImposto()
+    with pytest.raises(RuntimeError):
+        calc.itens()
+
+    calc = DeOlhoNoImposto(detalhar=True)
+    calc.produto('12340101', 0, Decimal('10'))
+    calc.servico('0123', Decimal('100'))
+    produto, servico = calc.itens()
+    assert produto.codigo == ('12340101', 0)
+    assert produto.estadual == Decimal('10') * (Decimal('18') / CEM)
+    assert produto.municipal is None
+    assert servico.codigo == '0123'
+    assert servico.municipal == Decimal('4.33')
+    calc.reiniciar()
+    assert calc.itens() == []
+
+
+def test_deolhonoimposto_totais_identicos(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto_alt_a
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+
+    # valores com muitas casas, para que as somas sejam arredondadas pelo
+    # contexto decimal; os totais devem ser idênticos (inclusive o
+    # expoente) aos da soma de todos os itens, na mesma ordem
+    aleatorio = random.Random(12741)
+    calc = DeOlhoNoImposto(detalhar=True)
+    for i in range(500):
+        valor = Decimal(aleatorio.randint(1, 10 ** 12)).scaleb(
+                -aleatorio.randint(2, 20))
+        if i % 3:
+            calc.produto('12340202', 0, valor)
+        else:
+            calc.servico('0123', valor)
+
+    itens = calc.itens()
+    def somar(valores):
+        return sum([v for v in valores if v is not None] or [ZERO,])
+    esperados = [
+            (calc.carga_federal_nacional(),
+                    somar(i.federal_nacional for i in itens)),
+            (calc.carga_federal_importado(),
+                    somar(i.federal_importado for i in itens)),
+            (calc.carga_estadual(), somar(i.estadual for i in itens)),
+            (calc.carga_municipal(), somar(i.municipal for i in itens)),]
+    for obtido, esperado in esperados:
+        assert obtido.as_tuple() == esperado.as_tuple()
+
+
+class ProvisaoFixa(ProvisaoBase):
+
+    def get_produto(self, ncm, ncm_ex):
+        if ncm == '99999999':
+            raise ErroProdutoNaoEncontrado()
+        return Produto(codigo=ncm, uf='SP', ex=ncm_ex, descricao='Produto',
+                nacional=4.2, importado=5.41, estadual=18.0)
+
+    def get_servico(self, nbs):
+        return Servico(codigo=nbs, uf='SP', descricao='Servico', tipo='NBS',
+                nacional=13.45, importado=14.05, estadual=0.0, municipal=4.33)
+
+
+def test_calcular_cupons():
+    aleatorio = random.Random(12741)
+    cupons = []
+    for i in range(50):
+        cupom = []
+        for j in range(aleatorio.randint(0, 5)):
+            valor = Decimal(aleatorio.randint(1, 10 ** 6)).scaleb(-2)
+            if aleatorio.random() < 0.7:
+                cupom.append(('12340101', 0, valor))
+            else:
+                cupom.append(('0123', valor))
+        cupons.append(cupom)
+    cupons[7] = [('12340101', 0, Decimal('1')), ('99999999', 0, Decimal('1'))]
+
+    resultados = list(calcular_cupons(iter(cupons),
+            fabrica_provisao=ProvisaoFixa, max_workers=2, chunksize=3))
+    assert len(resultados) == len(cupons)
+    assert isinstance(resultados[7], ErroProdutoNaoEncontrado)
+
+    calc = DeOlhoNoImposto(provisao=ProvisaoFixa())
+    for i, (cupom, resultado) in enumerate(zip(cupons, resultados)):
+        if i == 7:
+            continue
+        calc.reiniciar()
+        for item in cupom:
+            if len(item) == 3:
+                calc.produto(*item)
+            else:
+                calc.servico(*item)
+        assert resultado == Resultado(
+                federal_nacional=calc.carga_federal_nacional(),
+                federal_importado=calc.carga_federal_importado(),
+                estadual=calc.carga_estadual(),
+                municipal=calc.carga_municipal(),
+                total=calc.total())
+
+
+def test_calcular_cupons_interrompido():
+    cupons = ([('0123', Decimal('10'))] for i in range(10 ** 6))
+    resultados = calcular_cupons(cupons, fabrica_provisao=ProvisaoFixa,
+            max_workers=2, chunksize=10)
+    assert next(resultados).municipal == Decimal('0.4330')
+    resultados.close()
+
+
+def test_resultado_mesclar():
+    aleatorio = random.Random(12741)
+    itens = []
+    for i in range(60):
+        valor = Decimal(aleatorio.randint(1, 10 ** 6)).scaleb(-2)
+        itens.append(('12340101', 0, valor) if i % 4 else ('0123', valor))
+
+    def calcular(itens):
+        calc = DeOlhoNoImposto(provisao=ProvisaoFixa())
+        for item in itens:
+            if len(item) == 3:
+                calc.produto(*item)
+            else:
+                calc.servico(*item)
+        return calc
+
+    completa = calcular(itens)
+    parciais = [calcular(itens[i:i + 7]).resultado()
+            for i in range(0, len(itens), 7)]
+
+    # o resultado não carrega o provisionamento e é serializável
+    parciais = [pickle.loads(pickle.dumps(r)) for r in parciais]
+
+    esquerda = reduce(Resultado.mesclar, parciais, Resultado.vazio())
+    direita = reduce(lambda a, b: b.mesclar(a), reversed(parciais))
+    assert esquerda == direita == completa.resultado()
+    assert esquerda.carga_federal() == completa.carga_federal()
+    assert esquerda.total_tributos() == completa.total_tributos()
+    assert esquerda.percentual_sobre_total() == \
+            completa.percentual_sobre_total()
+    assert Resultado.vazio().percentual_sobre_total().is_zero()
+    assert DeOlhoNoImposto().resultado() == Resultado.vazio()
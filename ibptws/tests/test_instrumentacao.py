@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tests/test_instrumentacao.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+
+import pytest
+import fakeredis
+
+import requests
+
+from ibptws.config import conf
+from ibptws.excecoes import ErroIdentificacao
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.instrumentacao import Instrumentacao
+from ibptws.instrumentacao import InstrumentacaoCallback
+from ibptws.instrumentacao import InstrumentacaoEmMemoria
+from ibptws.instrumentacao import InstrumentacaoLogging
+from ibptws.produtos import get_produto
+from ibptws.provisoes import ProvisaoEmArquivo
+from ibptws.provisoes import ProvisaoEmCamadas
+from ibptws.provisoes import ProvisaoEmMemoria
+from ibptws.provisoes import ProvisaoViaRedis
+from ibptws.provisoes import ProvisaoViaSQLite
+from ibptws.servicos import get_servico
+from ibptws.tabelas import ProvisaoTabelaCompilada
+from ibptws.tabelas import ProvisaoTabelaLocal
+from ibptws.tabelas import compilar_tabela
+
+
+TABELA_CSV = u'''\
+codigo;ex;tipo;descricao;nacionalfederal;importadosfederal;estadual;municipal;vigenciainicio;vigenciafim;chave;versao;fonte
+12340101;;0;Produto;4.20;4.80;18.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+'''
+
+
+def test_instrumentacao_base():
+    instrumentacao = Instrumentacao()
+    with pytest.raises(NotImplementedError):
+        instrumentacao.contar('webservice_consultas')
+    with pytest.raises(NotImplementedError):
+        instrumentacao.medir('webservice_latencia', 0.1)
+
+
+def test_desabilitada_por_padrao():
+    assert conf.instrumentacao is None
+
+
+def test_webservice(monkeypatch):
+    respostas = {
+            '12340101': pytest.instancia_resp_sucesso_produto,
+            '99999999': pytest.ResponseMockup({}, requests.codes.not_found),
+            '88888888': pytest.ResponseMockup({}, requests.codes.forbidden),
+            '0123': pytest.instancia_resp_sucesso_servico,}
+    def mockreturn(endpoint, params={}):
+        return respostas[params['codigo']]
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    instrumentacao = InstrumentacaoEmMemoria()
+    monkeypatch.setattr(conf, 'instrumentacao', instrumentacao)
+
+    get_produto('12340101')
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        get_produto('99999999')
+    with pytest.raises(ErroIdentificacao):
+        get_produto('88888888')
+    get_servico('0123')
+
+    assert instrumentacao.contador('webservice_consultas',
+            recurso='produtos') == 3
+    assert instrumentacao.contador('webservice_consultas',
+            recurso='servicos') == 1
+    assert instrumentacao.contador('webservice_erros', recurso='produtos',
+            erro='ErroProdutoNaoEncontrado') == 1
+    assert instrumentacao.contador('webservice_erros', recurso='produtos',
+            erro='ErroIdentificacao') == 1
+    faixas, soma, total = instrumentacao.histograma('webservice_latencia',
+            recurso='produtos')
+    assert total == 3 and sum(faixas) == 3 and soma >= 0
+
+    texto = instrumentacao.exportar()
+    assert '# TYPE ibptws_webservice_consultas_total counter' in texto
+    assert 'ibptws_webservice_consultas_total{recurso="produtos"} 3' in texto
+    assert 'ibptws_webservice_latencia_seconds_bucket{recurso="produtos",' \
+            'le="+Inf"} 3' in texto
+    assert 'ibptws_webservice_latencia_seconds_count{recurso="servicos"} 1' \
+            in texto
+
+
+def test_provisoes(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    instrumentacao = InstrumentacaoEmMemoria()
+    monkeypatch.setattr(conf, 'instrumentacao', instrumentacao)
+
+    provisao = ProvisaoViaRedis(redis=fakeredis.FakeStrictRedis())
+    provisao.get_produto('12340101', 0)
+    provisao.get_produto('12340101', 0)
+    provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+    assert instrumentacao.contador('provisao_acertos',
+            provisao='ProvisaoViaRedis') == 2
+    assert instrumentacao.contador('provisao_falhas',
+            provisao='ProvisaoViaRedis') == 2
+    assert instrumentacao.histograma('provisao_latencia',
+            provisao='ProvisaoViaRedis')[2] == 3
+
+    em_memoria = ProvisaoEmMemoria(provisao)
+    em_memoria.get_produto('12340101', 0)
+    em_memoria.get_produto('12340101', 0)
+    assert instrumentacao.contador('provisao_acertos',
+            provisao='ProvisaoEmMemoria') == 1
+    assert instrumentacao.contador('provisao_falhas',
+            provisao='ProvisaoEmMemoria') == 1
+
+
+def test_exportar_agrupa_familias():
+    instrumentacao = InstrumentacaoEmMemoria(limites=(0.1,))
+    instrumentacao.contar('provisao_acertos', provisao='A')
+    instrumentacao.contar('provisao_falhas', provisao='A')
+    instrumentacao.medir('provisao_latencia', 0.05, provisao='A')
+    instrumentacao.contar('provisao_acertos', 2, provisao='B')
+    instrumentacao.medir('provisao_latencia', 0.5, provisao='B')
+    instrumentacao.contar('provisao_falhas', provisao='a"b\\c\nd')
+
+    linhas = instrumentacao.exportar().splitlines()
+    assert linhas[:5] == [
+            '# HELP ibptws_provisao_acertos_total '
+                    'Contador provisao_acertos.',
+            '# TYPE ibptws_provisao_acertos_total counter',
+            'ibptws_provisao_acertos_total{provisao="A"} 1',
+            'ibptws_provisao_acertos_total{provisao="B"} 2',
+            '# HELP ibptws_provisao_falhas_total Contador provisao_falhas.',]
+    assert linhas[5:8] == [
+            '# TYPE ibptws_provisao_falhas_total counter',
+            'ibptws_provisao_falhas_total{provisao="A"} 1',
+            'ibptws_provisao_falhas_total{provisao="a\\"b\\\\c\\nd"} 1',]
+
+    # cada família aparece uma única vez e suas amostras são contíguas
+    tipos = [linha for linha in linhas if linha.startswith('# TYPE')]
+    assert len(tipos) == len(set(tipos)) == 3
+    latencia = linhas[linhas.index(
+            '# TYPE ibptws_provisao_latencia_seconds histogram') + 1:]
+    assert latencia == [
+            'ibptws_provisao_latencia_seconds_bucket'
+                    '{provisao="A",le="0.1"} 1',
+            'ibptws_provisao_latencia_seconds_bucket'
+                    '{provisao="A",le="+Inf"} 1',
+            'ibptws_provisao_latencia_seconds_sum{provisao="A"} 0.05',
+            'ibptws_provisao_latencia_seconds_count{provisao="A"} 1',
+            'ibptws_provisao_latencia_seconds_bucket'
+                    '{provisao="B",le="0.1"} 0',
+            'ibptws_provisao_latencia_seconds_bucket'
+                    '{provisao="B",le="+Inf"} 1',
+            'ibptws_provisao_latencia_seconds_sum{provisao="B"} 0.5',
+            'ibptws_provisao_latencia_seconds_count{provisao="B"} 1',]
+
+
+def test_provisoes_registram_leituras(monkeypatch, tmpdir):
+    def mockreturn(endpoint, params={}):
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    instrumentacao = InstrumentacaoEmMemoria()
+    monkeypatch.setattr(conf, 'instrumentacao', instrumentacao)
+    csv = tmpdir.join('TabelaIBPTaxSP17.1.A.csv')
+    csv.write_binary(TABELA_CSV.encode('iso-8859-1'))
+    compilar_tabela(str(csv), str(tmpdir.join('ibpt.bin')))
+
+    # uma falha (seguida da consulta ao web services) e um acerto
+    for provisao in (ProvisaoViaSQLite(str(tmpdir.join('ibptws.db'))),
+            ProvisaoEmArquivo(str(tmpdir.join('ibptws.log')))):
+        provisao.get_produto('12340101', 0)
+        provisao.get_produto('12340101', 0)
+        nome = type(provisao).__name__
+        assert instrumentacao.contador('provisao_acertos',
+                provisao=nome) == 1
+        assert instrumentacao.contador('provisao_falhas',
+                provisao=nome) == 1
+        assert instrumentacao.histograma('provisao_latencia',
+                provisao=nome)[2] == 2
+
+    # em camadas, um acerto é a resposta de qualquer uma das camadas
+    memoria = ProvisaoEmMemoria()
+    camadas = ProvisaoEmCamadas([memoria])
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        camadas.get_produto('12340101', 0)
+    memoria.get_produto('12340101', 0)
+    camadas.get_produto('12340101', 0)
+    assert instrumentacao.contador('provisao_acertos',
+            provisao='ProvisaoEmCamadas') == 1
+    assert instrumentacao.contador('provisao_falhas',
+            provisao='ProvisaoEmCamadas') == 1
+
+    # as tabelas respondem por todos os produtos, inclusive os não
+    # encontrados
+    for provisao in (ProvisaoTabelaLocal(str(csv)),
+            ProvisaoTabelaCompilada(str(tmpdir.join('ibpt.bin')))):
+        provisao.get_produto('12340101', 0)
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+        assert instrumentacao.contador('provisao_acertos',
+                provisao=type(provisao).__name__) == 2
+
+
+def test_callback(monkeypatch):
+    registros = []
+    monkeypatch.setattr(conf, 'instrumentacao',
+            InstrumentacaoCallback(lambda *args: registros.append(args)))
+    monkeypatch.setattr(conf.transporte, 'get',
+            lambda endpoint, params={}: pytest.instancia_resp_sucesso_servico)
+    get_servico('0123')
+    assert [(tipo, nome) for tipo, nome, valor, rotulos in registros] == [
+            ('contador', 'webservice_consultas'),
+            ('histograma', 'webservice_latencia')]
+    assert registros[0][3] == {'recurso': 'servicos'}
+
+
+def test_logging(caplog):
+    instrumentacao = InstrumentacaoLogging()
+    with caplog.at_level(logging.DEBUG, logger='ibptws'):
+        instrumentacao.contar('provisao_acertos', 2, provisao='X')
+        instrumentacao.medir('provisao_latencia', 0.5, provisao='X')
+    mensagens = [registro.getMessage() for registro in caplog.records]
+    assert mensagens == ['provisao_acertos +2 provisao=X',
+            'provisao_latencia 0.500000s provisao=X']
@@ -23,15 +23,17 @@ import pytest
 
 import requests
 
+from ibptws.config import conf
 from ibptws.excecoes import ErroProdutoNaoEncontrado
 from ibptws.excecoes import ErroIdentificacao
 from ibptws.produtos import get_produto
+from ibptws.produtos import get_produtos
 
 
 def test_consulta_sucesso(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_produto
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     p = get_produto('12340101')
     assert p.codigo == '12340101'
     assert p.ex == 0
@@ -43,7 +45,7 @@ def test_consulta_sucesso(monkeypatch):
 def test_produto_nao_encontrado(monkeypatch):
     def mockreturn(endpoint, params=()):
         return pytest.ResponseMockup({}, requests.codes.not_found)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(ErroProdutoNaoEncontrado):
         p = get_produto('12340101')
         
@@ -51,7 +53,7 @@ def test_produto_nao_encontrado(monkeypatch):
 def test_erro_identificacao(monkeypatch):
     def mockreturn(endpoint, params=()):
         return pytest.ResponseMockup({}, requests.codes.forbidden)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(ErroIdentificacao):
         p = get_produto('12340101')
         
@@ -59,6 +61,40 @@ def test_erro_identificacao(monkeypatch):
 def test_erro_inesperado(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.ResponseMockup({}, requests.codes.teapot)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(requests.HTTPError):
         p = get_produto('12340101')
+
+
+def test_consulta_em_lote(monkeypatch):
+    consultados = []
+    def mockreturn(endpoint, params={}):
+        consultados.append((params['codigo'], params['ex']))
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    chaves = [('12340101', 0), ('99999999', 0), ('12340101', 0)] * 10
+    produtos = get_produtos(chaves, max_workers=4)
+    assert list(produtos.keys()) == [('12340101', 0), ('99999999', 0)]
+    assert sorted(consultados) == [('12340101', 0), ('99999999', 0)]
+    assert produtos[('12340101', 0)].codigo == '12340101'
+    assert isinstance(produtos[('99999999', 0)], ErroProdutoNaoEncontrado)
+
+
+def test_consulta_em_lote_chaves(monkeypatch):
+    consultados = []
+    def mockreturn(endpoint, params={}):
+        consultados.append((params['codigo'], params['ex']))
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+
+    # a exceção é normalizada como número inteiro
+    produtos = get_produtos([('12340101', '0'), ['12340101', 0]])
+    assert list(produtos.keys()) == [('12340101', 0)]
+    assert consultados == [('12340101', 0)]
+
+    # um código NCM isolado não é uma chave
+    with pytest.raises(TypeError):
+        get_produtos(['12340101'])
+    assert len(consultados) == 1
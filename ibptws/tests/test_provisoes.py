@@ -17,14 +17,48 @@
 # limitations under the License.
 #
 
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
 import pytest
 import fakeredis
+import redis
 
 import requests
 
+from ibptws import provisoes
+from ibptws.config import conf
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.excecoes import ErroServicoNaoEncontrado
+from ibptws.provisoes import AnelConsistente
+from ibptws.provisoes import CANAL_INVALIDACAO
+from ibptws.provisoes import CodecBinario
+from ibptws.provisoes import CodecHash
+from ibptws.provisoes import ConsultaUnica
+from ibptws.provisoes import InvalidacaoViaRedis
+from ibptws.provisoes import Estatisticas
+from ibptws.provisoes import EstatisticasConexoes
 from ibptws.provisoes import ProvisaoBase
+from ibptws.provisoes import ProvisaoEmArquivo
+from ibptws.provisoes import ProvisaoEmCamadas
+from ibptws.provisoes import ProvisaoEmMemoria
 from ibptws.provisoes import SemProvisao
 from ibptws.provisoes import ProvisaoViaRedis
+from ibptws.provisoes import ProvisaoViaRedisDistribuida
+from ibptws.provisoes import ProvisaoViaSQLite
+from ibptws.provisoes import pool_de_conexoes
+from ibptws.provisoes import RenovacaoProgramada
+from ibptws.provisoes import RevalidacaoEmSegundoPlano
+from ibptws.provisoes import INDICE_EXPIRACOES
+from ibptws.provisoes import INDICE_LEITURAS
+from ibptws.provisoes import VERSAO_TABELA
+from ibptws.provisoes import _estatisticas_pool
+from ibptws.produtos import Produto
+from ibptws.servicos import Servico
+from ibptws.tabelas import Tabela
 
 
 def test_provisao_base():
@@ -38,7 +72,7 @@ def test_provisao_base():
 def test_produto_sem_provisao(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_produto
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     p = SemProvisao()
     produto = p.get_produto('12340101', 0)
     assert produto.codigo == '12340101'
@@ -48,7 +82,7 @@ def test_produto_sem_provisao(monkeypatch):
 def test_servico_sem_provisao(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_servico
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     p = SemProvisao()
     produto = p.get_servico('0123')
     assert produto.codigo == '0123'
@@ -70,7 +104,7 @@ def test_produto_provisaoviaredis_provisionado():
 def test_produto_provisaoviaredis_nao_provisionado(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_produto
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     # agora não há provisionamento; o produto deverá ser obtido do
     # web services, que está em simulação (mocked)
     fredis = fakeredis.FakeStrictRedis()
@@ -95,7 +129,7 @@ def test_servico_provisaoviaredis_provisionado():
 def test_servico_provisaoviaredis_nao_provisionado(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_servico
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     # agora não há provisionamento; o serviço deverá ser obtido do
     # web services, que está em simulação (mocked)
     fredis = fakeredis.FakeStrictRedis()
@@ -105,3 +139,938 @@ def test_servico_provisaoviaredis_nao_provisionado(monkeypatch):
     assert servico.uf == 'SP'
     assert servico.tipo == 'NBS'
     
+
+
+def test_consulta_unica_entre_threads(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params)
+        time.sleep(0.1)
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    provisao = ProvisaoViaRedis(redis=fakeredis.FakeStrictRedis())
+    resultados = []
+    threads = [threading.Thread(
+            target=lambda: resultados.append(
+                    provisao.get_produto('12340101', 0)))
+            for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(chamadas) == 1
+    assert len(resultados) == 10
+    assert all(p.codigo == '12340101' for p in resultados)
+
+
+def test_consulta_unica_propaga_erro():
+    def falha():
+        raise ValueError()
+    consultas = ConsultaUnica()
+    with pytest.raises(ValueError):
+        consultas.executar('ncm:12340101:0', falha)
+    assert consultas.executar('ncm:12340101:0', lambda: 1) == 1
+
+
+def test_consulta_unica_entre_processos(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        raise AssertionError('o web services nao deveria ser consultado')
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    # simula outro processo que detém a trava e provisiona a chave
+    fredis.set('trava:ncm:12340101:0', 'outro-processo')
+    def outro_processo():
+        time.sleep(0.2)
+        fredis.hmset('ncm:12340101:0', pytest.RESPOSTA_SUCESSO_PRODUTO())
+        fredis.delete('trava:ncm:12340101:0')
+    t = threading.Thread(target=outro_processo)
+    t.start()
+    provisao = ProvisaoViaRedis(redis=fredis)
+    produto = provisao.get_produto('12340101', 0)
+    t.join()
+    assert produto.codigo == '12340101'
+
+
+def test_provisaoviaredis_nao_encontrado(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params)
+        return pytest.ResponseMockup({}, requests.codes.not_found)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    provisao = ProvisaoViaRedis(redis=fredis, expires_nao_encontrado=60)
+    for i in range(3):
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+        with pytest.raises(ErroServicoNaoEncontrado):
+            provisao.get_servico('9999')
+    assert len(chamadas) == 2
+    assert 0 < fredis.ttl('ncm:99999999:0') <= 60
+    assert 0 < fredis.ttl('nbs:9999') <= 60
+
+
+def test_provisaoviaredis_nao_encontrado_desabilitado(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params)
+        return pytest.ResponseMockup({}, requests.codes.not_found)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    provisao = ProvisaoViaRedis(redis=fakeredis.FakeStrictRedis(),
+            expires_nao_encontrado=0)
+    for i in range(3):
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+    assert len(chamadas) == 3
+
+
+def test_provisaoviasqlite(monkeypatch, tmpdir):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params)
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    monkeypatch.setattr(conf, 'estado', 'SP')
+    caminho = str(tmpdir.join('ibptws.db'))
+
+    provisao = ProvisaoViaSQLite(caminho)
+    produto = provisao.get_produto('12340101', 0)
+    servico = provisao.get_servico('0123')
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    assert len(chamadas) == 3
+
+    # outro processo (ou instância) compartilha o mesmo arquivo
+    outra = ProvisaoViaSQLite(caminho)
+    assert outra.get_produto('12340101', 0) == produto
+    assert outra.get_servico('0123') == servico
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        outra.get_produto('99999999', 0)
+    assert len(chamadas) == 3
+
+
+def test_provisaoviasqlite_expiracao(monkeypatch, tmpdir):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params)
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    caminho = str(tmpdir.join('ibptws.db'))
+    provisao = ProvisaoViaSQLite(caminho, expires=-1)
+    provisao.get_produto('12340101', 0)
+    provisao.get_produto('12340101', 0)
+    assert len(chamadas) == 2
+
+    # apenas os registros expirados são removidos
+    ProvisaoViaSQLite(caminho).provisionar_produtos([Produto(
+            codigo='12340202', uf='SP', ex=0, descricao='Produto',
+            nacional=4.2, importado=4.8, estadual=18.0)], uf=conf.estado)
+    provisao.expurgar()
+    conexao = sqlite3.connect(caminho)
+    assert conexao.execute('SELECT ncm FROM produtos').fetchall() == [
+            ('12340202',)]
+    conexao.close()
+
+
+def test_provisaoviasqlite_fechar(tmpdir):
+    provisao = ProvisaoViaSQLite(str(tmpdir.join('ibptws.db')))
+    conexoes = [provisao._conexao()]
+    thread = threading.Thread(
+            target=lambda: conexoes.append(provisao._conexao()))
+    thread.start()
+    thread.join()
+    assert conexoes[0] is not conexoes[1]
+
+    # as conexões de todas as threads são encerradas...
+    provisao.fechar()
+    for conexao in conexoes:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conexao.execute('SELECT 1')
+
+    # ...e reabertas na próxima consulta
+    assert provisao.consultar_produto('12340101', 0) is None
+    provisao.fechar()
+
+
+def test_provisaoviasqlite_em_lote(monkeypatch, tmpdir):
+    def mockreturn(endpoint, params={}):
+        raise AssertionError('o web services nao deveria ser consultado')
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    produto = Produto(codigo='12340101', uf='SP', ex=0, descricao='Produto',
+            nacional=4.2, importado=4.8, estadual=18.0)
+    servico = Servico(codigo='0123', uf='SP', descricao='Servico',
+            tipo='NBS', nacional=13.45, importado=14.05, estadual=0.0,
+            municipal=4.33)
+    provisao = ProvisaoViaSQLite(str(tmpdir.join('ibptws.db')))
+    provisao.provisionar_produtos([produto], uf=conf.estado)
+    provisao.provisionar_servicos([servico], uf=conf.estado)
+    assert provisao.get_produto('12340101', 0).nacional == 4.2
+    assert provisao.get_servico('0123').municipal == 4.33
+
+
+class ProvisaoMockup(ProvisaoBase):
+
+    def __init__(self):
+        self.consultas = []
+
+    def get_produto(self, ncm, ncm_ex):
+        self.consultas.append((ncm, ncm_ex))
+        if ncm == '99999999':
+            raise ErroProdutoNaoEncontrado()
+        return Produto(codigo=ncm, uf='SP', ex=ncm_ex, descricao='Produto',
+                nacional=4.2, importado=4.8, estadual=18.0)
+
+    def get_servico(self, nbs):
+        self.consultas.append(nbs)
+        return Servico(codigo=nbs, uf='SP', descricao='Servico', tipo='NBS',
+                nacional=13.45, importado=14.05, estadual=0.0, municipal=4.33)
+
+
+def test_provisao_em_memoria():
+    envolvida = ProvisaoMockup()
+    provisao = ProvisaoEmMemoria(envolvida, tamanho=2)
+    for i in range(3):
+        assert provisao.get_produto('12340101', 0).codigo == '12340101'
+        assert provisao.get_servico('0123').codigo == '0123'
+    assert envolvida.consultas == [('12340101', 0), '0123']
+    assert provisao.estatisticas() == Estatisticas(
+            acertos=4, falhas=2, despejos=0, tamanho=2)
+
+    # despeja o item menos recentemente consultado ('12340101')
+    provisao.get_produto('12340202', 0)
+    assert provisao.estatisticas().despejos == 1
+    provisao.get_servico('0123')
+    provisao.get_produto('12340101', 0)
+    assert envolvida.consultas[-1] == ('12340101', 0)
+
+    for i in range(2):
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+    assert envolvida.consultas.count(('99999999', 0)) == 1
+
+    provisao.limpar()
+    assert provisao.estatisticas().tamanho == 0
+
+
+def test_provisao_em_memoria_nao_encontrado():
+    # cada consulta lança uma nova instância, sem acumular o traceback
+    provisao = ProvisaoEmMemoria(ProvisaoMockup())
+    erros = []
+    for i in range(3):
+        try:
+            provisao.get_produto('99999999', 0)
+        except ErroProdutoNaoEncontrado as ex:
+            erros.append(ex)
+    assert len(set(id(ex) for ex in erros)) == 3
+    profundidades = []
+    for ex in erros:
+        tb, profundidade = ex.__traceback__, 0
+        while tb is not None:
+            tb, profundidade = tb.tb_next, profundidade + 1
+        profundidades.append(profundidade)
+    assert profundidades[1] == profundidades[2]
+
+    # consultar_produto também lança uma nova instância a cada consulta
+    consultados = []
+    for i in range(2):
+        with pytest.raises(ErroProdutoNaoEncontrado) as excinfo:
+            provisao.consultar_produto('99999999', 0)
+        consultados.append(excinfo.value)
+    assert consultados[0] is not consultados[1]
+    assert consultados[0] not in erros
+
+    produtos = provisao.get_produtos([('99999999', 0)])
+    assert isinstance(produtos[('99999999', 0)], ErroProdutoNaoEncontrado)
+    assert produtos[('99999999', 0)] is not erros[-1]
+
+
+def test_provisao_em_memoria_expiracao():
+    envolvida = ProvisaoMockup()
+    provisao = ProvisaoEmMemoria(envolvida, expires=0)
+    provisao.get_produto('12340101', 0)
+    provisao.get_produto('12340101', 0)
+    assert len(envolvida.consultas) == 2
+
+
+def test_provisaoviaredis_em_lote(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    fredis.hmset('ncm:12340202:0', pytest.RESPOSTA_SUCESSO_PRODUTO())
+    provisao = ProvisaoViaRedis(redis=fredis)
+
+    chaves = [('12340101', 0), ('12340202', 0), ('99999999', 0),
+            ('12340101', 0)]
+    for i in range(2):
+        produtos = provisao.get_produtos(chaves)
+        assert list(produtos.keys()) == [
+                ('12340101', 0), ('12340202', 0), ('99999999', 0)]
+        assert produtos[('12340101', 0)].codigo == '12340101'
+        assert produtos[('12340202', 0)].ex == 0
+        assert isinstance(produtos[('99999999', 0)], ErroProdutoNaoEncontrado)
+    assert sorted(chamadas) == ['12340101', '99999999']
+    assert fredis.ttl('ncm:12340101:0') > 0
+
+    servicos = provisao.get_servicos(['0123', '0123'])
+    assert list(servicos.keys()) == ['0123']
+    assert servicos['0123'].tipo == 'NBS'
+    assert provisao.get_servico('0123') == servicos['0123']
+
+
+def test_provisaoviaredis_em_lote_travas(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    provisao = ProvisaoViaRedis(redis=fredis, trava_expira=5)
+
+    # outro processo está consultando '12340202' e o provisiona em seguida
+    fredis.set('trava:ncm:12340202:0', 'outro', px=5000)
+    def provisionar():
+        fredis.hmset('ncm:12340202:0', pytest.RESPOSTA_SUCESSO_PRODUTO())
+        fredis.delete('trava:ncm:12340202:0')
+    temporizador = threading.Timer(0.2, provisionar)
+    temporizador.start()
+    produtos = provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+    temporizador.join()
+    assert produtos[('12340202', 0)].codigo == '12340101'
+    assert chamadas == ['12340101']
+    assert fredis.keys('trava:*') == []
+
+    # se a trava expira sem que a chave seja provisionada, ela é consultada
+    fredis.set('trava:ncm:12340303:0', 'outro', px=200)
+    produtos = provisao.get_produtos([('12340303', 0)])
+    assert produtos[('12340303', 0)].codigo == '12340101'
+    assert chamadas == ['12340101', '12340303']
+
+
+def test_codec_binario():
+    codec = CodecBinario()
+    produto = Produto(codigo='12340101', uf='SP', ex=0, descricao=u'Açúcar',
+            nacional=7.85, importado=9.85, estadual=18.0)
+    servico = Servico(codigo='0123', uf='XX', descricao='Teste',
+            tipo='OUTRO', nacional=0.1234, importado=1.0,
+            estadual=0.0, municipal=1.0 / 3)
+    dados = codec.codificar(produto)
+    assert len(dados) < 40
+    assert codec.decodificar(Produto, dados) == produto
+    assert codec.decodificar(Servico, codec.codificar(servico)) == servico
+    with pytest.raises(ErroServicoNaoEncontrado):
+        codec.decodificar(Servico, codec.codificar(
+                ErroServicoNaoEncontrado('9999')))
+
+
+def test_provisaoviaredis_codec_binario(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    # chave ainda no formato antigo (hash)
+    fredis.hmset('ncm:12340202:0', pytest.RESPOSTA_SUCESSO_PRODUTO())
+    provisao = ProvisaoViaRedis(redis=fredis, codec=CodecBinario())
+
+    assert provisao.get_produto('12340202', 0).codigo == '12340101'
+    produto = provisao.get_produto('12340101', 0)
+    assert produto == provisao.get_produto('12340101', 0)
+    assert fredis.type('ncm:12340101:0') == b'string'
+    for i in range(2):
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+        produtos = provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+        assert produtos[('12340101', 0)] == produto
+    assert chamadas == ['12340101', '99999999']
+
+    # sem leitura do formato antigo, a chave será substituída
+    provisao = ProvisaoViaRedis(redis=fredis,
+            codec=CodecBinario(ler_legado=False))
+    provisao.get_produto('12340202', 0)
+    assert fredis.type('ncm:12340202:0') == b'string'
+
+    # e o formato antigo pode voltar a ser utilizado
+    provisao = ProvisaoViaRedis(redis=fredis, codec=CodecHash())
+    provisao._provisionar_dados('ncm:12340101:0', produto)
+    assert fredis.type('ncm:12340101:0') == b'hash'
+    assert provisao.get_produto('12340101', 0) == produto
+
+
+@pytest.mark.parametrize('codec', [CodecHash(), CodecBinario()])
+def test_provisaoviaredis_revalidacao(monkeypatch, codec):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    revalidacao = RevalidacaoEmSegundoPlano()
+    provisao = ProvisaoViaRedis(redis=fredis, codec=codec, expires=60,
+            revalidar_apos=30, revalidacao=revalidacao)
+
+    # provisionado agora, ainda válido
+    produto = provisao.get_produto('12340101', 0)
+    assert provisao.get_produto('12340101', 0) == produto
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    assert len(chamadas) == 2
+
+    # desatualizado: é servido imediatamente e revalidado em segundo plano
+    fredis.expire('ncm:12340101:0', 20)
+    assert provisao.get_produto('12340101', 0) == produto
+    assert provisao.get_produtos([('12340101', 0)])[('12340101', 0)] == \
+            produto
+    revalidacao.encerrar()
+    assert chamadas == ['12340101', '99999999', '12340101']
+    assert fredis.ttl('ncm:12340101:0') > 30
+
+    # produtos não encontrados não são revalidados
+    fredis.expire('ncm:99999999:0', 20)
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    revalidacao.encerrar()
+    assert len(chamadas) == 3
+
+
+def test_revalidacao_em_segundo_plano():
+    revalidacao = RevalidacaoEmSegundoPlano()
+    liberar = threading.Event()
+    executadas = []
+    def revalidar(chave):
+        liberar.wait()
+        executadas.append(chave)
+        raise ValueError(chave)
+    assert revalidacao.agendar('a', revalidar, 'a')
+    assert not revalidacao.agendar('a', revalidar, 'a')
+    liberar.set()
+    revalidacao.encerrar()
+    assert executadas == ['a']
+    assert revalidacao.agendar('a', lambda: None)
+    revalidacao.encerrar()
+
+
+def test_provisaoviaredis_conexoes_compartilhadas(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    servidor = fakeredis.FakeServer()
+    argumentos = dict(connection_class=fakeredis.FakeConnection,
+            server=servidor, max_conexoes=4)
+    provisoes = [ProvisaoViaRedis(**argumentos) for i in range(2)]
+
+    def consultar(provisao):
+        for i in range(20):
+            provisao.get_produto('12340101', 0)
+
+    threads = [threading.Thread(target=consultar, args=(provisao,))
+            for provisao in provisoes * 4]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    pool = provisoes[0]._redis.connection_pool
+    assert provisoes[1]._redis.connection_pool is pool
+    assert pool is pool_de_conexoes(connection_class=fakeredis.FakeConnection,
+            server=servidor, max_conexoes=4)
+    estatisticas = provisoes[0].estatisticas_conexoes()
+    assert 1 <= estatisticas.criadas <= 4
+    assert estatisticas.em_uso == 0
+    assert estatisticas.maximo == 4
+
+    # contadores indisponíveis na versão do redis-py são desconhecidos
+    class PoolSemContadores(redis.ConnectionPool):
+        def __init__(self):
+            self.max_connections = 4
+    assert _estatisticas_pool(PoolSemContadores()) == \
+            EstatisticasConexoes(None, None, None, 4)
+
+    # após um fork, o cliente e o pool de conexões são recriados
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    cliente = provisoes[0]._redis
+    assert provisoes[0].get_produto('12340101', 0).codigo == '12340101'
+    assert provisoes[0]._redis is not cliente
+    assert provisoes[0]._redis.connection_pool is not pool
+
+    # instâncias que não compartilham conexões
+    provisao = ProvisaoViaRedis(compartilhar_conexoes=False, **argumentos)
+    provisao.get_produto('12340101', 0)
+    assert provisao._redis.connection_pool is not pool
+
+
+def test_provisaoviaredis_variacao_expiracao(monkeypatch):
+    def mockreturn(endpoint, params={}):
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    provisao = ProvisaoViaRedis(redis=fredis, expires=1000,
+            variacao_expiracao=0.5)
+    chaves = [('1234{:04d}'.format(i), 0) for i in range(50)]
+    provisao.get_produtos(chaves)
+    ttls = set(fredis.ttl('ncm:{}:{}'.format(*chave)) for chave in chaves)
+    assert len(ttls) > 1
+    assert all(500 <= ttl <= 1000 for ttl in ttls)
+
+
+def test_provisaoviaredis_variacao_expiracao_revalidacao(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    revalidacao = RevalidacaoEmSegundoPlano()
+    provisao = ProvisaoViaRedis(redis=fredis, expires=1000,
+            variacao_expiracao=0.5, revalidar_apos=400,
+            revalidacao=revalidacao)
+
+    # a expiração reduzida não torna as chaves recém-provisionadas
+    # desatualizadas
+    chaves = [('1234{:04d}'.format(i), 0) for i in range(50)]
+    provisao.get_produtos(chaves)
+    provisao.get_produtos(chaves)
+    revalidacao.encerrar()
+    assert len(chamadas) == 50
+
+    # apenas após revalidar_apos
+    chave = 'ncm:{}:{}'.format(*chaves[0])
+    fredis.expire(chave, provisao._expiracao(1000, chave) - 401)
+    provisao.get_produto(*chaves[0])
+    revalidacao.encerrar()
+    assert len(chamadas) == 51
+
+
+def test_provisaoviaredis_renovacao(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    fredis = fakeredis.FakeStrictRedis()
+    provisao = ProvisaoViaRedis(redis=fredis, expires=1000,
+            indexar_expiracoes=True)
+    provisao.get_produto('12340101', 0)
+    provisao.get_produtos([('12340202', 0)])
+    provisao.get_servico('0123')
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    assert fredis.zcard(INDICE_EXPIRACOES) == 3
+    del chamadas[:]
+
+    # nada expira nos próximos 10 minutos
+    assert provisao.renovar(antecedencia=600) == 0
+
+    # duas chaves expiram em breve, mas apenas uma é renovada por lote
+    fredis.expire('ncm:12340202:0', 300)
+    fredis.expire('nbs:0123', 300)
+    fredis.execute_command('ZADD', INDICE_EXPIRACOES, time.time() + 300,
+            'ncm:12340202:0')
+    fredis.execute_command('ZADD', INDICE_EXPIRACOES, time.time() + 300,
+            'nbs:0123')
+    # apenas as chaves lidas desde que foram gravadas são renovadas
+    provisao.get_produto('12340202', 0)
+    provisao.get_servico('0123')
+    assert chamadas == []
+    renovacao = RenovacaoProgramada(provisao, antecedencia=600, lote=1)
+    assert renovacao.executar() == 1
+    assert renovacao.executar() == 1
+    assert renovacao.executar() == 0
+    assert sorted(chamadas) == ['0123', '12340202']
+    assert fredis.ttl('ncm:12340202:0') > 900
+    assert fredis.ttl('nbs:0123') > 900
+
+    # não lidas desde a renovação, deixam o índice e expiram normalmente
+    # (renovadas há 700s e lidas pela última vez há 800s)
+    for chave in ('ncm:12340202:0', 'nbs:0123'):
+        fredis.execute_command('ZADD', INDICE_EXPIRACOES, time.time() + 300,
+                chave)
+        fredis.execute_command('ZADD', INDICE_LEITURAS, time.time() - 800,
+                chave)
+    assert provisao.renovar(antecedencia=600) == 0
+    assert fredis.zcard(INDICE_EXPIRACOES) == 1
+    assert fredis.ttl('nbs:0123') > 900
+
+    # chaves que já expiraram são apenas removidas do índice
+    fredis.delete('ncm:12340101:0')
+    fredis.execute_command('ZADD', INDICE_EXPIRACOES, time.time() - 1,
+            'ncm:12340101:0')
+    assert provisao.renovar() == 0
+    assert fredis.zcard(INDICE_EXPIRACOES) == 0
+
+    renovacao.iniciar()
+    renovacao.parar()
+
+
+def test_anel_consistente():
+    chaves = ['ncm:{:08d}:0'.format(i) for i in range(2000)]
+    anel = AnelConsistente(['a', 'b', 'c'])
+    antes = dict((chave, anel.no(chave)) for chave in chaves)
+    for no in 'abc':
+        assert 400 < list(antes.values()).count(no) < 900
+
+    # ao incluir um nó, apenas as chaves que passam a ele mudam de nó
+    anel = AnelConsistente(['a', 'b', 'c', 'd'])
+    movidas = [chave for chave in chaves if anel.no(chave) != antes[chave]]
+    assert all(anel.no(chave) == 'd' for chave in movidas)
+    assert len(movidas) < len(chaves) / 3
+
+
+def test_provisaoviaredis_distribuida(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    clientes = dict((nome, fakeredis.FakeStrictRedis(
+            server=fakeredis.FakeServer())) for nome in 'abc')
+    provisao = ProvisaoViaRedisDistribuida(clientes, codec=CodecBinario())
+
+    chaves = [('1234{:04d}'.format(i), 0) for i in range(30)]
+    produtos = provisao.get_produtos(chaves)
+    assert list(produtos.keys()) == chaves
+    assert len(chamadas) == 30
+    assert provisao.get_produtos(chaves) == produtos
+    assert provisao.get_produto('12340007', 0) == produtos[('12340007', 0)]
+    assert len(chamadas) == 30
+
+    # cada chave está provisionada em um único servidor
+    for ncm, ex in chaves:
+        chave = 'ncm:{}:{}'.format(ncm, ex)
+        assert [nome for nome, cliente in sorted(clientes.items())
+                if cliente.exists(chave)] == [provisao._anel.no(chave)]
+    assert all(cliente.dbsize() > 0 for cliente in clientes.values())
+    assert provisao.estatisticas_conexoes().criadas >= 3
+
+    # clientes em uma lista são identificados pelos seus endereços
+    provisao = ProvisaoViaRedisDistribuida([redis.StrictRedis(host='a'),
+            redis.StrictRedis(host='b', db=1)])
+    assert sorted(provisao._anel.nos) == ['a:6379/0', 'b:6379/1']
+    with pytest.raises(ValueError):
+        ProvisaoViaRedisDistribuida([redis.StrictRedis(host='a'),
+                redis.StrictRedis(host='a')])
+
+
+def test_provisao_em_arquivo(monkeypatch, tmpdir):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if params['codigo'] == '99999999':
+            return pytest.ResponseMockup({}, requests.codes.not_found)
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    monkeypatch.setattr(conf, 'estado', 'SP')
+    caminho = str(tmpdir.join('ibptws.log'))
+
+    provisao = ProvisaoEmArquivo(caminho)
+    produto = provisao.get_produto('12340101', 0)
+    servico = provisao.get_servico('0123')
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    assert provisao.get_produto('12340101', 0) == produto
+    assert len(chamadas) == 3
+
+    # após reiniciar, nenhuma consulta ao web services
+    reiniciada = ProvisaoEmArquivo(caminho)
+    assert reiniciada.get_produto('12340101', 0) == produto
+    assert reiniciada.get_servico('0123') == servico
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        reiniciada.get_produto('99999999', 0)
+    assert len(chamadas) == 3
+
+    # registros acrescentados por outro processo são lidos antes de
+    # consultar o web services
+    provisao.get_produto('12340202', 0)
+    assert reiniciada.get_produto('12340202', 0).codigo == '12340101'
+    assert len(chamadas) == 4
+
+    # uma escrita interrompida no final do arquivo é ignorada
+    with open(caminho, 'ab') as arquivo:
+        arquivo.write(b'\x01\x02\x03')
+    assert ProvisaoEmArquivo(caminho).get_servico('0123') == servico
+    assert len(chamadas) == 4
+
+
+@pytest.mark.skipif(provisoes.fcntl is None, reason='requer fcntl')
+def test_provisao_em_arquivo_escrita_interrompida(monkeypatch, tmpdir):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    monkeypatch.setattr(conf, 'estado', 'SP')
+    caminho = str(tmpdir.join('ibptws.log'))
+
+    provisao = ProvisaoEmArquivo(caminho)
+    provisao.get_produto('12340101', 0)
+    with open(caminho, 'ab') as arquivo:
+        arquivo.write(b'\x01\x02\x03')
+
+    # o registro incompleto é descartado antes de acrescentar o seguinte,
+    # que permanece legível após reiniciar
+    ProvisaoEmArquivo(caminho).get_servico('0123')
+    assert len(chamadas) == 2
+    reiniciada = ProvisaoEmArquivo(caminho)
+    assert reiniciada.get_produto('12340101', 0).codigo == '12340101'
+    assert reiniciada.get_servico('0123').codigo == '0123'
+    assert len(chamadas) == 2
+
+
+def test_provisao_em_arquivo_compactacao(monkeypatch, tmpdir):
+    def mockreturn(endpoint, params={}):
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    caminho = str(tmpdir.join('ibptws.log'))
+    provisao = ProvisaoEmArquivo(caminho, expires=-1, compactar_apos=5)
+    outra = ProvisaoEmArquivo(caminho)
+
+    # expirados imediatamente, os registros são substituídos a cada consulta
+    for i in range(20):
+        provisao.get_produto('12340101', 0)
+    assert os.path.getsize(caminho) < 7 * 80
+
+    provisao = ProvisaoEmArquivo(caminho)
+    provisao.get_produto('12340101', 0)
+    provisao.compactar()
+    tamanho = os.path.getsize(caminho)
+    assert 0 < tamanho < 80
+    # o outro processo relê o arquivo compactado
+    assert outra.get_produto('12340101', 0).codigo == '12340101'
+    assert os.path.getsize(caminho) == tamanho
+
+
+def test_provisao_em_memoria_em_lote():
+    envolvida = ProvisaoMockup()
+    provisao = ProvisaoEmMemoria(envolvida)
+    provisao.get_produto('12340101', 0)
+    produtos = provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+    assert produtos[('12340202', 0)].codigo == '12340202'
+    assert envolvida.consultas == [('12340101', 0), ('12340202', 0)]
+    servicos = provisao.get_servicos(['0123', '0124'])
+    assert list(servicos.keys()) == ['0123', '0124']
+    assert provisao.estatisticas().acertos == 1
+
+
+def test_provisao_em_memoria_excecao_como_texto():
+    # '0' e 0 são a mesma exceção da NCM, individualmente ou em lote
+    envolvida = ProvisaoMockup()
+    provisao = ProvisaoEmMemoria(envolvida)
+    assert provisao.get_produto('12340101', '0').ex == 0
+    assert provisao.get_produto('12340101', 0).ex == 0
+    produtos = provisao.get_produtos([('12340101', '0'), ('12340202', 0)])
+    assert list(produtos.keys()) == [('12340101', 0), ('12340202', 0)]
+    assert provisao.get_produto('12340202', '0').codigo == '12340202'
+    assert provisao.consultar_produto('12340202', '0').codigo == '12340202'
+    provisao.provisionar_produto('12340303', '0',
+            envolvida.get_produto('12340303', 0))
+    assert provisao.consultar_produto('12340303', 0).codigo == '12340303'
+    assert envolvida.consultas == [('12340101', 0), ('12340202', 0),
+            ('12340303', 0)]
+    assert provisao.estatisticas().tamanho == 3
+
+
+class ProvisaoIndisponivel(ProvisaoBase):
+
+    def __init__(self, espera=0):
+        self.espera = espera
+
+    def get_produto(self, ncm, ncm_ex):
+        if self.espera:
+            time.sleep(self.espera)
+            return ProvisaoMockup().get_produto(ncm, ncm_ex)
+        raise redis.ConnectionError()
+
+
+def test_provisao_base_consultar_e_provisionar():
+    provisao = ProvisaoMockup()
+    assert provisao.consultar_produto('12340101', 0).codigo == '12340101'
+    assert provisao.consultar_servico('0123').codigo == '0123'
+    provisao.provisionar_produto('12340101', 0, None)
+    provisao.provisionar_servico('0123', None)
+
+
+def test_provisao_em_camadas(monkeypatch, tmpdir):
+    monkeypatch.setattr(conf, 'estado', 'SP')
+    memoria = ProvisaoEmMemoria()
+    via_redis = ProvisaoViaRedis(redis=fakeredis.FakeStrictRedis())
+    arquivo = ProvisaoEmArquivo(str(tmpdir.join('ibptws.log')))
+    origem = ProvisaoMockup()
+    provisao = ProvisaoEmCamadas([memoria, (via_redis, 1), arquivo, origem])
+
+    produto = provisao.get_produto('12340101', 0)
+    assert provisao.ultima_camada == 3
+    assert memoria.consultar_produto('12340101', 0) == produto
+    assert via_redis.consultar_produto('12340101', 0) == produto
+    assert arquivo.consultar_produto('12340101', 0) == produto
+    assert provisao.get_produto('12340101', 0) == produto
+    assert provisao.ultima_camada == 0
+
+    # grava nas camadas anteriores à camada que respondeu
+    servico = ProvisaoMockup().get_servico('0123')
+    via_redis.provisionar_servico('0123', servico)
+    assert provisao.get_servico('0123') == servico
+    assert provisao.ultima_camada == 1
+    assert memoria.consultar_servico('0123') == servico
+    assert arquivo.consultar_servico('0123') is None
+
+    # não encontrado também é uma resposta
+    for i in range(2):
+        with pytest.raises(ErroProdutoNaoEncontrado):
+            provisao.get_produto('99999999', 0)
+    assert origem.consultas.count(('99999999', 0)) == 1
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        via_redis.consultar_produto('99999999', 0)
+
+    assert [n for p, n in provisao.respostas()] == [2, 1, 0, 2]
+
+
+def test_provisao_em_camadas_falhas():
+    origem = ProvisaoMockup()
+    memoria = ProvisaoEmMemoria(ProvisaoIndisponivel())
+    provisao = ProvisaoEmCamadas([memoria, ProvisaoIndisponivel(),
+            (ProvisaoIndisponivel(espera=0.5), 0.05), origem])
+    assert provisao.get_produto('12340101', 0).codigo == '12340101'
+    assert provisao.ultima_camada == 3
+    assert memoria.consultar_produto('12340101', 0).codigo == '12340101'
+    provisao.encerrar()
+
+    # nenhuma camada respondeu: lança o último erro
+    provisao = ProvisaoEmCamadas([ProvisaoEmMemoria(),
+            ProvisaoIndisponivel()])
+    with pytest.raises(redis.ConnectionError):
+        provisao.get_produto('12340101', 0)
+    assert provisao.ultima_camada is None
+
+    # apenas caches, sem o produto: não encontrado
+    provisao = ProvisaoEmCamadas([ProvisaoEmMemoria()])
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('12340101', 0)
+    assert provisao.consultar_produto('12340101', 0) is None
+
+
+def _mock_web_services(monkeypatch):
+    chamadas = []
+    def mockreturn(endpoint, params={}):
+        chamadas.append(params['codigo'])
+        if endpoint == conf.endpoint.servicos:
+            return pytest.instancia_resp_sucesso_servico
+        return pytest.instancia_resp_sucesso_produto
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    return chamadas
+
+
+def test_provisaoviaredis_versao(monkeypatch):
+    chamadas = _mock_web_services(monkeypatch)
+    fredis = fakeredis.FakeStrictRedis()
+    tabela = Tabela(uf='SP', versao='17.1.A',
+            vigencia_inicio=datetime.date(2017, 1, 1), vigencia_fim=None,
+            produtos={}, servicos={})
+    provisao = ProvisaoViaRedis(redis=fredis, versao=tabela)
+    assert provisao.versao == '17.1.A@20170101'
+    provisao.get_produto('12340101', 0)
+    provisao.get_servicos(['0123'])
+    assert fredis.exists('17.1.A@20170101/ncm:12340101:0')
+    assert fredis.exists('17.1.A@20170101/nbs:0123')
+    assert not fredis.exists('ncm:12340101:0')
+
+    with pytest.raises(ValueError):
+        ProvisaoViaRedis(redis=fredis, versao='17/1')
+
+    # a mudança imediata deixa de ler as chaves da versão anterior
+    limpezas = []
+    provisao.ao_mudar_versao(lambda: limpezas.append(provisao.versao))
+    assert provisao.mudar_versao('17.2.A')
+    assert not provisao.mudar_versao('17.2.A')
+    assert limpezas == ['17.2.A']
+    provisao.get_produto('12340101', 0)
+    assert chamadas == ['12340101', '0123', '12340101']
+    assert fredis.exists('17.2.A/ncm:12340101:0')
+
+
+def test_provisaoviaredis_versao_transicao(monkeypatch):
+    chamadas = _mock_web_services(monkeypatch)
+    provisao = ProvisaoViaRedis(redis=fakeredis.FakeStrictRedis(),
+            versao='17.1.A')
+    provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+    del chamadas[:]
+
+    # na metade da transição, '12340101' ainda é lido da versão anterior,
+    # mas '12340202' já passou para a nova versão
+    provisao.mudar_versao('17.2.A', transicao=1000,
+            inicio=time.time() - 500)
+    provisao.get_produto('12340101', 0)
+    assert provisao.consultar_produto('12340101', 0) is not None
+    assert chamadas == []
+    assert provisao.consultar_produto('12340202', 0) is None
+    provisao.get_produtos([('12340101', 0), ('12340202', 0)])
+    assert chamadas == ['12340202']
+
+    # encerrada a transição, todas as chaves passam para a nova versão
+    provisao.mudar_versao('17.3.A', transicao=1000,
+            inicio=time.time() - 1000)
+    provisao.get_produto('12340101', 0)
+    assert chamadas == ['12340202', '12340101']
+
+
+def test_provisaoviaredis_publicar_versao(monkeypatch):
+    chamadas = _mock_web_services(monkeypatch)
+    servidor = fakeredis.FakeServer()
+    argumentos = dict(connection_class=fakeredis.FakeConnection,
+            server=servidor, indexar_expiracoes=True, versao='17.1.A')
+    publicadora = ProvisaoViaRedis(**argumentos)
+    assinante = ProvisaoViaRedis(**argumentos)
+    em_memoria = ProvisaoEmMemoria(assinante)
+    assinante.ao_mudar_versao(em_memoria.limpar)
+    em_memoria.get_produto('12340101', 0)
+    publicadora.get_servico('0123')
+    del chamadas[:]
+
+    invalidacao = InvalidacaoViaRedis(assinante, intervalo=0.01)
+    invalidacao.iniciar()
+    try:
+        # aguarda a assinatura do canal
+        limite = time.time() + 5
+        while time.time() < limite and not publicadora._redis.pubsub_numsub(
+                CANAL_INVALIDACAO)[0][1]:
+            time.sleep(0.01)
+        aquecimento = publicadora.publicar_versao('17.2.A', aquecer=10)
+        aquecimento.join()
+        while assinante.versao != '17.2.A' and time.time() < limite:
+            time.sleep(0.01)
+    finally:
+        invalidacao.parar()
+
+    assert assinante.versao == '17.2.A'
+    assert em_memoria.estatisticas().tamanho == 0
+    # os produtos e serviços da versão anterior foram aquecidos
+    assert sorted(chamadas) == ['0123', '12340101']
+    assert em_memoria.get_produto('12340101', 0).codigo == '12340101'
+    assert len(chamadas) == 2
+
+    # um processo iniciado depois da publicação lê a versão gravada
+    novo = ProvisaoViaRedis(**argumentos)
+    assert novo.sincronizar_versao()
+    assert novo.versao == '17.2.A'
+    assert novo._redis.get(VERSAO_TABELA).startswith(b'17.2.A|')
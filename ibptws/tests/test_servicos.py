@@ -23,15 +23,17 @@ import pytest
 
 import requests
 
+from ibptws.config import conf
 from ibptws.excecoes import ErroServicoNaoEncontrado
 from ibptws.excecoes import ErroIdentificacao
 from ibptws.servicos import get_servico
+from ibptws.servicos import get_servicos
 
 
 def test_consulta_sucesso(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.instancia_resp_sucesso_servico
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     p = get_servico('0123')
     assert p.codigo == '0123'
     assert p.tipo == 'NBS'
@@ -44,7 +46,7 @@ def test_consulta_sucesso(monkeypatch):
 def test_servico_nao_encontrado(monkeypatch):
     def mockreturn(endpoint, params=()):
         return pytest.ResponseMockup({}, requests.codes.not_found)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(ErroServicoNaoEncontrado):
         p = get_servico('0123')
 
@@ -52,7 +54,7 @@ def test_servico_nao_encontrado(monkeypatch):
 def test_erro_identificacao(monkeypatch):
     def mockreturn(endpoint, params=()):
         return pytest.ResponseMockup({}, requests.codes.forbidden)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(ErroIdentificacao):
         p = get_servico('0123')
 
@@ -60,6 +62,21 @@ def test_erro_identificacao(monkeypatch):
 def test_erro_inesperado(monkeypatch):
     def mockreturn(endpoint, params={}):
         return pytest.ResponseMockup({}, requests.codes.teapot)
-    monkeypatch.setattr(requests, 'get', mockreturn)
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
     with pytest.raises(requests.HTTPError):
         p = get_servico('12340101')
+
+
+def test_consulta_em_lote(monkeypatch):
+    consultados = []
+    def mockreturn(endpoint, params={}):
+        consultados.append(params['codigo'])
+        if params['codigo'] == '9999':
+            return pytest.ResponseMockup({}, requests.codes.forbidden)
+        return pytest.instancia_resp_sucesso_servico
+    monkeypatch.setattr(conf.transporte, 'get', mockreturn)
+    servicos = get_servicos(['0123', '9999', '0123', '0123'])
+    assert list(servicos.keys()) == ['0123', '9999']
+    assert sorted(consultados) == ['0123', '9999']
+    assert servicos['0123'].tipo == 'NBS'
+    assert isinstance(servicos['9999'], ErroIdentificacao)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tests/test_tabelas.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.excecoes import ErroServicoNaoEncontrado
+from ibptws.tabelas import ProvisaoTabelaCompilada
+from ibptws.tabelas import ProvisaoTabelaLocal
+from ibptws.tabelas import compilar_tabela
+from ibptws.tabelas import ler_tabela
+
+
+TABELA_CSV = u'''\
+codigo;ex;tipo;descricao;nacionalfederal;importadosfederal;estadual;municipal;vigenciainicio;vigenciafim;chave;versao;fonte
+02091021;;0;Gordura de porco, fresca;4.20;6.39;12.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+12340101;;0;"Produto; Simples";4.20;4.80;18.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+12340101;01;0;Produto Simples (ex 01);3.10;4.10;18.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+0123;;2;Análise e desenvolvimento de sistemas;13.45;14.05;0.00;4.33;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+101011000;;1;Serviços de construção;13.45;15.45;0.00;3.90;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+'''
+
+
+@pytest.fixture
+def arquivo_tabela(tmpdir):
+    arquivo = tmpdir.join('TabelaIBPTaxSP17.1.A.csv')
+    arquivo.write_binary(TABELA_CSV.encode('iso-8859-1'))
+    return str(arquivo)
+
+
+def test_ler_tabela(arquivo_tabela):
+    tabela = ler_tabela(arquivo_tabela)
+    assert tabela.uf == 'SP'
+    assert tabela.versao == '17.1.A'
+    assert tabela.vigencia_inicio == date(2017, 1, 1)
+    assert tabela.vigencia_fim == date(2017, 6, 30)
+    assert len(tabela.produtos) == 3
+    assert len(tabela.servicos) == 2
+
+
+def test_ler_tabela_de_objeto_arquivo():
+    tabela = ler_tabela(io.StringIO(TABELA_CSV), uf='RJ')
+    assert tabela.uf == 'RJ'
+    assert tabela.produtos[('12340101', 0)].descricao == 'Produto; Simples'
+
+
+def test_provisao_tabela_local_produto(arquivo_tabela):
+    provisao = ProvisaoTabelaLocal(arquivo_tabela)
+    produto = provisao.get_produto('2091021', 0)
+    assert produto.codigo == '02091021'
+    assert produto.uf == 'SP'
+    assert produto.ex == 0
+    assert produto.aliquota_nacional == Decimal('4.2')
+    assert produto.aliquota_importado == Decimal('6.39')
+    assert produto.aliquota_estadual == Decimal('12')
+    assert provisao.get_produto('12340101', 1).nacional == 3.1
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('12340101', 2)
+
+
+def test_provisao_tabela_local_servico(arquivo_tabela):
+    provisao = ProvisaoTabelaLocal(arquivo_tabela)
+    servico = provisao.get_servico('0123')
+    assert servico.tipo == 'LC116'
+    assert servico.descricao == u'Análise e desenvolvimento de sistemas'
+    assert servico.aliquota_municipal == Decimal('4.33')
+    assert provisao.get_servico('1.0101.10.00').tipo == 'NBS'
+    with pytest.raises(ErroServicoNaoEncontrado):
+        provisao.get_servico('9999')
+
+
+def test_colunas_obrigatorias():
+    with pytest.raises(ValueError):
+        ler_tabela(io.StringIO(u'codigo;ex;descricao\n'))
+
+
+def test_tabela_compilada(arquivo_tabela, tmpdir):
+    compilado = str(tmpdir.join('ibpt-sp.bin'))
+    compilar_tabela(arquivo_tabela, compilado)
+    local = ProvisaoTabelaLocal(arquivo_tabela)
+    provisao = ProvisaoTabelaCompilada(compilado)
+    assert provisao.uf == 'SP'
+    assert provisao.versao == '17.1.A'
+    assert provisao.vigencia_inicio == date(2017, 1, 1)
+    assert provisao.vigencia_fim == date(2017, 6, 30)
+    for ncm, ex in local.tabela.produtos:
+        assert provisao.get_produto(ncm, ex) == local.get_produto(ncm, ex)
+    for nbs in local.tabela.servicos:
+        assert provisao.get_servico(nbs) == local.get_servico(nbs)
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('12340101', 2)
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        provisao.get_produto('99999999', 0)
+    with pytest.raises(ErroServicoNaoEncontrado):
+        provisao.get_servico('123') # difere de '0123'
+    provisao.fechar()
+
+
+def test_tabela_compilada_invalida(tmpdir):
+    arquivo = tmpdir.join('invalido.bin')
+    arquivo.write_binary(b'\0' * 128)
+    with pytest.raises(ValueError):
+        ProvisaoTabelaCompilada(str(arquivo))
+
+    # menor que o cabeçalho, inclusive vazio
+    for conteudo in (b'IBPT', b''):
+        arquivo.write_binary(conteudo)
+        with pytest.raises(ValueError):
+            ProvisaoTabelaCompilada(str(arquivo))
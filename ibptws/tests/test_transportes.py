@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tests/test_transportes.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+
+import pytest
+
+import requests
+
+from ibptws.config import conf
+from ibptws.excecoes import ErroServicoIndisponivel
+from ibptws.produtos import get_produto
+from ibptws.transportes import TransporteBase
+from ibptws.transportes import TransporteHTTP
+
+
+class TransporteMockup(TransporteBase):
+
+    def __init__(self, resposta):
+        self.resposta = resposta
+        self.requisicoes = []
+
+    def get(self, url, params=None):
+        self.requisicoes.append((url, params))
+        return self.resposta
+
+
+def test_transporte_base():
+    t = TransporteBase()
+    with pytest.raises(NotImplementedError):
+        t.get('http://localhost/')
+
+
+def test_sessao_reaproveitada():
+    t = TransporteHTTP(conexoes_por_host=4, max_hosts=2, bloquear=True)
+    sessao = t.sessao
+    assert sessao is t.sessao
+    adaptador = sessao.get_adapter('http://iws.ibpt.org.br/api/Produtos')
+    assert adaptador._pool_maxsize == 4
+    assert adaptador._pool_connections == 2
+    assert adaptador._pool_block
+    assert 'Connection' not in sessao.headers or \
+            sessao.headers['Connection'] != 'close'
+    t.fechar()
+    assert t._sessao is None
+    assert t.sessao is not sessao
+
+
+def test_sem_keep_alive():
+    t = TransporteHTTP(keep_alive=False)
+    assert t.sessao.headers['Connection'] == 'close'
+
+
+def test_transporte_injetado(monkeypatch):
+    transporte = TransporteMockup(pytest.instancia_resp_sucesso_produto)
+    monkeypatch.setattr(conf, 'transporte', transporte)
+    produto = get_produto('12340101')
+    assert produto.codigo == '12340101'
+    url, params = transporte.requisicoes[0]
+    assert url == conf.endpoint.produtos
+    assert params['codigo'] == '12340101'
+    assert params['ex'] == 0
+
+
+class SessaoMockup(object):
+
+    def __init__(self, *respostas):
+        self.respostas = list(respostas)
+        self.timeouts = []
+
+    def get(self, url, params=None, timeout=None):
+        self.timeouts.append(timeout)
+        resposta = self.respostas.pop(0)
+        if isinstance(resposta, Exception):
+            raise resposta
+        return resposta
+
+
+def _transporte(sessao, **kwargs):
+    t = TransporteHTTP(espera_inicial=0, **kwargs)
+    t._sessao = sessao
+    t._pid = os.getpid()
+    return t
+
+
+def test_repete_erros_temporarios():
+    indisponivel = pytest.ResponseMockup({}, requests.codes.unavailable)
+    sessao = SessaoMockup(
+            requests.ConnectionError(),
+            indisponivel,
+            pytest.instancia_resp_sucesso_produto)
+    t = _transporte(sessao, timeout=(1, 2))
+    assert t.get('http://localhost/') is pytest.instancia_resp_sucesso_produto
+    assert sessao.timeouts == [(1, 2)] * 3
+    assert not t.disjuntor('http://localhost/').aberto
+
+
+def test_nao_repete_erros_definitivos():
+    sessao = SessaoMockup(
+            pytest.ResponseMockup({}, requests.codes.not_found),
+            pytest.instancia_resp_sucesso_produto)
+    t = _transporte(sessao)
+    assert t.get('http://localhost/').status_code == requests.codes.not_found
+    assert len(sessao.respostas) == 1
+
+
+def test_esgota_tentativas(monkeypatch):
+    indisponivel = pytest.ResponseMockup({}, requests.codes.unavailable)
+    sessao = SessaoMockup(*([indisponivel] * 2 + [requests.Timeout()] * 2))
+    t = _transporte(sessao, max_tentativas=2)
+    monkeypatch.setattr(conf, 'transporte', t)
+    with pytest.raises(requests.HTTPError):
+        get_produto('12340101')
+    with pytest.raises(requests.Timeout):
+        get_produto('12340101')
+
+
+def test_prazo_limita_timeout():
+    sessao = SessaoMockup(pytest.instancia_resp_sucesso_produto)
+    t = _transporte(sessao, timeout=(5, 30), prazo=2)
+    t.get('http://localhost/')
+    conexao, leitura = sessao.timeouts[0]
+    assert 0 < conexao <= 2 and 0 < leitura <= 2
+
+
+def test_timeout_unico():
+    sessao = SessaoMockup(pytest.instancia_resp_sucesso_produto)
+    t = _transporte(sessao, timeout=5, prazo=2)
+    assert t.timeout == (5, 5)
+    t.get('http://localhost/')
+    conexao, leitura = sessao.timeouts[0]
+    assert 0 < conexao <= 2 and 0 < leitura <= 2
+
+
+def test_disjuntor():
+    sessao = SessaoMockup(*([requests.ConnectionError()] * 2))
+    t = _transporte(sessao, max_tentativas=1, limite_falhas=2,
+            tempo_recuperacao=0.1)
+    for i in range(2):
+        with pytest.raises(requests.ConnectionError):
+            t.get('http://localhost/')
+    with pytest.raises(ErroServicoIndisponivel):
+        t.get('http://localhost/')
+    # outros endereços não são afetados
+    sessao.respostas.append(pytest.instancia_resp_sucesso_produto)
+    assert t.get('http://outro/').status_code == requests.codes.ok
+    # após o tempo de recuperação, uma consulta de teste é permitida
+    time.sleep(0.1)
+    sessao.respostas.append(pytest.instancia_resp_sucesso_produto)
+    assert t.get('http://localhost/').status_code == requests.codes.ok
+    assert not t.disjuntor('http://localhost/').aberto
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/tests/test_vetorizado.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import random
+
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from ibptws.calculadoras import DeOlhoNoImposto
+from ibptws.excecoes import ErroProdutoNaoEncontrado
+from ibptws.excecoes import ErroServicoNaoEncontrado
+from ibptws.tabelas import ProvisaoTabelaLocal
+from ibptws.tabelas import ler_tabela
+from ibptws.vetorizado import TabelaVetorizada
+from ibptws.vetorizado import para_decimal
+from ibptws.vetorizado import _somar
+
+
+TABELA_CSV = u'''\
+codigo;ex;tipo;descricao;nacionalfederal;importadosfederal;estadual;municipal;vigenciainicio;vigenciafim;chave;versao;fonte
+02091021;;0;Gordura de porco, fresca;4.20;6.39;12.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+12340101;;0;Produto Simples;4.20;4.80;18.00;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+12340101;01;0;Produto Simples (ex 01);3.1234;4.10;17.50;0.00;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+0123;;2;Análise e desenvolvimento de sistemas;13.45;14.05;0.00;4.33;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+101011000;;1;Serviços de construção;13.45;15.45;0.00;3.90;01/01/2017;30/06/2017;A1B2C3;17.1.A;IBPT
+'''
+
+
+@pytest.fixture
+def arquivo_tabela(tmpdir):
+    arquivo = tmpdir.join('TabelaIBPTaxSP17.1.A.csv')
+    arquivo.write_binary(TABELA_CSV.encode('iso-8859-1'))
+    return str(arquivo)
+
+
+def test_produtos_identicos_a_calculadora(arquivo_tabela):
+    aleatorio = random.Random(12741)
+    chaves = [('02091021', 0), ('12340101', 0), ('12340101', 1)]
+    linhas = [chaves[aleatorio.randrange(3)] + (
+            aleatorio.randint(-10 ** 4, 10 ** 9),) for i in range(2000)]
+
+    calc = DeOlhoNoImposto(provisao=ProvisaoTabelaLocal(arquivo_tabela))
+    for ncm, ex, centavos in linhas:
+        calc.produto(ncm, ex, Decimal(centavos) / 100)
+
+    tabela = TabelaVetorizada(ler_tabela(arquivo_tabela))
+    resultado = tabela.produtos(
+            np.array([ncm for ncm, ex, centavos in linhas]),
+            np.array([ex for ncm, ex, centavos in linhas]),
+            np.array([centavos for ncm, ex, centavos in linhas]))
+    assert len(resultado) == len(linhas)
+    assert resultado.encontrados.all()
+
+    totais = resultado.totais()
+    assert totais.federal_nacional == calc.carga_federal_nacional()
+    assert totais.federal_importado == calc.carga_federal_importado()
+    assert totais.estadual == calc.carga_estadual()
+    assert totais.municipal == calc.carga_municipal()
+    assert totais.total == calc.total()
+
+    # os valores por linha também são exatos
+    ncm, ex, centavos = linhas[0]
+    produto = ProvisaoTabelaLocal(arquivo_tabela).get_produto(ncm, ex)
+    assert para_decimal(resultado.estadual[0]) == \
+            Decimal(centavos) / 100 * (produto.aliquota_estadual / 100)
+
+
+def test_servicos_identicos_a_calculadora(arquivo_tabela):
+    linhas = [('0123', 57577), ('101011000', 10000), ('0123', 1)]
+    calc = DeOlhoNoImposto(provisao=ProvisaoTabelaLocal(arquivo_tabela))
+    for nbs, centavos in linhas:
+        calc.servico(nbs, Decimal(centavos) / 100)
+
+    tabela = TabelaVetorizada(ler_tabela(arquivo_tabela))
+    totais = tabela.servicos([nbs for nbs, c in linhas],
+            [c for nbs, c in linhas]).totais()
+    assert totais.federal_nacional == calc.carga_federal_nacional()
+    assert totais.federal_importado == calc.carga_federal_importado()
+    assert totais.estadual == calc.carga_estadual()
+    assert totais.municipal == calc.carga_municipal()
+
+
+def test_nao_encontrados(arquivo_tabela):
+    tabela = TabelaVetorizada(ler_tabela(arquivo_tabela))
+    with pytest.raises(ErroProdutoNaoEncontrado):
+        tabela.produtos([12340101, 99999999], 0, [100, 100])
+    with pytest.raises(ErroServicoNaoEncontrado):
+        tabela.servicos(['123'], [100])
+
+    resultado = tabela.produtos([12340101, 99999999, 2091021], 0,
+            [100, 100, 100], ignorar_nao_encontrados=True)
+    assert resultado.encontrados.tolist() == [True, False, True]
+    assert resultado.federal_nacional.tolist() == [4200000, 0, 4200000]
+
+
+def test_tabela_vazia():
+    tabela = TabelaVetorizada(ler_tabela(io.StringIO(TABELA_CSV.split(
+            '\n')[0] + '\n'), uf='SP'))
+    resultado = tabela.produtos([12340101], 0, [100],
+            ignorar_nao_encontrados=True)
+    assert not resultado.encontrados.any()
+    assert resultado.totais().estadual == 0
+
+
+def test_limite_ponto_fixo(arquivo_tabela):
+    tabela = TabelaVetorizada(ler_tabela(arquivo_tabela))
+    with pytest.raises(ValueError):
+        tabela.produtos([12340101], 0, [2 ** 62])
+
+
+def test_soma_exata():
+    valores = np.array([2 ** 62, 2 ** 62, -3, 2 ** 62 - 1], dtype=np.int64)
+    assert _somar(valores) == 3 * 2 ** 62 - 4
+    assert _somar(np.zeros(0, dtype=np.int64)) == 0
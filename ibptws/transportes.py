@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/transportes.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numbers
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .excecoes import ErroServicoIndisponivel
+
+
+STATUS_REPETIVEIS = (
+        requests.codes.internal_server_error,
+        requests.codes.bad_gateway,
+        requests.codes.service_unavailable,
+        requests.codes.gateway_timeout,)
+"""Códigos de status HTTP para os quais uma consulta será repetida."""
+
+
+class TransporteBase(object):
+    """
+    Classe base para os transportes HTTP utilizados nas consultas aos web
+    services do IBPT. Um transporte mínimo deverá sobrescrever o método
+    :meth:`get`, que deverá se comportar como ``requests.get``, retornando um
+    objeto que possua o atributo ``status_code`` e os métodos ``json()`` e
+    ``raise_for_status()``.
+
+    Para utilizar um transporte próprio (em testes ou para substituir o web
+    services por uma implementação local, por exemplo) basta atribuí-lo às
+    configurações:
+
+    .. sourcecode:: python
+
+        >>> from ibptws import conf         # doctest: +SKIP
+        >>> conf.transporte = MeuTransporte()   # doctest: +SKIP
+
+    .. versionadded:: 0.5
+    """
+
+    def get(self, url, params=None):
+        """
+        Realiza uma requisição HTTP GET.
+
+        :param str url: Endereço do recurso.
+        :param dict params: Parâmetros da *query string*.
+
+        :return: Um objeto de resposta, como ``requests.Response``.
+        """
+        raise NotImplementedError()
+
+
+    def fechar(self):
+        """
+        Libera os recursos mantidos pelo transporte, como as conexões
+        mantidas abertas. Esta implementação não faz nada.
+        """
+        pass
+
+
+class Disjuntor(object):
+    """
+    Implementa um disjuntor (*circuit breaker*) para um endereço do web
+    services. Após ``limite_falhas`` consultas consecutivas com falha, o
+    disjuntor abre e as consultas seguintes falham imediatamente durante
+    ``tempo_recuperacao`` segundos. Passado esse tempo, uma única consulta
+    de teste é permitida: se tiver sucesso, o disjuntor fecha; se falhar,
+    volta a abrir por mais ``tempo_recuperacao`` segundos.
+
+    .. sourcecode:: python
+
+        >>> disjuntor = Disjuntor(limite_falhas=2, tempo_recuperacao=60)
+        >>> disjuntor.falha(); disjuntor.permitir()
+        True
+        >>> disjuntor.falha(); disjuntor.permitir()
+        False
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, limite_falhas=5, tempo_recuperacao=30):
+        self.limite_falhas = limite_falhas
+        self.tempo_recuperacao = tempo_recuperacao
+        self._falhas = 0
+        self._aberto_em = None
+        self._testando = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def aberto(self):
+        """``True`` se o disjuntor estiver aberto (ou em teste)."""
+        return self._aberto_em is not None
+
+
+    def permitir(self):
+        """
+        Indica se uma consulta pode ser realizada. Quando o disjuntor está
+        aberto e o tempo de recuperação já passou, permite apenas uma
+        consulta de teste por vez.
+        """
+        with self._lock:
+            if self._aberto_em is None:
+                return True
+            if self._testando:
+                return False
+            if time.time() - self._aberto_em >= self.tempo_recuperacao:
+                self._testando = True
+                return True
+            return False
+
+
+    def sucesso(self):
+        """Registra uma consulta bem sucedida, fechando o disjuntor."""
+        with self._lock:
+            self._falhas = 0
+            self._aberto_em = None
+            self._testando = False
+
+
+    def falha(self):
+        """Registra uma consulta com falha."""
+        with self._lock:
+            self._falhas += 1
+            if self._testando or self._falhas >= self.limite_falhas:
+                self._aberto_em = time.time()
+            self._testando = False
+
+
+class PoliticaRepeticao(object):
+    """
+    Tempos limite, repetição das consultas e disjuntores compartilhados pelos
+    transportes síncrono (:class:`TransporteHTTP`) e assíncrono
+    (:class:`~ibptws.assincrono.TransporteAIOHTTP`). Os argumentos são
+    descritos em :class:`TransporteHTTP`.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, timeout=(3.05, 10), prazo=None, max_tentativas=3,
+            espera_inicial=0.1, espera_maxima=2, limite_falhas=5,
+            tempo_recuperacao=30):
+        if isinstance(timeout, numbers.Number):
+            timeout = (timeout, timeout)
+        self.timeout = timeout
+        self.prazo = prazo
+        self.max_tentativas = max_tentativas
+        self.espera_inicial = espera_inicial
+        self.espera_maxima = espera_maxima
+        self.limite_falhas = limite_falhas
+        self.tempo_recuperacao = tempo_recuperacao
+        self._disjuntores = {}
+        self._lock_disjuntores = threading.Lock()
+
+
+    def disjuntor(self, url):
+        """Retorna o :class:`Disjuntor` para o endereço informado."""
+        disjuntor = self._disjuntores.get(url)
+        if disjuntor is None:
+            with self._lock_disjuntores:
+                disjuntor = self._disjuntores.setdefault(url, Disjuntor(
+                        limite_falhas=self.limite_falhas,
+                        tempo_recuperacao=self.tempo_recuperacao))
+        return disjuntor
+
+
+    def _permitir(self, url):
+        # retorna o disjuntor do endereço, se permitir a consulta
+        disjuntor = self.disjuntor(url)
+        if not disjuntor.permitir():
+            raise ErroServicoIndisponivel(url)
+        return disjuntor
+
+
+    def _limite(self):
+        return time.time() + self.prazo if self.prazo else None
+
+
+    def _timeout(self, limite):
+        if limite is None:
+            return self.timeout
+        restante = limite - time.time()
+        if restante <= 0:
+            raise requests.Timeout('prazo esgotado')
+        conexao, leitura = self.timeout
+        return (min(conexao, restante), min(leitura, restante))
+
+
+    def _espera(self, tentativa, limite):
+        # espera antes da próxima tentativa ou None, se não houver outra
+        espera = random.uniform(0, min(self.espera_maxima,
+                self.espera_inicial * 2 ** (tentativa - 1)))
+        if tentativa >= self.max_tentativas or (
+                limite is not None and time.time() + espera >= limite):
+            return None
+        return espera
+
+
+class TransporteHTTP(PoliticaRepeticao, TransporteBase):
+    """
+    Implementa um transporte baseado em uma única ``requests.Session``,
+    compartilhada entre as *threads* do processo, mantendo um *pool* de
+    conexões persistentes (*keep-alive*) com os web services do IBPT. Desse
+    modo, consultas sucessivas reaproveitam a conexão TCP (e a resolução DNS)
+    ao invés de estabelecer uma nova conexão a cada consulta.
+
+    A sessão é criada sob demanda, na primeira requisição, e é recriada
+    automaticamente se o processo for bifurcado (*fork*), de modo que os
+    processos filhos não compartilhem os *sockets* do processo pai.
+
+    Toda requisição tem um tempo limite para conexão e para leitura e,
+    opcionalmente, um prazo total. Falhas de conexão, tempo esgotado e erros
+    HTTP 5xx (veja :data:`STATUS_REPETIVEIS`) são repetidos com espera
+    exponencial e aleatória (*jitter*) entre as tentativas. Cada endereço do
+    web services tem seu próprio :class:`Disjuntor`; enquanto estiver aberto,
+    as consultas lançam :class:`~ibptws.excecoes.ErroServicoIndisponivel`
+    sem acessar a rede.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, conexoes_por_host=10, max_hosts=10,
+            bloquear=False, keep_alive=True, timeout=(3.05, 10), prazo=None,
+            max_tentativas=3, espera_inicial=0.1, espera_maxima=2,
+            limite_falhas=5, tempo_recuperacao=30):
+        """
+        Inicia uma instância de :class:`TransporteHTTP`.
+
+        :param int conexoes_por_host: Número máximo de conexões mantidas
+            abertas para um mesmo host (``pool_maxsize`` do ``HTTPAdapter``).
+            Em aplicações com várias *threads* deve ser, no mínimo, o número
+            de *threads* que farão consultas simultâneas.
+
+        :param int max_hosts: Número de *pools* de conexões (um por host)
+            mantidos em cache (``pool_connections`` do ``HTTPAdapter``).
+
+        :param bool bloquear: Se ``True``, uma requisição aguardará até que
+            haja uma conexão livre no *pool* ao invés de abrir uma conexão
+            adicional, limitando estritamente o número de conexões por host
+            a ``conexoes_por_host``.
+
+        :param bool keep_alive: Se ``False``, as conexões serão encerradas ao
+            final de cada requisição (cabeçalho ``Connection: close``).
+
+        :param tuple timeout: Tempos limite de conexão e de leitura, em
+            segundos, para cada tentativa (como em ``requests.get``). Um
+            único número é utilizado para ambos.
+
+        :param float prazo: **Opcional** Prazo total, em segundos, para uma
+            consulta, incluindo todas as tentativas e esperas entre elas.
+
+        :param int max_tentativas: Número máximo de tentativas por consulta.
+            Informe ``1`` para não repetir as consultas.
+
+        :param float espera_inicial: Espera máxima, em segundos, antes da
+            segunda tentativa. A espera máxima dobra a cada tentativa; a
+            espera efetiva é sorteada entre zero e esse máximo.
+
+        :param float espera_maxima: Limite, em segundos, para a espera entre
+            duas tentativas.
+
+        :param int limite_falhas: Número de consultas consecutivas com falha
+            que abrem o disjuntor de um endereço.
+
+        :param float tempo_recuperacao: Tempo, em segundos, que o disjuntor
+            permanece aberto antes de permitir uma consulta de teste.
+        """
+        super(TransporteHTTP, self).__init__(timeout=timeout, prazo=prazo,
+                max_tentativas=max_tentativas, espera_inicial=espera_inicial,
+                espera_maxima=espera_maxima, limite_falhas=limite_falhas,
+                tempo_recuperacao=tempo_recuperacao)
+        self.conexoes_por_host = conexoes_por_host
+        self.max_hosts = max_hosts
+        self.bloquear = bloquear
+        self.keep_alive = keep_alive
+        self._sessao = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+
+    def _criar_sessao(self):
+        adaptador = HTTPAdapter(
+                pool_connections=self.max_hosts,
+                pool_maxsize=self.conexoes_por_host,
+                pool_block=self.bloquear)
+        sessao = requests.Session()
+        sessao.mount('http://', adaptador)
+        sessao.mount('https://', adaptador)
+        if not self.keep_alive:
+            sessao.headers['Connection'] = 'close'
+        return sessao
+
+
+    @property
+    def sessao(self):
+        """
+        A ``requests.Session`` em uso por este transporte, criada sob demanda.
+        """
+        sessao = self._sessao
+        if sessao is None or self._pid != os.getpid():
+            with self._lock:
+                if self._sessao is None or self._pid != os.getpid():
+                    # após um fork, a sessão herdada é simplesmente
+                    # descartada (sem fechar os sockets do processo pai)
+                    self._sessao = self._criar_sessao()
+                    self._pid = os.getpid()
+                sessao = self._sessao
+        return sessao
+
+
+    def get(self, url, params=None):
+        disjuntor = self._permitir(url)
+        limite = self._limite()
+        tentativa = 0
+
+        while True:
+            tentativa += 1
+            erro, response = None, None
+            try:
+                response = self.sessao.get(url, params=params,
+                        timeout=self._timeout(limite))
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                erro = ex
+            except Exception:
+                disjuntor.falha()
+                raise
+            else:
+                if response.status_code not in STATUS_REPETIVEIS:
+                    disjuntor.sucesso()
+                    return response
+
+            espera = self._espera(tentativa, limite)
+            if espera is None:
+                disjuntor.falha()
+                if erro is not None:
+                    raise erro
+                return response
+
+            time.sleep(espera)
+
+
+    def fechar(self):
+        with self._lock:
+            if self._sessao is not None and self._pid == os.getpid():
+                self._sessao.close()
+            self._sessao = None
+            self._pid = None
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+# ibptws/vetorizado.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Cálculo vetorizado dos valores aproximados dos tributos sobre grandes
+volumes de itens, com `NumPy`_, para relatórios fiscais que processam
+milhões de linhas de venda. As entradas são colunas (arrays) com os códigos,
+as exceções e os subtotais em centavos; as alíquotas de uma tabela do IBPT
+são mantidas em arrays ordenados pela chave numérica dos produtos e
+serviços, como no formato compilado (veja
+:func:`~ibptws.tabelas.compilar_tabela`).
+
+Toda a aritmética é inteira, em ponto fixo, e não há arredondamento: as
+alíquotas são representadas em unidades de ``1/ESCALA`` ponto percentual
+(veja :data:`~ibptws.tabelas.ESCALA`) e os subtotais em centavos, de modo
+que o valor de cada linha, ``centavos * aliquota``, é exato em unidades de
+:data:`UNIDADE` real. Os totais são somados com inteiros do Python, sem
+risco de estouro. Assim, os valores obtidos, convertidos para ``Decimal``,
+são exatamente iguais (``==``) aos calculados por
+:class:`~ibptws.calculadoras.DeOlhoNoImposto` para os mesmos itens com
+``valor = Decimal(centavos) / 100``, enquanto os totais de
+:class:`~ibptws.calculadoras.DeOlhoNoImposto` não excederem a precisão do
+contexto decimal (28 dígitos). Apenas o expoente dos objetos ``Decimal``
+pode diferir.
+
+.. sourcecode:: python
+
+    >>> from ibptws.tabelas import ler_tabela
+    >>> tabela = TabelaVetorizada(ler_tabela('TabelaIBPTaxSP17.1.A.csv'))  # doctest: +SKIP
+    >>> resultado = tabela.produtos(ncms, exs, centavos)  # doctest: +SKIP
+    >>> resultado.totais().estadual  # doctest: +SKIP
+    Decimal('1523.87000000')
+
+Requer o NumPy, que é uma dependência opcional (``pip install
+ibptws[numpy]``).
+
+.. versionadded:: 0.5
+
+.. _`NumPy`: https://numpy.org/
+"""
+
+from collections import namedtuple
+from decimal import Decimal
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .excecoes import ErroProdutoNaoEncontrado
+from .excecoes import ErroServicoNaoEncontrado
+from .tabelas import ESCALA
+from .tabelas import _fixo
+
+
+UNIDADE = Decimal(1).scaleb(-2) / (ESCALA * 100)
+"""Unidade, em reais, dos valores inteiros calculados por linha: centavos
+vezes alíquota em ``1/ESCALA`` ponto percentual, dividido por cem."""
+
+_EXPOENTE = UNIDADE.adjusted()
+
+_MAXIMO = 2 ** 63 - 1
+
+# linhas somadas de uma só vez (veja _somar)
+_BLOCO = 2 ** 30
+
+
+Totais = namedtuple('Totais', 'federal_nacional federal_importado estadual '
+        'municipal total')
+"""
+Totais, como ``Decimal``, dos valores aproximados dos tributos em cada
+esfera e da soma dos subtotais (``total``), em reais.
+"""
+
+
+class ResultadoVetorizado(object):
+    """
+    Resultado do cálculo vetorizado. Os atributos ``federal_nacional``,
+    ``federal_importado``, ``estadual`` e ``municipal`` são arrays
+    ``int64`` com o valor de cada linha em unidades de :data:`UNIDADE`;
+    ``centavos`` é o array dos subtotais informados e ``encontrados``
+    indica as linhas cujo código foi encontrado na tabela (as demais têm
+    valor zero em todas as esferas).
+    """
+
+    def __init__(self, centavos, encontrados, federal_nacional,
+            federal_importado, estadual, municipal):
+        self.centavos = centavos
+        self.encontrados = encontrados
+        self.federal_nacional = federal_nacional
+        self.federal_importado = federal_importado
+        self.estadual = estadual
+        self.municipal = municipal
+
+
+    def __len__(self):
+        return len(self.centavos)
+
+
+    def somas(self):
+        """
+        Retorna as somas exatas de cada esfera, como inteiros do Python em
+        unidades de :data:`UNIDADE`, e a soma dos subtotais, em centavos.
+
+        :rtype: Totais
+        """
+        return Totais(
+                federal_nacional=_somar(self.federal_nacional),
+                federal_importado=_somar(self.federal_importado),
+                estadual=_somar(self.estadual),
+                municipal=_somar(self.municipal),
+                total=_somar(self.centavos))
+
+
+    def totais(self):
+        """
+        Retorna os totais de cada esfera e a soma dos subtotais, em reais.
+
+        :rtype: Totais
+        """
+        somas = self.somas()
+        return Totais(
+                federal_nacional=para_decimal(somas.federal_nacional),
+                federal_importado=para_decimal(somas.federal_importado),
+                estadual=para_decimal(somas.estadual),
+                municipal=para_decimal(somas.municipal),
+                total=Decimal(somas.total).scaleb(-2))
+
+
+class TabelaVetorizada(object):
+    """
+    Mantém as alíquotas de uma tabela do IBPT em arrays ordenados pela
+    chave numérica dos produtos (``NCM * 1000 + EX``) e dos serviços
+    (``código * 100 + número de dígitos``), para o cálculo vetorizado.
+    """
+
+    def __init__(self, tabela):
+        """
+        Inicia uma instância de :class:`TabelaVetorizada`.
+
+        :param tabela: Uma :class:`~ibptws.tabelas.Tabela`, como a obtida
+            por :func:`~ibptws.tabelas.ler_tabela`.
+
+        :raises ValueError: se alguma alíquota tiver mais casas decimais do
+            que ``ESCALA`` é capaz de representar.
+
+        :raises RuntimeError: se o NumPy não estiver instalado.
+        """
+        if np is None:
+            raise RuntimeError('TabelaVetorizada requer o NumPy')
+
+        produtos = sorted((int(ncm) * 1000 + ex, _fixo(p.nacional),
+                _fixo(p.importado), _fixo(p.estadual), 0)
+                for (ncm, ex), p in tabela.produtos.items())
+        servicos = sorted((int(codigo) * 100 + len(codigo),
+                _fixo(s.nacional), _fixo(s.importado), _fixo(s.estadual),
+                _fixo(s.municipal))
+                for codigo, s in tabela.servicos.items())
+
+        self._produtos = _colunas(produtos)
+        self._servicos = _colunas(servicos)
+
+
+    def produtos(self, ncms, exs, centavos, ignorar_nao_encontrados=False):
+        """
+        Calcula os valores aproximados dos tributos de cada linha de venda de
+        produtos.
+
+        :param ncms: Array (ou sequência) com os códigos NCM, como números
+            inteiros ou strings de dígitos.
+
+        :param exs: Array com as exceções à regra do NCM, ou um número
+            inteiro, a exceção de todas as linhas.
+
+        :param centavos: Array com os subtotais, em centavos.
+
+        :param bool ignorar_nao_encontrados: Se ``True``, as linhas cujo NCM
+            não for encontrado na tabela são calculadas como zero (veja
+            ``ResultadoVetorizado.encontrados``), ao invés de lançar a
+            exceção.
+
+        :rtype: ResultadoVetorizado
+
+        :raises ErroProdutoNaoEncontrado: se algum NCM não for encontrado na
+            tabela, informando o da primeira linha não encontrada.
+        """
+        ncms = np.asarray(ncms)
+        chaves = ncms.astype(np.int64) * 1000 + np.asarray(exs, np.int64)
+        resultado = self._calcular(self._produtos, chaves, centavos)
+        if not ignorar_nao_encontrados and not resultado.encontrados.all():
+            i = int(np.argmin(resultado.encontrados))
+            raise ErroProdutoNaoEncontrado('NCM={!r}, EX={!r}'.format(
+                    ncms[i].item(), int(chaves[i] % 1000)))
+        return resultado
+
+
+    def servicos(self, codigos, centavos, ignorar_nao_encontrados=False):
+        """
+        Calcula os valores aproximados dos tributos de cada linha de venda de
+        serviços. Veja :meth:`produtos`.
+
+        :param codigos: Array (ou sequência) com os códigos NBS/LC116, como
+            strings de dígitos (os zeros à esquerda são significativos).
+
+        :raises ErroServicoNaoEncontrado: se algum código não for encontrado
+            na tabela.
+        """
+        codigos = np.asarray(codigos, dtype=np.str_)
+        chaves = codigos.astype(np.int64) * 100 + np.char.str_len(codigos)
+        resultado = self._calcular(self._servicos, chaves, centavos)
+        if not ignorar_nao_encontrados and not resultado.encontrados.all():
+            i = int(np.argmin(resultado.encontrados))
+            raise ErroServicoNaoEncontrado('NBS/LC116={!r}'.format(
+                    codigos[i].item()))
+        return resultado
+
+
+    def _calcular(self, colunas, chaves, centavos):
+        tabela, aliquotas = colunas
+        centavos = np.asarray(centavos, dtype=np.int64)
+        if chaves.shape != centavos.shape:
+            raise ValueError('As colunas devem ter o mesmo tamanho')
+
+        # junção por busca binária sobre as chaves ordenadas da tabela
+        posicoes = np.searchsorted(tabela, chaves)
+        np.minimum(posicoes, len(tabela) - 1, out=posicoes)
+        encontrados = (tabela[posicoes] == chaves) if len(tabela) else \
+                np.zeros(chaves.shape, dtype=bool)
+
+        maior = int(aliquotas.max()) if aliquotas.size else 0
+        if maior and len(centavos) and \
+                int(np.abs(centavos).max()) > _MAXIMO // maior:
+            raise ValueError('Subtotal excede o limite do cálculo em ponto '
+                    'fixo ({} centavos)'.format(_MAXIMO // maior))
+
+        valores = []
+        for esfera in range(4):
+            valor = np.zeros(chaves.shape, dtype=np.int64)
+            if len(tabela):
+                np.multiply(centavos, aliquotas[esfera][posicoes],
+                        out=valor, where=encontrados)
+            valores.append(valor)
+
+        return ResultadoVetorizado(centavos, encontrados, *valores)
+
+
+def para_decimal(valor):
+    """
+    Converte um valor inteiro, em unidades de :data:`UNIDADE`, para reais.
+
+    .. sourcecode:: python
+
+        >>> para_decimal(21000000)
+        Decimal('0.21000000')
+
+    :rtype: decimal.Decimal
+    """
+    return Decimal(int(valor)).scaleb(_EXPOENTE)
+
+
+def _colunas(registros):
+    # chaves ordenadas e as alíquotas de cada esfera, em ponto fixo
+    if not registros:
+        return (np.zeros(0, dtype=np.int64), np.zeros((4, 0), dtype=np.int64))
+    colunas = np.array(registros, dtype=np.int64)
+    return colunas[:, 0].copy(), colunas[:, 1:].T.copy()
+
+
+def _somar(valores):
+    # soma exata de um array int64: cada valor é dividido em 32 bits altos
+    # (com sinal) e baixos, cujas somas não estouram em blocos de até 2**30
+    # linhas; os blocos são somados com inteiros do Python
+    valores = np.asarray(valores, dtype=np.int64)
+    soma = 0
+    for inicio in range(0, len(valores), _BLOCO):
+        bloco = valores[inicio:inicio + _BLOCO]
+        altos = int(np.right_shift(bloco, 32).sum())
+        baixos = int(np.bitwise_and(bloco, 0xFFFFFFFF).sum())
+        soma += (altos << 32) + baixos
+    return soma
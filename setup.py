@@ -79,6 +79,13 @@ setup(
             ],
         install_requires=read_install_requires(),
         extras_require={
+                'async': [
+                        'aiohttp',
+                        'redis>=4.2',
+                    ],
+                'numpy': [
+                        'numpy',
+                    ],
                 'testing': [
                         'pytest',
                         'pytest-cov',